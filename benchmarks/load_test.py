@@ -0,0 +1,300 @@
+"""
+Load test of the STIB collectors against the replay server: a full day of
+polls, compressed `--speedup` times, reporting the achieved poll cadence, the
+missed slots, and the CPU time and memory of the collector process.
+
+    python -m benchmarks.load_test --collector async --speedup 48
+    python -m benchmarks.load_test --collector adaptive --speedup 48
+    python -m benchmarks.load_test --collector sync --recording data/vehicle_positions_<start>.ndjson.gz \\
+        --latency 0.02 --error-rate 0.01 --save sync.json
+
+The collector runs as a subprocess, in a temporary directory, with its
+interval divided by the speedup and its base URL pointed at a replay server
+running in this process. Without a recording, a synthetic day is generated
+(see stib/synthetic.py), from midnight, with lines running from 6 to 24 and
+a tenth of them only at night. Polls are taken from the requests arriving at
+the server, leaving out the retries of failed requests, so the timestamps
+the collector writes (to the second, several ticks share one at a high
+speedup) do not matter. The coverage bought with these requests and bytes is
+the share of the recorded snapshots with vehicles that the server served at
+least once.
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+
+from benchmarks.replay_server import ReplayServer, StibReplay, serving
+from stib import synthetic
+from stib.async_collector import chunk_lines
+from stib.scheduler import MAX_GAP_SECONDS
+
+# name -> (module, arguments)
+COLLECTORS = {
+    "async": ("stib.async_collector", []),
+    "adaptive": ("stib.async_collector", ["--adaptive"]),
+    "sync": ("stib.collect_stib_data", []),
+}
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def first_attempts(requests, max_retries=2):
+    """
+    The arrival times of the requests that are not retries.
+
+    The collectors request the same lines again right after a failed request, at most
+    `max_retries` times (see `async_collector.fetch_chunk`); after that the lines wait for the next poll.
+
+    Parameters:
+    requests (list): (arrival time, lines, status) of every request, see `ReplayServer.stib_requests`.
+    """
+    times, failures = [], {}
+    for arrival, lines, status in sorted(requests):
+        failed = failures.get(lines, 0)
+        retry = 0 < failed <= max_retries
+        if not retry:
+            times.append(arrival)
+        failures[lines] = (failed + 1 if retry else 1) if status != 200 else 0
+    return np.asarray(times, dtype=float)
+
+
+def poll_starts(request_times, requests_per_poll=None, interval=None):
+    """
+    The arrival time of the first request of every poll, a poll being `requests_per_poll`
+    requests, or, when polls vary in size, the requests of one tick (a multiple of
+    `interval` seconds since the epoch, see `async_collector.next_tick`).
+
+    Parameters:
+    request_times (array-like): Arrival times of the requests, retries left out (see `first_attempts`).
+    """
+    request_times = np.sort(np.asarray(request_times, dtype=float))
+    if requests_per_poll is not None:
+        return request_times[::requests_per_poll]
+    ticks = np.floor(request_times / interval)
+    first = np.concatenate([[True], ticks[1:] != ticks[:-1]])
+    return request_times[first[: len(request_times)]]
+
+
+def cadence(starts, interval):
+    """
+    Statistics of the gaps between poll starts, in seconds of the run.
+
+    A gap of n intervals (rounded) skips n - 1 slots; a collector that drifts
+    (waits `interval` after each poll) loses slots without skipping any.
+
+    Returns:
+    dict: Polls, skipped slots, and the mean, median, 95th percentile and maximum gap.
+    """
+    gaps = np.diff(starts)
+    if len(gaps) == 0:
+        return {"polls": len(starts), "skipped_slots": 0}
+    return {
+        "polls": len(starts),
+        "skipped_slots": int(np.maximum(np.rint(gaps / interval) - 1, 0).sum()),
+        "gap_mean": float(gaps.mean()),
+        "gap_p50": float(np.quantile(gaps, 0.5)),
+        "gap_p95": float(np.quantile(gaps, 0.95)),
+        "gap_max": float(gaps.max()),
+    }
+
+
+def rss_kb(pid):
+    """Resident memory of process `pid` in kB, from /proc (Linux only), or None."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for row in f:
+                if row.startswith("VmRSS:"):
+                    return int(row.split()[1])
+    except OSError:
+        return None
+    return None
+
+
+def run_collector(collector, url, directory, hours, interval, arguments=(), sample_every=1.0):
+    """
+    Run a collector to completion, with extra command line `arguments`, sampling its memory
+    every `sample_every` seconds.
+
+    Returns:
+    dict: Exit code, wall and CPU seconds, and the resident memory in kB (first, last and peak
+        samples, and the peak reported by the kernel).
+    """
+    module, collector_arguments = COLLECTORS[collector]
+    command = [
+        sys.executable, "-m", module,
+        "--hours", str(hours), "--interval", str(interval), "--base-url", url, *collector_arguments, *arguments,
+    ]
+    env = dict(os.environ, STIB_API_KEY="replay", PYTHONPATH=REPO_ROOT)
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    samples = []
+    start = time.perf_counter()
+    with open(os.path.join(directory, "collector.log"), "w") as log:
+        process = subprocess.Popen(command, cwd=directory, env=env, stdout=log, stderr=subprocess.STDOUT)
+        while process.poll() is None:
+            rss = rss_kb(process.pid)
+            if rss is not None:
+                samples.append(rss)
+            time.sleep(sample_every)
+    wall = time.perf_counter() - start
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        "returncode": process.returncode,
+        "wall_seconds": wall,
+        "cpu_user_seconds": after.ru_utime - before.ru_utime,
+        "cpu_system_seconds": after.ru_stime - before.ru_stime,
+        "rss_first_kb": samples[0] if samples else None,
+        "rss_last_kb": samples[-1] if samples else None,
+        "rss_peak_kb": max(samples) if samples else None,
+        "maxrss_kb": after.ru_maxrss,
+    }
+
+
+def log_bytes(directory):
+    """
+    Size of the snapshot logs of `directory`/data, in bytes.
+
+    The snapshots are not counted: the log drops identical snapshots of one timestamp,
+    and at a high speedup several ticks share a timestamp, so `ReplayServer.coverage`
+    counts what was collected instead.
+    """
+    data = os.path.join(directory, "data")
+    return sum(
+        os.path.getsize(os.path.join(data, name))
+        for name in os.listdir(data)
+        if name.startswith("vehicle_positions_") and ".ndjson" in name
+    )
+
+
+def load_test(
+    collector="async",
+    recording=None,
+    hours=24.0,
+    speedup=48.0,
+    interval=13.0,
+    lines=50,
+    vehicles=8,
+    latency=0.0,
+    jitter=0.0,
+    error_rate=0.0,
+    seed=0,
+):
+    """
+    Replay `hours` of `recording` (a synthetic day if None) to `collector`, `speedup` times faster.
+
+    Latency and jitter are in seconds of the run, not of the recording.
+
+    Returns:
+    dict: {"scale", "collector" (see `run_collector`), "cadence" (see `cadence`, in seconds of
+        the recording), "server" (requests, errors and bytes per API), "coverage" (see
+        `ReplayServer.coverage`, over the whole recording)}.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        if recording is None:
+            recording = synthetic.generate(
+                os.path.join(tmp, "recording"),
+                lines,
+                vehicles,
+                hours,
+                start=datetime(2024, 8, 27),
+                seed=seed,
+                service_hours=(6, 24),
+                night_line_rate=0.1,
+            )
+        replay = StibReplay(recording)
+        server = ReplayServer(
+            stib=replay, latency=latency, jitter=jitter, error_rate=error_rate, speedup=speedup, seed=seed
+        )
+        bus_lines = sorted(replay.lines, key=lambda line_id: (len(line_id), line_id))
+        directory = os.path.join(tmp, "collector")
+        os.makedirs(os.path.join(directory, "data"))
+        with open(os.path.join(directory, "data", "bus_lines.txt"), "w") as f:
+            f.write("\n".join(bus_lines) + "\n")
+
+        # the gap the speed computation tolerates shrinks with the interval
+        arguments = ["--max-gap", str(MAX_GAP_SECONDS / speedup)] if collector == "adaptive" else []
+        with serving(server) as url:
+            process = run_collector(collector, url, directory, hours / speedup, interval / speedup, arguments)
+        if process["returncode"] != 0:
+            with open(os.path.join(directory, "collector.log")) as f:
+                print(f.read()[-2000:], file=sys.stderr)
+        process["log_bytes"] = log_bytes(directory)
+
+    request_times = first_attempts(server.stib_requests)
+    if collector == "adaptive":
+        # a tick polls the lines that are due, possibly none
+        starts = poll_starts(request_times, interval=interval / speedup)
+    else:
+        starts = poll_starts(request_times, len(chunk_lines(bus_lines)))
+    stats = cadence(starts * speedup, interval)
+    stats["expected_polls"] = int(hours * 3600 // interval)
+    stats["missed_slots"] = max(stats["expected_polls"] - stats["polls"], 0)
+    return {
+        "scale": {"collector": collector, "hours": hours, "speedup": speedup, "interval": interval,
+                  "lines": len(bus_lines), "latency": latency, "jitter": jitter, "error_rate": error_rate},
+        "collector": process,
+        "cadence": stats,
+        "server": dict(server.stats),
+        "coverage": server.coverage(),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay a compressed day of STIB positions to a collector.")
+    parser.add_argument("--collector", default="async", choices=sorted(COLLECTORS))
+    parser.add_argument("--recording", help="snapshot log, vehicle_positions_*.json or Parquet root; synthetic by default")
+    parser.add_argument("--hours", type=float, default=24.0, help="of recording to replay")
+    parser.add_argument("--speedup", type=float, default=48.0)
+    parser.add_argument("--interval", type=float, default=13.0, help="poll interval of the recording, in seconds")
+    parser.add_argument("--lines", type=int, default=50, help="lines of the synthetic recording")
+    parser.add_argument("--vehicles", type=int, default=8, help="vehicles per line of the synthetic recording")
+    parser.add_argument("--latency", type=float, default=0.0, help="added to every response, in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save", help="write the report to this JSON file")
+    args = parser.parse_args(argv)
+
+    report = load_test(
+        args.collector,
+        args.recording,
+        args.hours,
+        args.speedup,
+        args.interval,
+        args.lines,
+        args.vehicles,
+        args.latency,
+        args.jitter,
+        args.error_rate,
+        args.seed,
+    )
+    process, stats = report["collector"], report["cadence"]
+    print(f"collector {args.collector}: exit {process['returncode']}, {process['wall_seconds']:.0f} s wall, "
+          f"{process['cpu_user_seconds'] + process['cpu_system_seconds']:.1f} s CPU")
+    print(f"snapshot logs: {process['log_bytes']} bytes")
+    print(f"RSS (kB): first {process['rss_first_kb']}, last {process['rss_last_kb']}, "
+          f"peak {process['rss_peak_kb']}, max {process['maxrss_kb']}")
+    print(f"polls {stats['polls']} of {stats['expected_polls']} slots: {stats['missed_slots']} missed, "
+          f"{stats['skipped_slots']} skipped by a late poll")
+    if "gap_mean" in stats:
+        print(f"gap between polls (s): mean {stats['gap_mean']:.2f}, p50 {stats['gap_p50']:.2f}, "
+              f"p95 {stats['gap_p95']:.2f}, max {stats['gap_max']:.2f}")
+    coverage = report["coverage"]
+    print(f"served {coverage['served']} of the {coverage['recorded']} recorded snapshots with vehicles "
+          f"({coverage['served'] / max(coverage['recorded'], 1):.1%})")
+    for api, counts in report["server"].items():
+        print(f"{api}: {counts['requests']} requests, {counts['errors']} injected errors, {counts['bytes']} bytes")
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
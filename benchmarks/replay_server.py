@@ -0,0 +1,444 @@
+"""
+Local replay server for the collectors: serves recorded STIB vehicle positions,
+Mobility Twin aggregated speeds and static network, and Routes API legs, with
+injected latency and errors, so that collectors can be run without an API key
+or quota.
+
+    python -m benchmarks.replay_server --stib data/vehicle_positions_<start>.ndjson.gz --speedup 24
+    python -m stib.async_collector --base-url http://127.0.0.1:8750 --interval 0.54 --hours 1
+
+Every API is served under its own path on the same port, so the base URL of
+every collector (--base-url, or $STIB_BASE_URL, $MOBILITY_TWIN_BASE_URL and
+$GOOGLE_MAPS_BASE_URL) is the address of the server:
+
+- STIB: the snapshots of a snapshot log, legacy JSON dump or Parquet root, on
+  a clock running `speedup` times faster than real time from the first
+  snapshot, looping at the end of the recording;
+- Mobility Twin: the aggregated speeds of an mt_speeds Parquet store, by
+  timestamp (modulo the recorded period), and the segments and stops GeoJSON
+  of a directory;
+- Routes: as many legs as the request has waypoints, the distance between
+  consecutive waypoints at a speed drawn from recorded Google Maps legs.
+
+GET /_stats returns the requests, injected errors and bytes served per API.
+"""
+import argparse
+import asyncio
+import bisect
+import contextlib
+import functools
+import json
+import math
+import os
+import pickle
+import random
+import re
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+
+from aiohttp import web
+
+from google_maps.async_collector import ROUTES_PATH
+from mobility_twin.backfill import AGGREGATED_SPEED_PATH
+from stib.async_collector import RECORDS_PATH, TIMESTAMP_FORMAT
+from stib.snapshot_log import iter_vehicle_positions
+
+MT_STATIC_PATH = "/stib/{kind}"
+DEFAULT_PORT = 8750
+# speeds of the Routes legs without a recording, in m/s
+DEFAULT_ROUTE_SPEEDS = (4.0, 6.0, 8.0, 10.0)
+EARTH_RADIUS = 6_371_000.0
+
+
+class StibReplay:
+    """
+    The snapshots of a recording, per line, by seconds since its first snapshot.
+
+    Parameters:
+    path (str): A snapshot log, a legacy vehicle_positions_*.json or a Parquet root.
+    """
+
+    def __init__(self, path):
+        snapshots = defaultdict(list)
+        for line_id, instance in iter_vehicle_positions(path):
+            timestamp = datetime.strptime(instance["timestamp"][:19], TIMESTAMP_FORMAT)
+            snapshots[str(line_id)].append((timestamp, instance["vehicle_positions"]))
+        if not snapshots:
+            raise ValueError(f"no snapshots in {path}")
+        self.start = min(instances[0][0] for instances in snapshots.values())
+        self.lines = {}
+        last = 0.0
+        for line_id, instances in snapshots.items():
+            instances.sort(key=lambda instance: instance[0])
+            offsets = [(timestamp - self.start).total_seconds() for timestamp, _ in instances]
+            self.lines[line_id] = (offsets, [positions for _, positions in instances])
+            last = max(last, offsets[-1])
+        # one more poll interval, so that the last snapshot is served as long as the others
+        polls = sorted({offset for offsets, _ in self.lines.values() for offset in offsets})
+        step = min((b - a for a, b in zip(polls, polls[1:])), default=13.0)
+        self.duration = last + step
+        self._render = functools.lru_cache(maxsize=4096)(self._render_uncached)
+
+    def snapshot(self, line_id, offset):
+        """Index of the snapshot of `line_id` at `offset` seconds into the recording (wrapped around), or None."""
+        if line_id not in self.lines:
+            return None
+        offsets, _ = self.lines[line_id]
+        i = bisect.bisect_right(offsets, offset % self.duration) - 1
+        return i if i >= 0 else None
+
+    def has_vehicles(self, line_id, i):
+        positions = self.lines[line_id][1][i]
+        return positions is not None and len(positions) > 0
+
+    def record(self, line_id, i):
+        """The API record of the `i`-th snapshot of `line_id`."""
+        return {"lineid": line_id, "vehiclepositions": self._render(line_id, i)}
+
+    def _render_uncached(self, line_id, i):
+        # the API serves the vehicles as a JSON string, ids as strings
+        positions = self.lines[line_id][1][i]
+        if positions is None:
+            return None
+        return json.dumps(
+            [
+                {"directionId": str(direction), "distanceFromPoint": distance, "pointId": str(point)}
+                for direction, distance, point in zip(
+                    positions["directionId"].tolist(),
+                    positions["distanceFromPoint"].tolist(),
+                    positions["pointId"].tolist(),
+                )
+            ]
+        )
+
+
+class MobilityTwinReplay:
+    """
+    Aggregated-speed responses of an mt_speeds Parquet store (see `storage.write_mt_speeds`)
+    and the segments and stops GeoJSON of a directory, as saved by mobility_twin.get_static_data.
+    """
+
+    def __init__(self, root=None, static_dir=None):
+        self.responses = {}
+        if root is not None:
+            import storage
+
+            df = storage.read_mt_speeds(columns=["line_id", "timestamp", "pointId", "speed"], root=root)
+            for timestamp, group in df.groupby("timestamp"):
+                # naive local times, like the timestamps the collectors request
+                self.responses[int(timestamp.to_pydatetime().timestamp())] = [
+                    {"lineId": str(line_id), "pointId": str(point_id), "speed": speed}
+                    for line_id, point_id, speed in zip(
+                        group["line_id"].tolist(), group["pointId"].tolist(), group["speed"].tolist()
+                    )
+                ]
+        self.timestamps = sorted(self.responses)
+        self.static_dir = static_dir
+
+    def aggregated_speed(self, timestamp):
+        """The response recorded at `timestamp`, or at the same time modulo the recorded period."""
+        if not self.timestamps:
+            return []
+        if timestamp not in self.responses:
+            first, last = self.timestamps[0], self.timestamps[-1]
+            period = last - first + 600
+            timestamp = first + (timestamp - first) % period
+            i = max(bisect.bisect_right(self.timestamps, timestamp) - 1, 0)
+            timestamp = self.timestamps[i]
+        return self.responses[timestamp]
+
+    def static(self, kind):
+        """The text of <static_dir>/<kind>.geojson, or None."""
+        if self.static_dir is None:
+            return None
+        path = os.path.join(self.static_dir, f"{kind}.geojson")
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return f.read()
+
+
+class RoutesReplay:
+    """
+    Routes API legs: the great-circle distance between consecutive waypoints,
+    covered at speeds drawn from recorded legs.
+
+    Parameters:
+    path (str): Optional; a Google Maps pickle or route checkpoint (.ndjson).
+    seed (int): Seed of the speed draws.
+    """
+
+    def __init__(self, path=None, seed=0):
+        speeds = []
+        if path is not None:
+            if path.endswith(".pkl"):
+                with open(path, "rb") as f:
+                    segment_speeds = pickle.load(f)
+            else:
+                from google_maps.checkpoint import RouteCheckpoint
+
+                segment_speeds = RouteCheckpoint(path).segment_speeds()
+            for entry in segment_speeds.values():
+                for leg in entry["speed_data"]:
+                    if leg.get("speed", 0) > 0:
+                        speeds.append(leg["speed"])
+        self.speeds = speeds or list(DEFAULT_ROUTE_SPEEDS)
+        self.rng = random.Random(seed)
+
+    def legs(self, body):
+        waypoints = [body["origin"], *body.get("intermediates", []), body["destination"]]
+        points = [
+            (waypoint["location"]["latLng"]["latitude"], waypoint["location"]["latLng"]["longitude"])
+            for waypoint in waypoints
+        ]
+        legs = []
+        for (lat1, lon1), (lat2, lon2) in zip(points, points[1:]):
+            distance = round(_haversine(lat1, lon1, lat2, lon2))
+            duration = round(distance / self.rng.choice(self.speeds))
+            legs.append({"distanceMeters": distance, "duration": f"{duration}s"})
+        return legs
+
+
+def _haversine(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+
+
+class ReplayServer:
+    """
+    The aiohttp application serving the replays.
+
+    Parameters:
+    stib (StibReplay): Optional.
+    mobility_twin (MobilityTwinReplay): Optional.
+    routes (RoutesReplay): Legs at the default speeds if not given.
+    latency (float): Mean delay added to every response, in seconds.
+    jitter (float): The delay is uniform in latency +/- jitter.
+    error_rate (float): Fraction of the requests answered with `error_status`.
+    error_status (int): Status of the injected errors.
+    retry_after (int): Retry-After of the injected errors, in seconds; no header if not given.
+    speedup (float): How much faster than real time the STIB recording is replayed.
+    seed (int): Seed of the latencies and errors.
+    """
+
+    def __init__(
+        self,
+        stib=None,
+        mobility_twin=None,
+        routes=None,
+        latency=0.0,
+        jitter=0.0,
+        error_rate=0.0,
+        error_status=503,
+        retry_after=None,
+        speedup=1.0,
+        seed=0,
+    ):
+        self.stib = stib
+        self.mobility_twin = mobility_twin
+        self.routes = routes or RoutesReplay(seed=seed)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.speedup = speedup
+        self.rng = random.Random(seed)
+        self.started = time.monotonic()
+        self.stats = defaultdict(lambda: {"requests": 0, "errors": 0, "bytes": 0})
+        # (arrival time, lines requested, status) of every STIB request, for the poll cadence;
+        # arrival times are time.time(), the clock the collectors align their ticks on
+        self.stib_requests = []
+        # (line_id, index) of the recorded snapshots served, for the coverage
+        self.stib_served = set()
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get(RECORDS_PATH, self.handle_stib)
+        app.router.add_get(AGGREGATED_SPEED_PATH, self.handle_aggregated_speed)
+        app.router.add_get(MT_STATIC_PATH, self.handle_mt_static)
+        app.router.add_post(ROUTES_PATH, self.handle_routes)
+        app.router.add_get("/_stats", self.handle_stats)
+        return app
+
+    def clock(self):
+        """Seconds into the STIB recording."""
+        return (time.monotonic() - self.started) * self.speedup
+
+    async def _respond(self, api, payload=None, text=None, status=200):
+        stats = self.stats[api]
+        stats["requests"] += 1
+        delay = self.latency + self.rng.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        headers = {}
+        if self.rng.random() < self.error_rate:
+            stats["errors"] += 1
+            status, text = self.error_status, json.dumps({"error": "injected by the replay server"})
+            if self.retry_after is not None:
+                headers["Retry-After"] = str(self.retry_after)
+        elif text is None:
+            text = json.dumps(payload)
+        stats["bytes"] += len(text)
+        return web.Response(text=text, status=status, headers=headers, content_type="application/json")
+
+    async def handle_stib(self, request):
+        arrival = time.time()
+        # where=lineid in ('71', '72') or lineid in ('71',)
+        lines = re.findall(r"'(\w+)'", request.query.get("where", ""))
+        if self.stib is None:
+            response = await self._respond("stib", {"error": "no STIB recording"}, status=404)
+        else:
+            offset = self.clock()
+            results, served = [], []
+            for line_id in lines:
+                i = self.stib.snapshot(line_id, offset)
+                if i is not None:
+                    results.append(self.stib.record(line_id, i))
+                    served.append((line_id, i))
+            response = await self._respond("stib", {"total_count": len(results), "results": results})
+            # an injected error serves nothing
+            if response.status == 200:
+                self.stib_served.update(served)
+        self.stib_requests.append((arrival, tuple(lines), response.status))
+        return response
+
+    def coverage(self):
+        """
+        Returns:
+        dict: Recorded STIB snapshots with vehicles, and how many of them were served at least once.
+        """
+        recorded = sum(
+            self.stib.has_vehicles(line_id, i)
+            for line_id, (offsets, _) in self.stib.lines.items()
+            for i in range(len(offsets))
+        )
+        served = sum(self.stib.has_vehicles(line_id, i) for line_id, i in self.stib_served)
+        return {"recorded": recorded, "served": served}
+
+    async def handle_aggregated_speed(self, request):
+        if self.mobility_twin is None:
+            return await self._respond("mobility_twin", {"error": "no Mobility Twin recording"}, status=404)
+        timestamp = int(request.query.get("timestamp", time.time()))
+        return await self._respond("mobility_twin", self.mobility_twin.aggregated_speed(timestamp))
+
+    async def handle_mt_static(self, request):
+        text = self.mobility_twin.static(request.match_info["kind"]) if self.mobility_twin else None
+        if text is None:
+            return await self._respond("mobility_twin", {"error": "not recorded"}, status=404)
+        return await self._respond("mobility_twin", text=text)
+
+    async def handle_routes(self, request):
+        body = await request.json()
+        return await self._respond("routes", {"routes": [{"legs": self.routes.legs(body)}]})
+
+    async def handle_stats(self, request):
+        return web.json_response({"uptime": time.monotonic() - self.started, "apis": self.stats})
+
+    async def start(self, host="127.0.0.1", port=DEFAULT_PORT):
+        """
+        Start serving on the running event loop.
+
+        Returns:
+        tuple: (web.AppRunner, to clean up when done, base URL of the server)
+        """
+        runner = web.AppRunner(self.app(), access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, host, port)
+        await site.start()
+        host, port = runner.addresses[0][:2]
+        self.started = time.monotonic()
+        return runner, f"http://{host}:{port}"
+
+
+@contextlib.contextmanager
+def serving(server, host="127.0.0.1", port=0):
+    """
+    Run `server` on its own event loop in a background thread for the duration of the block.
+
+    Yields:
+    str: The base URL of the server.
+    """
+    loop = asyncio.new_event_loop()
+    started = threading.Event()
+    stopped = asyncio.Event()
+    address = {}
+
+    async def run():
+        try:
+            runner, address["url"] = await server.start(host, port)
+        except BaseException as error:
+            # e.g. the port is in use: raised in the caller rather than lost with the thread
+            address["error"] = error
+            return
+        finally:
+            started.set()
+        try:
+            await stopped.wait()
+        finally:
+            await runner.cleanup()
+
+    thread = threading.Thread(target=loop.run_until_complete, args=(run(),), daemon=True)
+    thread.start()
+    started.wait()
+    if "error" in address:
+        thread.join()
+        loop.close()
+        raise address["error"]
+    try:
+        yield address["url"]
+    finally:
+        loop.call_soon_threadsafe(stopped.set)
+        thread.join()
+        loop.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve recorded STIB, Mobility Twin and Routes responses locally.")
+    parser.add_argument("--stib", help="snapshot log, vehicle_positions_*.json or Parquet root to replay")
+    parser.add_argument("--mt-root", help="Parquet root with the mt_speeds to replay")
+    parser.add_argument("--mt-static", help="directory with the segments.geojson and stops.geojson to serve")
+    parser.add_argument("--routes", help="Google Maps pickle or route checkpoint to draw the leg speeds from")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--latency", type=float, default=0.0, help="mean delay of a response, in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument("--retry-after", type=int, help="Retry-After of the injected errors, in seconds")
+    parser.add_argument("--speedup", type=float, default=1.0, help="replay the STIB recording this much faster")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    server = ReplayServer(
+        stib=StibReplay(args.stib) if args.stib else None,
+        mobility_twin=MobilityTwinReplay(args.mt_root, args.mt_static) if args.mt_root or args.mt_static else None,
+        routes=RoutesReplay(args.routes, seed=args.seed),
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        retry_after=args.retry_after,
+        speedup=args.speedup,
+        seed=args.seed,
+    )
+
+    async def run():
+        runner, url = await server.start(args.host, args.port)
+        print(f"replaying on {url}")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
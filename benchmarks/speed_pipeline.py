@@ -0,0 +1,184 @@
+"""
+Benchmarks of the STIB speed pipeline, on synthetic data from stib/synthetic.py.
+
+    python -m benchmarks.speed_pipeline --lines 20 --vehicles 8 --hours 2 --save baseline.json
+    python -m benchmarks.speed_pipeline --lines 20 --vehicles 8 --hours 2 --compare baseline.json
+
+Every case is run `--repeat` times and its median time reported. With
+`--compare`, the medians are compared with a saved run of the same scale and
+the exit status is 1 if a case got slower than `--tolerance` times its saved median.
+
+This is a script rather than a pytest-benchmark suite: its baselines are JSON
+files of a given scale, compared across commits, while tests/ checks the
+results of the same functions (e.g. tests/test_speed_engine.py).
+"""
+import argparse
+import copy
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from stib import calculate_stib_speed as pipeline
+from stib import synthetic
+from stib.network_index import NetworkIndex
+from stib.snapshot_log import load_vehicle_positions
+
+
+def sample_pairs(vehicle_positions, num_pairs):
+    """`num_pairs` (line_id, i) pairs of consecutive non-empty snapshots, spread evenly over every line."""
+    pairs = [
+        (line_id, i)
+        for line_id, instances in vehicle_positions.items()
+        for i in range(len(instances) - 1)
+        if len(instances[i]["vehicle_positions"]) and len(instances[i + 1]["vehicle_positions"])
+    ]
+    step = max(len(pairs) // num_pairs, 1)
+    return pairs[::step][:num_pairs]
+
+
+def cases(network, vehicle_positions, num_pairs):
+    """
+    The benchmarked callables, by name.
+
+    The per-pair functions of calculate_stib_speed are run on the same sample of
+    `num_pairs` snapshot pairs; the engine and the aggregation on every snapshot.
+    Every case gets its own copy of `vehicle_positions`, as `filter_zero_distance`
+    (and `get_interval_pair` through it) drops rows in place.
+    """
+    import pandas as pd
+
+    from stib.aggregation import SpeedAggregator, aggregate_in_time_windows
+    from stib.speed_engine import compute_interval_speeds
+
+    pairs = sample_pairs(vehicle_positions, num_pairs)
+    sample = copy.deepcopy(vehicle_positions)
+    instances = [(line_id, pipeline.filter_zero_distance(sample[line_id][i])) for line_id, i in pairs]
+    # filtered up front, so that every repeat does the same work
+    filtered = copy.deepcopy(vehicle_positions)
+    for line_id, i in pairs:
+        pipeline.filter_zero_distance(filtered[line_id][i])
+        pipeline.filter_zero_distance(filtered[line_id][i + 1])
+
+    raw = []
+    for line_id, instance in instances:
+        df = pd.DataFrame(instance["vehicle_positions"])
+        df["directionId"] = df["directionId"].astype(int)
+        df["pointId"] = df["pointId"].astype(int)
+        raw.append((df, network.stops_line(int(line_id))))
+    joined = [
+        (
+            pipeline.to_df(vehicle_positions[line_id][i], line_id, network)[0],
+            pipeline.to_df(vehicle_positions[line_id][i + 1], line_id, network)[0],
+        )
+        for line_id, i in pairs
+    ]
+    speeds, _ = compute_interval_speeds(vehicle_positions, network)
+    copies = {name: copy.deepcopy(vehicle_positions) for name in ("engine", "end_to_end")}
+
+    def aggregate():
+        aggregator = SpeedAggregator()
+        aggregator.add(speeds)
+        return aggregator.pop_all()
+
+    return {
+        "to_df": lambda: [pipeline.to_df(instance, line_id, network) for line_id, instance in instances],
+        "merge_with_flexible_direction": lambda: [
+            pipeline.merge_with_flexible_direction(df, stops_line) for df, stops_line in raw
+        ],
+        "join_dataframes": lambda: [pipeline.join_dataframes(df1, df2) for df1, df2 in joined],
+        "get_interval_pair": lambda: [
+            pipeline.get_interval_pair(filtered, i, line_id, network) for line_id, i in pairs
+        ],
+        "compute_interval_speeds": lambda: compute_interval_speeds(copies["engine"], network),
+        "aggregate": aggregate,
+        "end_to_end": lambda: list(aggregate_in_time_windows(copies["end_to_end"], network)),
+    }
+
+
+def run(benchmarks, repeat=5):
+    """
+    Returns:
+    dict: name -> {"median", "min"} in seconds.
+    """
+    results = {}
+    for name, benchmark in benchmarks.items():
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            benchmark()
+            timings.append(time.perf_counter() - start)
+        results[name] = {"median": statistics.median(timings), "min": min(timings)}
+    return results
+
+
+def compare(results, baseline, tolerance=1.2):
+    """
+    Print the ratio of every median to the one of `baseline`.
+
+    Returns:
+    list: Names of the cases slower than `tolerance` times their baseline.
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result["median"] / baseline[name]["median"]
+        flag = ""
+        if ratio > tolerance:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:32} {ratio:6.2f}x{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the STIB speed pipeline on synthetic data.")
+    parser.add_argument("--lines", type=int, default=10)
+    parser.add_argument("--vehicles", type=int, default=8, help="vehicles per line")
+    parser.add_argument("--hours", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--pairs", type=int, default=100, help="snapshot pairs for the per-pair functions")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--data", help="directory of the synthetic data, a temporary one by default")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="compare with the results of this JSON file")
+    parser.add_argument("--tolerance", type=float, default=1.2)
+    args = parser.parse_args(argv)
+
+    scale = {"lines": args.lines, "vehicles": args.vehicles, "hours": args.hours, "seed": args.seed, "pairs": args.pairs}
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = args.data or tmp
+        path = synthetic.generate(directory, args.lines, args.vehicles, args.hours, seed=args.seed)
+        vehicle_positions = load_vehicle_positions(path)
+        network = NetworkIndex.from_files(
+            os.path.join(directory, "preprocessed_data", "Stops.geojson"),
+            os.path.join(directory, "data", "segments.geojson"),
+            cache_dir=None,
+        )
+        num_rows = sum(
+            len(instance["vehicle_positions"]) for instances in vehicle_positions.values() for instance in instances
+        )
+        print(f"{sum(map(len, vehicle_positions.values()))} snapshots, {num_rows} vehicle positions")
+        results = run(cases(network, vehicle_positions, args.pairs), args.repeat)
+
+    for name, result in results.items():
+        print(f"{name:32} median {result['median'] * 1000:10.1f} ms   min {result['min'] * 1000:10.1f} ms")
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"scale": scale, "results": results}, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline["scale"] != scale:
+            sys.exit(f"{args.compare} was run at another scale: {baseline['scale']}")
+        if compare(results, baseline["results"], args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
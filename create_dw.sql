@@ -1,12 +1,16 @@
-CREATE EXTENSION postgis;
+-- schema of the warehouse, applied by load_dw.py (safe to run again);
+-- secondary indexes and foreign keys are added by the loader after the bulk load
+CREATE EXTENSION IF NOT EXISTS postgis;
 
-CREATE TABLE lines (
+CREATE TABLE IF NOT EXISTS lines (
 	line_id SMALLINT PRIMARY KEY
 );
 
-CREATE TABLE times (
+-- time_id: number of 10-minute buckets since 1970-01-01 (facts.time_ids); a times table
+-- with the serial ids of create_db_files.ipynb is renumbered by load_dw.create_schema
+CREATE TABLE IF NOT EXISTS times (
 	time_id INT PRIMARY KEY,
-	datetime TIMESTAMP,
+	datetime TIMESTAMP UNIQUE,
 	day SMALLINT,
 	month SMALLINT,
 	year SMALLINT,
@@ -14,10 +18,10 @@ CREATE TABLE times (
 	minute SMALLINT
 );
 
-
-CREATE TABLE stops (
+-- direction as in Stops.geojson (the ogr2ogr import used to replace the table)
+CREATE TABLE IF NOT EXISTS stops (
 	stop_id INT,
-	direction BOOLEAN,
+	direction TEXT,
 	stop_name TEXT,
 	stop_sequence INT,
 	line_id INT,
@@ -25,14 +29,25 @@ CREATE TABLE stops (
 	PRIMARY KEY (stop_id, direction, line_id)
 );
 
-DROP TABLE IF EXISTS segments;
-CREATE TABLE segments (
+CREATE TABLE IF NOT EXISTS segments (
 	start_stop_id INT,
 	end_stop_id INT,
-	geometry GEOMETRY
+	geometry GEOMETRY,
+	PRIMARY KEY (start_stop_id, end_stop_id)
 );
 
-CREATE TABLE speeds (
+-- the lines and directions every segment is part of (data/segments.geojson)
+CREATE TABLE IF NOT EXISTS segment_lines (
+	start_stop_id INT,
+	end_stop_id INT,
+	line_id SMALLINT,
+	direction SMALLINT,
+	PRIMARY KEY (start_stop_id, end_stop_id, line_id, direction)
+);
+
+-- one partition per month of time_ids, created by load_dw.create_partitions;
+-- the primary key also serves the lookups by segment
+CREATE TABLE IF NOT EXISTS speeds (
 	start_stop_id INT,
 	end_stop_id INT,
 	time_id INT,
@@ -40,42 +55,35 @@ CREATE TABLE speeds (
 	median_speed DECIMAL,
 	source TEXT,
 	PRIMARY KEY (start_stop_id, end_stop_id, time_id, source)
-);
-
-COPY lines(line_id)
-FROM '/Users/cookiefinder/Documents/BDMA/Summer_Internship_24/TrafficSegmentSpeedsBrussels/preprocessed_data/Lines.csv' DELIMITER ',' CSV HEADER;
-
-COPY times(time_id,datetime,day,month,year,hour,minute)
-FROM '/Users/cookiefinder/Documents/BDMA/Summer_Internship_24/TrafficSegmentSpeedsBrussels/preprocessed_data/Times.csv' DELIMITER ',' CSV HEADER;
-
-COPY speeds(start_stop_id,end_stop_id,time_id,avg_speed,median_speed,source)
-FROM '/Users/cookiefinder/Documents/BDMA/Summer_Internship_24/TrafficSegmentSpeedsBrussels/preprocessed_data/FactTable.csv' DELIMITER ',' CSV HEADER;
-
--- ogr2ogr -f "PostgreSQL" PG:"dbname=tssb_aug27 user=postgres password=password host=localhost" /Users/cookiefinder/Documents/BDMA/Summer_Internship_24/TrafficSegmentSpeedsBrussels/preprocessed_data/Stops.geojson -nln stops -overwrite -nlt POINT -lco GEOMETRY_NAME=geometry
-
-SELECT * FROM stops;
-
--- ogr2ogr -f "PostgreSQL" PG:"dbname=tssb_aug27 user=postgres password=password host=localhost" /Users/cookiefinder/Documents/BDMA/Summer_Internship_24/TrafficSegmentSpeedsBrussels/preprocessed_data/Segments.geojson -nln segments -overwrite -nlt LINESTRING -lco GEOMETRY_NAME=geometry
-
-SELECT * FROM segments;
-
-ALTER TABLE segments DROP CONSTRAINT segments_pkey;
-
-ALTER TABLE segments
-ADD PRIMARY KEY (start_stop_id, end_stop_id);
-
-
-ALTER TABLE stops
-ADD CONSTRAINT fk_stops_line_id
-FOREIGN KEY (line_id) REFERENCES lines(line_id);
-
-ALTER TABLE speeds
-ADD CONSTRAINT fk_speeds_start_stop_id
-FOREIGN KEY (start_stop_id,end_stop_id) REFERENCES segments(start_stop_id, end_stop_id);
-
-ALTER TABLE speeds
-ADD CONSTRAINT fk_speeds_time_id
-FOREIGN KEY (time_id) REFERENCES times(time_id);
+) PARTITION BY RANGE (time_id);
 
+-- hourly rollups of speeds, refreshed by load_dw.refresh_rollups for the hours it loads;
+-- hour_id = time_id / 6, and speed_sum / samples is the mean of the 10-minute avg_speed
+CREATE TABLE IF NOT EXISTS speeds_segment_hourly (
+	start_stop_id INT,
+	end_stop_id INT,
+	hour_id INT,
+	source TEXT,
+	samples INT,
+	speed_sum DOUBLE PRECISION,
+	PRIMARY KEY (start_stop_id, end_stop_id, hour_id, source)
+);
 
+CREATE TABLE IF NOT EXISTS speeds_line_direction_hourly (
+	line_id SMALLINT,
+	direction SMALLINT,
+	hour_id INT,
+	source TEXT,
+	samples INT,
+	speed_sum DOUBLE PRECISION,
+	PRIMARY KEY (line_id, direction, hour_id, source)
+);
 
+CREATE TABLE IF NOT EXISTS speeds_line_hourly (
+	line_id SMALLINT,
+	hour_id INT,
+	source TEXT,
+	samples INT,
+	speed_sum DOUBLE PRECISION,
+	PRIMARY KEY (line_id, hour_id, source)
+);
@@ -0,0 +1,260 @@
+"""
+Fact table of the warehouse: mean and median speed per segment, 10-minute
+bucket and source ("STIB", "MT" or "GM").
+
+Every source is turned into a flat frame and joined once against the segment
+table; time ids are the number of 10-minute buckets since 1970-01-01, so they
+are computed from the datetime instead of looked up.
+"""
+import json
+import os
+import pickle
+
+import pandas as pd
+
+import storage
+
+TIME_FREQ = pd.Timedelta(minutes=10)
+EPOCH = pd.Timestamp("1970-01-01")
+# time_ids per hour, hour_id = time_id // BUCKETS_PER_HOUR
+BUCKETS_PER_HOUR = pd.Timedelta(hours=1) // TIME_FREQ
+
+FACT_COLUMNS = ["start_stop_id", "end_stop_id", "time_id", "datetime", "avg_speed", "median_speed", "source"]
+TIME_COLUMNS = ["time_id", "datetime", "day", "month", "year", "hour", "minute"]
+
+
+def time_ids(datetimes):
+    """The 10-minute bucket number of each (bucket-aligned) datetime."""
+    datetimes = pd.to_datetime(pd.Series(datetimes))
+    return ((datetimes - EPOCH) // TIME_FREQ).astype("int64")
+
+
+def times_dimension(datetimes):
+    """
+    The rows of the times table for a set of bucket datetimes.
+
+    Returns:
+    pd.DataFrame: TIME_COLUMNS, one row per distinct datetime, ordered by time_id.
+    """
+    datetimes = pd.Series(pd.to_datetime(pd.Series(datetimes)).drop_duplicates().sort_values().to_numpy())
+    return pd.DataFrame(
+        {
+            "time_id": time_ids(datetimes),
+            "datetime": datetimes,
+            "day": datetimes.dt.day,
+            "month": datetimes.dt.month,
+            "year": datetimes.dt.year,
+            "hour": datetimes.dt.hour,
+            "minute": datetimes.dt.minute,
+        }
+    )
+
+
+def round_to_nearest_10_minutes(datetimes):
+    """Vectorized `round_to_nearest_10_minutes`: seconds are dropped, minute 5 rounds up."""
+    datetimes = pd.to_datetime(pd.Series(datetimes))
+    return (datetimes.dt.floor("min") + pd.Timedelta(minutes=5)).dt.floor(TIME_FREQ)
+
+
+def load_segment_legs(path="data/segments.geojson"):
+    """
+    The raw segments of every (line_id, direction) in route order.
+
+    `leg` is the position of the segment within its route, which is also the
+    index of its leg in the Routes API response of that route.
+    """
+    import geopandas as gpd
+
+    segments = pd.DataFrame(gpd.read_file(path, ignore_geometry=True))
+    segments = segments[["line_id", "direction", "start", "end"]].astype(int)
+    segments["leg"] = segments.groupby(["line_id", "direction"]).cumcount()
+    return segments
+
+
+def _aggregate(df, source):
+    # df: start_stop_id, end_stop_id, datetime, speed
+    facts = (
+        df.groupby(["start_stop_id", "end_stop_id", "datetime"], sort=True)["speed"]
+        .agg(avg_speed="mean", median_speed="median")
+        .reset_index()
+    )
+    facts["time_id"] = time_ids(facts["datetime"]).to_numpy()
+    facts["source"] = source
+    return facts[FACT_COLUMNS]
+
+
+# STIB
+
+
+def stib_facts(stib_speeds):
+    """
+    Facts of the 10-minute STIB speeds (speeds_stib.csv, or `storage.read_stib_speeds`).
+    """
+    facts = pd.DataFrame(
+        {
+            "start_stop_id": stib_speeds["start"].astype(int).to_numpy(),
+            "end_stop_id": stib_speeds["end"].astype(int).to_numpy(),
+            "datetime": pd.to_datetime(stib_speeds["datetime"]).to_numpy(),
+            "avg_speed": stib_speeds["mean"].to_numpy(),
+            "median_speed": stib_speeds["median"].to_numpy(),
+        }
+    ).drop_duplicates()
+    facts["time_id"] = time_ids(facts["datetime"]).to_numpy()
+    facts["source"] = "STIB"
+    return facts[FACT_COLUMNS]
+
+
+# Mobility Twin
+
+
+def load_mt_json(path, start_date, bus_lines=None):
+    """
+    Flatten an agg_speed_*.json dump: a list of responses, one every 10 minutes from `start_date`.
+
+    Returns:
+    pd.DataFrame: timestamp, line_id, pointId, speed.
+    """
+    with open(path) as f:
+        intervals = json.load(f)
+    rows = [
+        (i, entry["lineId"], entry["pointId"], entry["speed"])
+        for i, interval in enumerate(intervals)
+        for entry in interval
+        if bus_lines is None or entry["lineId"] in bus_lines
+    ]
+    df = pd.DataFrame(rows, columns=["interval", "line_id", "pointId", "speed"])
+    df["timestamp"] = pd.Timestamp(start_date) + df.pop("interval") * TIME_FREQ
+    df["line_id"] = df["line_id"].astype(int)
+    df["pointId"] = df["pointId"].astype(int)
+    return df[["timestamp", "line_id", "pointId", "speed"]]
+
+
+def mt_facts(mt_speeds, segments):
+    """
+    Facts of the Mobility Twin aggregated speeds, matched to the segment starting at their point.
+
+    Parameters:
+    mt_speeds (pd.DataFrame): timestamp, line_id, pointId, speed (`load_mt_json` or `storage.read_mt_speeds`).
+    segments (pd.DataFrame): `load_segment_legs`.
+    """
+    # a point starts one segment per line (the first one, as in the notebook)
+    starts = segments.drop_duplicates(subset=["line_id", "start"])[["line_id", "start", "end"]]
+    df = mt_speeds.merge(starts, left_on=["line_id", "pointId"], right_on=["line_id", "start"], how="inner")
+    df = pd.DataFrame(
+        {
+            "start_stop_id": df["start"],
+            "end_stop_id": df["end"],
+            "datetime": pd.to_datetime(df["timestamp"]).dt.floor(TIME_FREQ),
+            "speed": df["speed"].astype(float),
+        }
+    )
+    return _aggregate(df, "MT")
+
+
+# Google Maps
+
+
+def load_gm_pickle(path):
+    """
+    Flatten a gm_segment_speeds_*.pkl file written by `collect_google_maps_data`.
+
+    Returns:
+    pd.DataFrame: line_id, direction, departure_time (local wall time), leg, speed.
+    """
+    with open(path, "rb") as f:
+        segment_speeds = pickle.load(f)
+    rows = [
+        (line_id, direction, entry["time"], leg, estimates["speed"])
+        for (line_id, direction, *_), entry in segment_speeds.items()
+        for leg, estimates in enumerate(entry["speed_data"])
+    ]
+    df = pd.DataFrame(rows, columns=["line_id", "direction", "departure_time", "leg", "speed"])
+    # RFC 3339 times in Brussels time, the offset is dropped
+    df["departure_time"] = pd.to_datetime(df["departure_time"].str[:19], format="%Y-%m-%dT%H:%M:%S")
+    return df
+
+
+def gm_facts(gm_speeds, segments):
+    """
+    Facts of the Google Maps leg speeds, averaged over the routes sharing a segment.
+
+    Parameters:
+    gm_speeds (pd.DataFrame): line_id, direction, departure_time, leg, speed
+        (`load_gm_pickle` or `storage.read_gm_speeds`).
+    segments (pd.DataFrame): `load_segment_legs`.
+    """
+    departure_time = gm_speeds["departure_time"]
+    if departure_time.dt.tz is not None:
+        departure_time = departure_time.dt.tz_convert("Europe/Brussels").dt.tz_localize(None)
+    gm_speeds = gm_speeds.assign(departure_time=departure_time)
+
+    # every response must have one leg per segment of its route
+    keys = ["line_id", "direction"]
+    route_legs = segments.groupby(keys).size().rename("segments")
+    response_legs = gm_speeds.groupby(keys + ["departure_time"]).size().rename("legs").reset_index()
+    mismatch = response_legs.join(route_legs, on=keys)
+    mismatch = mismatch[mismatch["legs"] != mismatch["segments"]]
+    if not mismatch.empty:
+        raise ValueError(f"Length mismatch between legs and segments:\n{mismatch.head()}")
+
+    df = gm_speeds.merge(segments, on=keys + ["leg"], how="inner")
+    df = pd.DataFrame(
+        {
+            "start_stop_id": df["start"],
+            "end_stop_id": df["end"],
+            "datetime": round_to_nearest_10_minutes(df["departure_time"]),
+            "speed": df["speed"].astype(float),
+        }
+    )
+    return _aggregate(df, "GM")
+
+
+def build_fact_table(stib_speeds=None, mt_speeds=None, gm_speeds=None, segments=None):
+    """
+    Facts of every source given, e.g.
+
+        segments = load_segment_legs()
+        build_fact_table(
+            stib_speeds=pd.read_csv("data/speeds_stib.csv"),
+            mt_speeds=load_mt_json("data/agg_speed_2024-05-23_9am_6pm.json", "2024-05-23 09:00:00"),
+            gm_speeds=load_gm_pickle("data/gm_segment_speeds_aug27.pkl"),
+            segments=segments,
+        )
+
+    Returns:
+    pd.DataFrame: FACT_COLUMNS.
+    """
+    parts = []
+    if stib_speeds is not None:
+        parts.append(stib_facts(stib_speeds))
+    if mt_speeds is not None:
+        parts.append(mt_facts(mt_speeds, segments))
+    if gm_speeds is not None:
+        parts.append(gm_facts(gm_speeds, segments))
+    if not parts:
+        return pd.DataFrame(columns=FACT_COLUMNS)
+    return pd.concat(parts, ignore_index=True)
+
+
+def stored_facts(dates=None, segments_path="data/segments.geojson", root=storage.ROOT):
+    """The facts of every source in the Parquet store, for the given days."""
+    stib_speeds = storage.read_stib_speeds(dates, root=root)
+    mt_speeds = storage.read_mt_speeds(dates, root=root)
+    gm_speeds = storage.read_gm_speeds(dates, root=root)
+    segments = None
+    if not mt_speeds.empty or not gm_speeds.empty:
+        segments = load_segment_legs(segments_path)
+    return build_fact_table(
+        stib_speeds=None if stib_speeds.empty else stib_speeds,
+        mt_speeds=None if mt_speeds.empty else mt_speeds,
+        gm_speeds=None if gm_speeds.empty else gm_speeds,
+        segments=segments,
+    )
+
+
+def write_tables(facts, directory="preprocessed_data"):
+    """Write Times.csv and FactTable.csv, the layout `load_dw.legacy_facts` reads."""
+    os.makedirs(directory, exist_ok=True)
+    times_dimension(facts["datetime"]).to_csv(os.path.join(directory, "Times.csv"), index=False)
+    columns = ["start_stop_id", "end_stop_id", "time_id", "avg_speed", "median_speed", "source"]
+    facts[columns].to_csv(os.path.join(directory, "FactTable.csv"), index=False)
@@ -0,0 +1,222 @@
+import argparse
+import asyncio
+import json
+import os
+import pickle
+import random
+import time
+from datetime import datetime
+
+import aiohttp
+import pytz
+from dotenv import load_dotenv
+
+from google_maps.checkpoint import RouteCheckpoint, dated_checkpoint_path
+from google_maps.get_gm_data import add_speeds
+from google_maps.route_templates import load_route_templates
+
+BASE_URL = "https://routes.googleapis.com"
+ROUTES_PATH = "/directions/v2:computeRoutes"
+URL = BASE_URL + ROUTES_PATH
+FIELD_MASK = "routes.legs.distanceMeters,routes.legs.duration"
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """
+    Allow `rate` requests per second on average, with bursts of up to `capacity`.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class RetryableError(Exception):
+    def __init__(self, status, retry_after=None):
+        super().__init__(f"Request failed with status code: {status}")
+        self.retry_after = retry_after
+
+
+async def compute_route(session, semaphore, bucket, url, template, departure_time, max_retries=5, backoff=1.0):
+    """
+    Request the legs of one route request, retrying on 429, 5xx, connection errors and
+    responses that are not JSON.
+
+    Retries wait `backoff` * 2^attempt seconds (with jitter), or as long as
+    the Retry-After header asks.
+    """
+    body = template.render(departure_time)
+    for attempt in range(max_retries + 1):
+        await bucket.acquire()
+        try:
+            async with semaphore:
+                async with session.post(url, data=body) as response:
+                    if response.status in RETRY_STATUSES:
+                        raise RetryableError(response.status, response.headers.get("Retry-After"))
+                    if response.status != 200:
+                        text = await response.text()
+                        raise Exception(f"Request failed with status code: {response.status} {text[:200]}")
+                    # a 200 with an HTML body (e.g. a proxy error page) is retried
+                    data = await response.json(content_type=None)
+            legs = data["routes"][0]["legs"]
+            if len(legs) != template.legs:
+                raise Exception(f"A route was skipped ({len(legs) + 1} != {template.legs + 1})")
+            return legs
+        except (RetryableError, aiohttp.ClientError, asyncio.TimeoutError, json.JSONDecodeError) as e:
+            if attempt == max_retries:
+                raise
+            delay = backoff * 2**attempt * (1 + random.random())
+            if isinstance(e, RetryableError) and e.retry_after and e.retry_after.isdigit():
+                delay = max(delay, float(e.retry_after))
+            await asyncio.sleep(delay)
+
+
+async def get_speed_data_async(session, semaphore, bucket, url, templates, departure_time, **retry):
+    # the requests of a route are independent, their legs are concatenated in order
+    legs = await asyncio.gather(
+        *(
+            compute_route(session, semaphore, bucket, url, template, departure_time, **retry)
+            for template in templates
+        )
+    )
+    return add_speeds([leg for chunk in legs for leg in chunk])
+
+
+async def collect_google_maps_data_async(
+    routes,
+    save_filename,
+    H=8,
+    interval=10,
+    url=URL,
+    api_key=None,
+    rate=10,
+    max_concurrency=20,
+    timeout=30,
+    max_retries=5,
+    timezone_str="Europe/Brussels",
+    checkpoint_path=None,
+):
+    """
+    Request the leg speeds of every route, one departure-time slot at a time.
+
+    All routes of a slot are requested concurrently. Departure times are fixed
+    from the start of the run, so every route of a slot gets the same one,
+    however long the collection takes. Every route is checkpointed as soon as
+    it is received; a run resumed on the same day requests the remaining routes
+    at the departure times of the original schedule (the ones already past are
+    missed), and fails if they have all passed.
+
+    Parameters:
+    routes (dict): (line_id, direction) -> request templates (`route_templates.load_route_templates`).
+    save_filename (str): Pickle of (line_id, direction, time) -> {"time", "speed_data"}, written at the end.
+    url (str): The computeRoutes endpoint, e.g. of a local replay server (benchmarks.replay_server).
+    api_key (str): Google Maps API key.
+    rate (float): Maximum requests per second.
+    max_concurrency (int): Maximum number of requests in flight.
+    timeout (int): Timeout of a single request, in seconds.
+    max_retries (int): Retries of a request on 429, 5xx and connection errors.
+    checkpoint_path (str): The checkpoint log, see `checkpoint.dated_checkpoint_path` for the default.
+
+    Returns:
+    dict: The collected speeds, keyed like the pickle.
+    """
+    tz = pytz.timezone(timezone_str)
+    start = datetime.now(tz).replace(second=0, microsecond=0)
+    checkpoint = RouteCheckpoint(checkpoint_path or dated_checkpoint_path(save_filename, start))
+    times = checkpoint.open_schedule(start, H, interval)
+
+    headers = {"Content-Type": "application/json", "X-Goog-FieldMask": FIELD_MASK}
+    if api_key:
+        headers["X-Goog-Api-Key"] = api_key
+    semaphore = asyncio.Semaphore(max_concurrency)
+    bucket = TokenBucket(rate)
+    errors = []
+    missed = 0
+
+    async def collect_route(session, line_id, direction, departure_time):
+        speed_data = await get_speed_data_async(
+            session, semaphore, bucket, url, routes[(line_id, direction)], departure_time, max_retries=max_retries
+        )
+        checkpoint.append(line_id, direction, departure_time, speed_data)
+
+    async with aiohttp.ClientSession(
+        headers=headers,
+        connector=aiohttp.TCPConnector(limit=max_concurrency),
+        timeout=aiohttp.ClientTimeout(total=timeout),
+    ) as session:
+        for departure_time in times:
+            keys = [(line_id, direction, departure_time) for line_id, direction in routes]
+            keys = [key for key in keys if key not in checkpoint]
+            if not keys:
+                continue
+            # only future departure times can be requested
+            if datetime.fromisoformat(departure_time) <= datetime.now(tz):
+                missed += len(keys)
+                continue
+            results = await asyncio.gather(*(collect_route(session, *key) for key in keys), return_exceptions=True)
+            errors += [(key, result) for key, result in zip(keys, results) if isinstance(result, Exception)]
+            if errors:
+                break
+
+    segment_speeds = checkpoint.segment_speeds()
+    with open(save_filename, "wb") as f:
+        pickle.dump(segment_speeds, f)
+    if missed:
+        print(f"{missed} routes were not collected, their departure time had passed")
+    if errors:
+        key, error = errors[0]
+        raise Exception(f"Stopped due to error for {key} ({len(errors)} failed routes)") from error
+    return segment_speeds
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Collect Google Maps leg speeds for every line and direction.")
+    parser.add_argument("--hours", type=int, default=8)
+    parser.add_argument("--interval", type=int, default=10)
+    parser.add_argument("--rate", type=float, default=10, help="requests per second")
+    parser.add_argument("--max-concurrency", type=int, default=20)
+    parser.add_argument("--base-url", help=f"defaults to $GOOGLE_MAPS_BASE_URL or {BASE_URL}")
+    parser.add_argument("--url", help="the full computeRoutes endpoint, overrides --base-url")
+    parser.add_argument("--save-filename", default="data/gm_segment_speeds.pkl")
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    # built from the segments once, then loaded from data/cache
+    routes = load_route_templates("data/segments.geojson")
+
+    segment_speeds = asyncio.run(
+        collect_google_maps_data_async(
+            routes,
+            args.save_filename,
+            H=args.hours,
+            interval=args.interval,
+            url=args.url or (args.base_url or os.environ.get("GOOGLE_MAPS_BASE_URL", BASE_URL)) + ROUTES_PATH,
+            api_key=os.environ.get("GOOGLE_MAPS_API_KEY2"),
+            rate=args.rate,
+            max_concurrency=args.max_concurrency,
+        )
+    )
+
+    # pandas and pyarrow are only loaded once the collection is over
+    import storage
+
+    storage.write_gm_speeds(segment_speeds)
+
+
+if __name__ == "__main__":
+    main()
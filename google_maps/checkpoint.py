@@ -0,0 +1,112 @@
+import json
+import os
+from datetime import datetime, timedelta
+
+
+def schedule(H=8, interval=10):
+    """
+    The (hour, minute) offsets collected by `collect_google_maps_data`: every
+    `interval` minutes for H hours (the first one minute after the start), then H:00.
+    """
+    slots = [(hour, minute) for hour in range(H) for minute in range(0, 60, interval)]
+    slots[0] = (0, 1)
+    return slots + [(H, 0)]
+
+
+def departure_times(start, H=8, interval=10):
+    """The absolute departure times of the schedule, as RFC 3339 strings."""
+    return [(start + timedelta(hours=hour, minutes=minute)).isoformat() for hour, minute in schedule(H, interval)]
+
+
+def dated_checkpoint_path(save_filename, start):
+    """
+    The checkpoint of the run started at `start`: `save_filename` with the date of the run and an
+    .ndjson extension, so a run on a later day starts its own schedule instead of resuming this one.
+    """
+    return f"{os.path.splitext(save_filename)[0]}_{start:%Y-%m-%d}.ndjson"
+
+
+class RouteCheckpoint:
+    """
+    Append-only, line-delimited log of the routes collected so far.
+
+    The first record holds the schedule of the run ({"start", "H", "interval"});
+    every other record is one route at one departure time:
+    {"line_id", "direction", "time", "speed_data"}. Records are fsynced as they
+    are written, so a crash loses at most the request in flight, and a resumed
+    run collects the same departure times, keyed by their absolute time.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.start = None
+        self.H = None
+        self.interval = None
+        self.routes = {}
+        if os.path.isfile(path):
+            self._read()
+
+    def _read(self):
+        with open(self.path, "rb") as f:
+            data = f.read()
+        # a record cut off by a crash is dropped, so the next one starts on its own line
+        complete = data[: data.rfind(b"\n") + 1]
+        if len(complete) != len(data):
+            with open(self.path, "r+b") as f:
+                f.truncate(len(complete))
+        for row in complete.splitlines():
+            record = json.loads(row)
+            if "start" in record:
+                self.start = datetime.fromisoformat(record["start"])
+                self.H = record["H"]
+                self.interval = record["interval"]
+            else:
+                self.routes[(record["line_id"], record["direction"], record["time"])] = record["speed_data"]
+
+    def _write(self, record):
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record, separators=(",", ":")) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def open_schedule(self, start, H=8, interval=10):
+        """
+        Start a new schedule, or return the one of the run being resumed.
+
+        Parameters:
+        start (datetime): The start of a new schedule, the current time.
+
+        Returns:
+        list: The departure times of the schedule.
+
+        Raises:
+        ValueError: If the resumed schedule has no departure time after `start` left to collect.
+        """
+        if self.start is None:
+            self.start, self.H, self.interval = start, H, interval
+            self._write({"start": start.isoformat(), "H": H, "interval": interval})
+        times = departure_times(self.start, self.H, self.interval)
+        if datetime.fromisoformat(times[-1]) <= start:
+            raise ValueError(
+                f"Every departure time of the schedule in {self.path} (started {self.start.isoformat()}) "
+                "has passed; remove the checkpoint to start a new schedule"
+            )
+        return times
+
+    def __contains__(self, key):
+        return key in self.routes
+
+    def append(self, line_id, direction, time, speed_data):
+        """Durably record the legs of one route at one departure time."""
+        line_id, direction = int(line_id), int(direction)
+        self._write({"line_id": line_id, "direction": direction, "time": time, "speed_data": speed_data})
+        self.routes[(line_id, direction, time)] = speed_data
+
+    def segment_speeds(self):
+        """
+        The collected routes in the layout of the gm_segment_speeds pickle.
+
+        Returns:
+        dict: (line_id, direction, time) -> {"time", "speed_data"}.
+        """
+        return {key: {"time": key[2], "speed_data": speed_data} for key, speed_data in self.routes.items()}
@@ -1,26 +1,30 @@
-import json
 from datetime import datetime, timedelta
 from pprint import pprint
+import argparse
 import os
 import pickle
 
 import requests
-from dotenv import load_dotenv, find_dotenv
-import geopandas as gpd
+from dotenv import load_dotenv
 import pytz
-from tqdm.auto import trange
+from tqdm.auto import tqdm
 
-load_dotenv()
+from google_maps.checkpoint import RouteCheckpoint, dated_checkpoint_path
+from google_maps.route_templates import load_route_templates
 
-google_maps_api_key = os.environ["GOOGLE_MAPS_API_KEY2"]
+BASE_URL = "https://routes.googleapis.com"
+ROUTES_PATH = "/directions/v2:computeRoutes"
+URL = BASE_URL + ROUTES_PATH
 
-session = requests.Session()
-headers = {
-    "Content-Type": "application/json",
-    "X-Goog-Api-Key": google_maps_api_key,
-    "X-Goog-FieldMask": "routes.legs.distanceMeters,routes.legs.duration",
-}
-session.headers.update(headers)
+def make_session(google_maps_api_key):
+    session = requests.Session()
+    headers = {
+        "Content-Type": "application/json",
+        "X-Goog-Api-Key": google_maps_api_key,
+        "X-Goog-FieldMask": "routes.legs.distanceMeters,routes.legs.duration",
+    }
+    session.headers.update(headers)
+    return session
 
 # Function to get the RFC 3339 formatted time for a given timezone
 def get_rfc3339_time(
@@ -32,62 +36,17 @@ def get_rfc3339_time(
     )
     return future_time.isoformat()
 
-gdf = gpd.read_file("data/segments.geojson", driver="GeoJSON")
-gdf = gdf[["line_id", "direction", "geometry"]]
-gdf["line_id"] = gdf["line_id"].astype(int)
-
-def get_locations_data(gdf):
-    locations = []
-    # obtain coordinates for each stop in the line
-    for _, row in gdf.iterrows():
-        coords = row.geometry.coords[0]
-        lon, lat = coords
-        location_obj = {"location": {"latLng": {"latitude": lat, "longitude": lon}}}
-        locations.append(location_obj)
-
-    # the final coords are the last point in the last stop
-    final_coords = row.geometry.coords[-1]
-    lon, lat = final_coords
-    location_obj = {"location": {"latLng": {"latitude": lat, "longitude": lon}}}
-    locations.append(location_obj)
-
-    return locations
-
-def get_speed_data_routes_api(gdf, time):
-    url = "https://routes.googleapis.com/directions/v2:computeRoutes"
-    locations = get_locations_data(gdf)
+def get_speed_data_routes_api(session, templates, time, url=URL):
     total_data = []
 
-    for i in range(0, len(locations), 25):
-        if i == 0:
-            locations_list = locations[i : i + 25]
-        else:
-            locations_list = locations[i - 1 : i + 25]
-
-        payload = {
-            "origin": locations_list[0],
-            "destination": locations_list[-1],
-            "intermediates": locations_list[1:-1],
-            "routingPreference": "TRAFFIC_AWARE_OPTIMAL",
-            "computeAlternativeRoutes": False,
-            "routeModifiers": {
-                "avoidTolls": False,
-                "avoidHighways": False,
-                "avoidFerries": False,
-            },
-            "departureTime": time,
-            "languageCode": "en-US",
-            "units": "METRIC",
-        }
-
-        response = session.post(url, data=json.dumps(payload))
+    for template in templates:
+        response = session.post(url, data=template.render(time))
         # Check the response
         if response.status_code == 200:
             data = response.json()
-            if len(locations_list) > 1:
-                assert len(data["routes"][0]["legs"]) + 1 == len(
-                    locations_list
-                ), f"A route was skipped ({len(data['routes'][0]['legs']) + 1} != {len(locations_list)})"
+            assert len(data["routes"][0]["legs"]) == template.legs, (
+                f"A route was skipped ({len(data['routes'][0]['legs']) + 1} != {template.legs + 1})"
+            )
             data = data["routes"][0]["legs"]
             total_data.extend(data)
         else:
@@ -95,78 +54,71 @@ def get_speed_data_routes_api(gdf, time):
             raise Exception(f"Request failed with status code: {response.status_code}")
     return total_data
 
-def collect_google_maps_data(gdf, save_filename, H=8, interval=10, debug=False):
-    grouped = gdf.groupby(["line_id", "direction"])
-
-    if os.path.isfile(save_filename):
-        with open(save_filename, "rb") as f:
-            segment_speeds = pickle.load(f)
-    else:
-        segment_speeds = {}
-
-    # 2. Iterate over each group
-    for hour in trange(H):
-        for minute in range(0, 60, interval):
-            for (line_id, direction), group in grouped:
-                # only future data allowed
-                if hour == 0 and minute == 0:
-                    minute += 1
-                # do not recollect data for segments
-                if (line_id, direction, hour, minute) in segment_speeds:
-                    continue
-                # convert current datetime to iso format
-                time = get_rfc3339_time(hours_from_now=hour, minutes_from_now=minute)
-                speed_data = get_speed_data_routes_api(group, time)
-                if speed_data is None:
-                    raise Exception("Stopped due to error")
-                else:
-                    for i, estimates in enumerate(speed_data):
-                        duration = int(estimates["duration"][:-1])
-                        if duration == 0:
-                            speed_data[i]["distanceMeters"] = 0
-                            speed_data[i]["speed"] = 0
-                        else:
-                            speed_data[i]["speed"] = (
-                                estimates["distanceMeters"] / duration
-                            )
-                    segment_speeds[(line_id, direction, hour, minute)] = {
-                        "time": time,
-                        "speed_data": speed_data,
-                    }
-                    if debug:
-                        print(
-                            f"Processed segment for line_id: {line_id}, direction: {direction}, hours: {hour}, minutes: {minute}"
-                        )
-    else:
-        for (line_id, direction), group in grouped:
-            # finished successfully, so get data for last hour
-            time = get_rfc3339_time(hours_from_now=H)
-            speed_data = get_speed_data_routes_api(group, time)
+def add_speeds(speed_data):
+    for i, estimates in enumerate(speed_data):
+        duration = int(estimates["duration"][:-1])
+        if duration == 0:
+            speed_data[i]["distanceMeters"] = 0
+            speed_data[i]["speed"] = 0
+        else:
+            # distanceMeters is left out of the response when it is 0
+            speed_data[i]["speed"] = estimates.get("distanceMeters", 0) / duration
+    return speed_data
+
+def collect_google_maps_data(
+    session, routes, save_filename, H=8, interval=10, debug=False, checkpoint_path=None, url=URL
+):
+    # every route is checkpointed as soon as it is received, keyed by its departure time;
+    # a resumed run (on the same day) continues the schedule of the checkpoint
+    tz = pytz.timezone("Europe/Brussels")
+    start = datetime.now(tz).replace(second=0, microsecond=0)
+    checkpoint = RouteCheckpoint(checkpoint_path or dated_checkpoint_path(save_filename, start))
+    times = checkpoint.open_schedule(start, H, interval)
+
+    for time in tqdm(times):
+        # only future data allowed
+        if datetime.fromisoformat(time) <= datetime.now(tz):
+            continue
+        for (line_id, direction), templates in routes.items():
+            # do not recollect data for segments
+            if (line_id, direction, time) in checkpoint:
+                continue
+            speed_data = get_speed_data_routes_api(session, templates, time, url)
             if speed_data is None:
                 raise Exception("Stopped due to error")
-            else:
-                for i, estimates in enumerate(speed_data):
-                    duration = int(estimates["duration"][:-1])
-                    if duration == 0:
-                        speed_data[i]["distanceMeters"] = 0
-                        speed_data[i]["speed"] = 0
-                    else:
-                        speed_data[i]["speed"] = estimates["distanceMeters"] / duration
-                segment_speeds[(line_id, direction, H, 0)] = {
-                    "time": time,
-                    "speed_data": speed_data,
-                }
-                if debug:
-                    print(
-                        f"Processed segment for line_id: {line_id}, direction: {direction}, hours: {H}, minutes: 0"
-                    )
+            checkpoint.append(line_id, direction, time, add_speeds(speed_data))
+            if debug:
+                print(f"Processed segment for line_id: {line_id}, direction: {direction}, time: {time}")
 
+    segment_speeds = checkpoint.segment_speeds()
     with open(save_filename, "wb") as f:
         pickle.dump(segment_speeds, f)
 
+    # pandas and pyarrow are only loaded once the collection is over
+    import storage
+
+    storage.write_gm_speeds(segment_speeds)
+
     return segment_speeds
 
-H = 8
-interval = 10
-save_filename = "data/gm_segment_speeds_aug27.pkl"
-data = collect_google_maps_data(gdf, H=H, interval=interval)
\ No newline at end of file
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Collect Google Maps leg speeds of every route, one request at a time.")
+    parser.add_argument("--hours", type=int, default=8)
+    parser.add_argument("--interval", type=int, default=10)
+    parser.add_argument("--segments", default="data/segments.geojson")
+    parser.add_argument("--save-filename", default="data/gm_segment_speeds_aug27.pkl")
+    parser.add_argument("--base-url", help=f"defaults to $GOOGLE_MAPS_BASE_URL or {BASE_URL}")
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    session = make_session(os.environ["GOOGLE_MAPS_API_KEY2"])
+    # waypoints and request bodies of every (line_id, direction), built from the segments
+    # once, then loaded from data/cache; only the departure time changes between requests
+    route_templates = load_route_templates(args.segments)
+    url = (args.base_url or os.environ.get("GOOGLE_MAPS_BASE_URL", BASE_URL)) + ROUTES_PATH
+    return collect_google_maps_data(
+        session, route_templates, args.save_filename, H=args.hours, interval=args.interval, url=url
+    )
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
@@ -0,0 +1,129 @@
+import hashlib
+import json
+import os
+import pickle
+
+# bump when the layout of the cached templates changes
+TEMPLATES_VERSION = 1
+
+# origin, destination and up to 23 intermediates per request
+MAX_WAYPOINTS = 25
+
+_DEPARTURE_PLACEHOLDER = "__departure_time__"
+
+
+def route_locations(xs, ys):
+    """
+    The waypoints of a route: the first point of every segment, then the last
+    point of the last segment.
+
+    Parameters:
+    xs, ys (np.ndarray): Coordinates of the first point of every segment, plus the last point.
+    """
+    return [{"location": {"latLng": {"latitude": lat, "longitude": lon}}} for lon, lat in zip(xs.tolist(), ys.tolist())]
+
+
+def route_payloads(locations, departure_time):
+    """
+    Split the stops of a route into requests of at most MAX_WAYPOINTS waypoints,
+    each starting at the last waypoint of the previous one.
+    """
+    payloads = []
+    for i in range(0, len(locations), MAX_WAYPOINTS):
+        locations_list = locations[i : i + MAX_WAYPOINTS] if i == 0 else locations[i - 1 : i + MAX_WAYPOINTS]
+        payloads.append(
+            {
+                "origin": locations_list[0],
+                "destination": locations_list[-1],
+                "intermediates": locations_list[1:-1],
+                "routingPreference": "TRAFFIC_AWARE_OPTIMAL",
+                "computeAlternativeRoutes": False,
+                "routeModifiers": {
+                    "avoidTolls": False,
+                    "avoidHighways": False,
+                    "avoidFerries": False,
+                },
+                "departureTime": departure_time,
+                "languageCode": "en-US",
+                "units": "METRIC",
+            }
+        )
+    return payloads
+
+
+class RequestTemplate:
+    """
+    A serialized computeRoutes request body, split around its departure time.
+    """
+
+    __slots__ = ("prefix", "suffix", "legs")
+
+    def __init__(self, payload):
+        body = json.dumps(payload)
+        self.prefix, self.suffix = body.split(json.dumps(_DEPARTURE_PLACEHOLDER))
+        # the response has one leg per pair of consecutive waypoints
+        self.legs = len(payload["intermediates"]) + 1
+
+    def render(self, departure_time):
+        """The request body, identical to `json.dumps` of the payload at `departure_time`."""
+        return f'{self.prefix}"{departure_time}"{self.suffix}'
+
+    def __getstate__(self):
+        return self.prefix, self.suffix, self.legs
+
+    def __setstate__(self, state):
+        self.prefix, self.suffix, self.legs = state
+
+
+def build_route_templates(gdf):
+    """
+    The request templates of every route.
+
+    Parameters:
+    gdf (gpd.GeoDataFrame): Segments with 'line_id', 'direction' and 'geometry', in route order.
+
+    Returns:
+    dict: (line_id, direction) -> list of RequestTemplate, in leg order.
+    """
+    import numpy as np
+    import shapely
+
+    templates = {}
+    for (line_id, direction), group in gdf.groupby(["line_id", "direction"]):
+        geometries = group.geometry.to_numpy()
+        points = shapely.get_point(geometries, 0)
+        points = np.append(points, shapely.get_point(geometries[-1], -1))
+        locations = route_locations(shapely.get_x(points), shapely.get_y(points))
+        templates[(int(line_id), int(direction))] = [
+            RequestTemplate(payload) for payload in route_payloads(locations, _DEPARTURE_PLACEHOLDER)
+        ]
+    return templates
+
+
+def load_route_templates(segments_path="data/segments.geojson", cache_dir="data/cache"):
+    """
+    The request templates of every route of the segments file.
+
+    They are cached in `cache_dir` under a hash of the file, so restarts skip
+    reading the GeoJSON and the geometry work.
+    """
+    with open(segments_path, "rb") as f:
+        digest = hashlib.sha1(str(TEMPLATES_VERSION).encode() + f.read()).hexdigest()[:16]
+    cache_path = None
+    if cache_dir is not None:
+        cache_path = os.path.join(cache_dir, f"route_templates_{digest}.pkl")
+        if os.path.isfile(cache_path):
+            with open(cache_path, "rb") as f:
+                return pickle.load(f)
+
+    import geopandas as gpd
+
+    gdf = gpd.read_file(segments_path)
+    gdf = gdf[["line_id", "direction", "geometry"]]
+    gdf["line_id"] = gdf["line_id"].astype(int)
+    templates = build_route_templates(gdf)
+    if cache_path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(cache_path, "wb") as f:
+            pickle.dump(templates, f)
+    return templates
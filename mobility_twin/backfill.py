@@ -0,0 +1,195 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+from datetime import datetime, timedelta
+
+import aiohttp
+import pandas as pd
+from dotenv import load_dotenv
+from tqdm.auto import tqdm
+
+import storage
+from mobility_twin.static_network import BASE_URL
+
+AGGREGATED_SPEED_PATH = "/stib/aggregated-speed"
+URL = BASE_URL + AGGREGATED_SPEED_PATH
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+def timestamps(start_date, end_date, interval=timedelta(minutes=10)):
+    """Every `interval` from `start_date` up to and including `end_date`."""
+    result = []
+    while start_date <= end_date:
+        result.append(start_date)
+        start_date += interval
+    return result
+
+
+def progress_path(root=storage.ROOT):
+    return os.path.join(root, "mt_speeds_backfill.log")
+
+
+def completed_timestamps(start_date, end_date, root=storage.ROOT):
+    """
+    Timestamps of the range already backfilled: those in the progress log
+    (including responses without any bus) and those already in the store.
+    """
+    done = set()
+    if os.path.isfile(progress_path(root)):
+        with open(progress_path(root)) as f:
+            done.update(datetime.strptime(row.strip(), TIMESTAMP_FORMAT) for row in f if len(row.strip()) == 19)
+    dates = [date.strftime("%Y-%m-%d") for date in pd.date_range(start_date.date(), end_date.date())]
+    stored = storage.read_mt_speeds(dates, columns=["timestamp"], root=root)
+    if not stored.empty:
+        done.update(stored["timestamp"].drop_duplicates().tolist())
+    return done
+
+
+async def fetch_timestamp(session, semaphore, url, timestamp, max_retries=5, backoff=1.0):
+    """
+    Request the aggregated speeds of one timestamp, retrying with exponential
+    backoff on 429, 5xx, connection errors and responses that are not JSON.
+    """
+    params = {"timestamp": int(timestamp.timestamp())}
+    for attempt in range(max_retries + 1):
+        try:
+            async with semaphore:
+                async with session.get(url, params=params) as response:
+                    if response.status in RETRY_STATUSES:
+                        raise aiohttp.ClientResponseError(
+                            response.request_info, response.history, status=response.status
+                        )
+                    if response.status != 200:
+                        text = await response.text()
+                        raise Exception(f"Error: {response.status} {text[:200]}")
+                    # a 200 with an HTML body (e.g. a proxy error page) is retried
+                    data = await response.json(content_type=None)
+            return data
+        except (aiohttp.ClientError, asyncio.TimeoutError, json.JSONDecodeError):
+            if attempt == max_retries:
+                raise
+            await asyncio.sleep(backoff * 2**attempt * (1 + random.random()))
+
+
+async def backfill(
+    start_date,
+    end_date,
+    bus_lines,
+    url=URL,
+    token=None,
+    max_concurrency=8,
+    timeout=60,
+    max_retries=5,
+    root=storage.ROOT,
+):
+    """
+    Store the aggregated speeds of the bus lines every 10 minutes from `start_date` to `end_date`.
+
+    Timestamps are requested concurrently. The responses of a day are buffered
+    and written to the mt_speeds dataset at once when the last timestamp of the
+    day is done (or the backfill stops), then recorded in a progress log, so an
+    interrupted backfill resumes with the timestamps it is missing.
+
+    Parameters:
+    start_date, end_date (datetime): The range, both included.
+    bus_lines (list): Line ids to keep (trams and night buses are dropped).
+    url (str): The aggregated-speed endpoint, e.g. of a local replay server (benchmarks.replay_server).
+    token (str): Mobility Twin API token.
+    max_concurrency (int): Maximum number of requests in flight.
+    timeout (int): Timeout of a single request, in seconds.
+    max_retries (int): Retries of a request on 429, 5xx and connection errors.
+
+    Returns:
+    dict: Number of timestamps stored, already done and failed.
+    """
+    done = completed_timestamps(start_date, end_date, root)
+    todo = [timestamp for timestamp in timestamps(start_date, end_date) if timestamp not in done]
+    stats = {"stored": 0, "skipped": len(timestamps(start_date, end_date)) - len(todo), "failed": 0}
+    bus_lines = set(bus_lines)
+
+    headers = {"Authorization": f"Bearer {token}"} if token else {}
+    semaphore = asyncio.Semaphore(max_concurrency)
+    os.makedirs(root, exist_ok=True)
+
+    # date -> responses received and timestamps still to be done
+    responses, pending = {}, {}
+    for timestamp in todo:
+        pending[timestamp.date()] = pending.get(timestamp.date(), 0) + 1
+
+    def flush(date):
+        day = responses.pop(date, [])
+        storage.write_mt_responses(day, root)
+        with open(progress_path(root), "a") as f:
+            f.writelines(timestamp.strftime(TIMESTAMP_FORMAT) + "\n" for timestamp, _ in day)
+
+    def done(timestamp):
+        pending[timestamp.date()] -= 1
+        if pending[timestamp.date()] == 0:
+            flush(timestamp.date())
+
+    async def backfill_timestamp(session, timestamp):
+        try:
+            data = await fetch_timestamp(session, semaphore, url, timestamp, max_retries)
+        except Exception:
+            done(timestamp)
+            raise
+        # drop trams and night buses
+        bus_info = [entry for entry in data if entry["lineId"] in bus_lines]
+        responses.setdefault(timestamp.date(), []).append((timestamp, bus_info))
+        done(timestamp)
+
+    async with aiohttp.ClientSession(
+        headers=headers,
+        connector=aiohttp.TCPConnector(limit=max_concurrency),
+        timeout=aiohttp.ClientTimeout(total=timeout),
+    ) as session:
+        tasks = [asyncio.ensure_future(backfill_timestamp(session, timestamp)) for timestamp in todo]
+        try:
+            for task in tqdm(asyncio.as_completed(tasks), total=len(tasks), desc="Backfilling aggregated speeds"):
+                try:
+                    await task
+                    stats["stored"] += 1
+                except Exception as e:
+                    stats["failed"] += 1
+                    print(f"An error occurred: {e}")
+        finally:
+            # on interruption, stop the requests still in flight; they are redone on resume
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for date in list(responses):
+                flush(date)
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Backfill Mobility Twin aggregated speeds over a date range.")
+    parser.add_argument("start", help='e.g. "2024-05-23 09:00:00"')
+    parser.add_argument("end", help='e.g. "2024-05-23 18:00:00"')
+    parser.add_argument("--max-concurrency", type=int, default=8)
+    parser.add_argument("--base-url", help=f"defaults to $MOBILITY_TWIN_BASE_URL or {BASE_URL}")
+    parser.add_argument("--url", help="the full aggregated-speed endpoint, overrides --base-url")
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    with open("data/bus_lines.txt") as f:
+        bus_lines = f.read().splitlines()
+
+    stats = asyncio.run(
+        backfill(
+            datetime.strptime(args.start, TIMESTAMP_FORMAT),
+            datetime.strptime(args.end, TIMESTAMP_FORMAT),
+            bus_lines,
+            url=args.url or (args.base_url or os.environ.get("MOBILITY_TWIN_BASE_URL", BASE_URL)) + AGGREGATED_SPEED_PATH,
+            token=os.environ.get("MOBILITY_TWIN_TOKEN"),
+            max_concurrency=args.max_concurrency,
+        )
+    )
+    print(stats)
+
+
+if __name__ == "__main__":
+    main()
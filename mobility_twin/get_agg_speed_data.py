@@ -1,39 +1,76 @@
 from datetime import datetime, timedelta
+import argparse
 import requests
 import json
 from dotenv import load_dotenv
 import os
 
-load_dotenv()
-
-with open("data/bus_lines.txt") as f:
-    bus_lines = f.read().splitlines()
-
-avg_speed_data = []
-start_date = datetime.strptime("2024-05-23 09:00:00", "%Y-%m-%d %H:%M:%S")
-end_date = datetime.strptime("2024-05-23 18:00:00", "%Y-%m-%d %H:%M:%S")
-token = os.environ['MOBILITY_TWIN_TOKEN']
+import storage
+from mobility_twin.backfill import AGGREGATED_SPEED_PATH
+from mobility_twin.static_network import BASE_URL
 
 # 10 minute interval
 interval_seconds = 60 * 10
-avg_speed_data = []
-while start_date <= end_date:
-    t = int(start_date.timestamp())
+
+
+def get_agg_speed_data(start_date, end_date, bus_lines, token, base_url=BASE_URL):
+    """
+    Download the aggregated speeds of the bus lines every 10 minutes from `start_date` to `end_date`.
+
+    A failed request is retried until it succeeds. The responses of a day are
+    written to the mt_speeds dataset at once, when the first timestamp of the
+    next day is reached or the download stops.
+    """
+    avg_speed_data = []
+    day = []
     try:
-        response = requests.get(
-            f"https://api.mobilitytwin.brussels/stib/aggregated-speed?timestamp={t}",
-            headers={"Authorization": f"Bearer {token}"},
-        )
-        # drop trams and night buses
-        bus_info = [entry for entry in response.json() if entry["lineId"] in bus_lines]
-        avg_speed_data.append(bus_info)
-    except Exception as e:
-        print(response)
-        print(response.json())
-        print(f"An error occurred: {e}")
-    else:
-        start_date += timedelta(seconds=interval_seconds)
-        
-
-with open("data/agg_speed_2024-05-23_9am_6pm.json", "w") as f:
-    json.dump(avg_speed_data, f, indent=4)
\ No newline at end of file
+        while start_date <= end_date:
+            t = int(start_date.timestamp())
+            try:
+                response = requests.get(
+                    f"{base_url}{AGGREGATED_SPEED_PATH}?timestamp={t}",
+                    headers={"Authorization": f"Bearer {token}"},
+                )
+                # the status first: error pages are not always JSON
+                if response.status_code != 200:
+                    raise Exception(f"Error: {response.status_code} {response.text[:200]}")
+                entries = response.json()
+            except Exception as e:
+                print(f"An error occurred: {e}")
+                continue
+            # drop trams and night buses
+            bus_info = [entry for entry in entries if entry["lineId"] in bus_lines]
+            avg_speed_data.append(bus_info)
+            if day and day[-1][0].date() != start_date.date():
+                storage.write_mt_responses(day)
+                day = []
+            day.append((start_date, bus_info))
+            start_date += timedelta(seconds=interval_seconds)
+    finally:
+        storage.write_mt_responses(day)
+    return avg_speed_data
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Download Mobility Twin aggregated speeds one timestamp at a time.")
+    parser.add_argument("start", nargs="?", default="2024-05-23 09:00:00")
+    parser.add_argument("end", nargs="?", default="2024-05-23 18:00:00")
+    parser.add_argument("--output", default="data/agg_speed_2024-05-23_9am_6pm.json")
+    parser.add_argument("--base-url", help=f"defaults to $MOBILITY_TWIN_BASE_URL or {BASE_URL}")
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    with open("data/bus_lines.txt") as f:
+        bus_lines = f.read().splitlines()
+    start_date = datetime.strptime(args.start, "%Y-%m-%d %H:%M:%S")
+    end_date = datetime.strptime(args.end, "%Y-%m-%d %H:%M:%S")
+    token = os.environ['MOBILITY_TWIN_TOKEN']
+
+    base_url = args.base_url or os.environ.get("MOBILITY_TWIN_BASE_URL", BASE_URL)
+    avg_speed_data = get_agg_speed_data(start_date, end_date, bus_lines, token, base_url)
+    with open(args.output, "w") as f:
+        json.dump(avg_speed_data, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
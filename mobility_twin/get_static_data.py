@@ -1,25 +1,38 @@
 # obtain data from segments or stops
 
+import argparse
 from datetime import datetime
-import requests
 import json
-from tqdm.auto import tqdm
 import os
 from dotenv import load_dotenv
 
-with open("data/bus_lines.txt") as f:
-    bus_lines = f.read().splitlines()
+from mobility_twin.static_network import BASE_URL, fetch
 
-load_dotenv()
-start_date = datetime.strptime("2024-05-23 09:00:00", "%Y-%m-%d %H:%M:%S")
-t = int(start_date.timestamp())
-token = os.environ['MOBILITY_TWIN_TOKEN']
 
-url = f"https://api.mobilitytwin.brussels/stib/segments?timestamp={t}"
-r = requests.get(url, headers={"Authorization": f"Bearer {token}"})
-data = r.json()
+def get_static_data(kind, start_date, token, path, base_url=BASE_URL):
+    data = fetch(kind, start_date, token, url=base_url + "/stib")
 
-# data["features"] = list(filter(lambda x: x["properties"]["route_short_name"] in bus_lines, data["features"]))
+    # data["features"] = list(filter(lambda x: x["properties"]["route_short_name"] in bus_lines, data["features"]))
 
-with open("data/segments.geojson", "w") as f:
-    json.dump(data, f, indent=2)
\ No newline at end of file
+    with open(path, "w") as f:
+        json.dump(data, f, indent=2)
+    return data
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Download the segments or stops valid at a timestamp.")
+    parser.add_argument("timestamp", nargs="?", default="2024-05-23 09:00:00")
+    parser.add_argument("--kind", default="segments", choices=["segments", "stops"])
+    parser.add_argument("--output", help="data/<kind>.geojson by default")
+    parser.add_argument("--base-url", help=f"defaults to $MOBILITY_TWIN_BASE_URL or {BASE_URL}")
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    start_date = datetime.strptime(args.timestamp, "%Y-%m-%d %H:%M:%S")
+    token = os.environ['MOBILITY_TWIN_TOKEN']
+    base_url = args.base_url or os.environ.get("MOBILITY_TWIN_BASE_URL", BASE_URL)
+    get_static_data(args.kind, start_date, token, args.output or f"data/{args.kind}.geojson", base_url)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+"""
+Versioned store of the static STIB network (segments and stops) of the Mobility Twin API.
+
+Every fetch is compared with the version in effect at its timestamp by a hash
+of its content; only a changed network is stored, as a new version valid from
+that timestamp. Versions are kept under data/network/<version>/ as GeoParquet,
+already normalized: typed ids and projected segment lengths. The speed
+computation reads them with `calculate_stib_speed.load_network(network_at=...)`;
+by default it, like the Google Maps route templates, reads the GeoJSON files.
+
+    python -m mobility_twin.static_network "2024-05-23 09:00:00"
+"""
+import argparse
+import hashlib
+import json
+import os
+from datetime import datetime
+
+import requests
+from dotenv import load_dotenv
+
+BASE_URL = "https://api.mobilitytwin.brussels"
+URL = BASE_URL + "/stib"
+NETWORK_DIR = "data/network"
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+KINDS = ("segments", "stops")
+
+
+def fetch(kind, timestamp, token=None, url=URL):
+    """
+    Download the segments or stops valid at `timestamp`.
+
+    Returns:
+    dict: The GeoJSON feature collection.
+    """
+    headers = {"Authorization": f"Bearer {token}"} if token else {}
+    response = requests.get(f"{url}/{kind}", params={"timestamp": int(timestamp.timestamp())}, headers=headers)
+    if response.status_code != 200:
+        raise Exception(f"Error: {response.status_code} {response.text}")
+    return response.json()
+
+
+def content_hash(feature_collection):
+    # independent of key order, whitespace and feature order
+    features = sorted(json.dumps(feature, sort_keys=True) for feature in feature_collection["features"])
+    return hashlib.sha256("\n".join(features).encode()).hexdigest()
+
+
+def normalize_segments(feature_collection):
+    import geopandas as gpd
+
+    # the API serves (lon, lat) pairs
+    segments = gpd.GeoDataFrame.from_features(feature_collection["features"], crs="EPSG:4326")
+    segments = segments.drop(columns=["color"], errors="ignore")
+    for column in ("line_id", "start", "end", "direction"):
+        segments[column] = segments[column].astype(int)
+    segments["segment_length"] = segments.geometry.to_crs(epsg=3812).length
+    return segments
+
+
+def normalize_stops(feature_collection):
+    import geopandas as gpd
+
+    stops = gpd.GeoDataFrame.from_features(feature_collection["features"], crs="EPSG:4326")
+    stops = stops.drop(columns=["id", "stop_lat", "stop_lon", "direction_id"], errors="ignore")
+    stops = stops.rename(columns={"route_short_name": "line_id"})
+    stops["line_id"] = stops["line_id"].astype(int)
+    return stops
+
+
+NORMALIZERS = {"segments": normalize_segments, "stops": normalize_stops}
+
+
+class NetworkStore:
+    """
+    The network versions on disk, listed in data/network/versions.json as
+    {"version", "valid_from", "segments", "stops"} records (the two content hashes).
+    """
+
+    def __init__(self, directory=NETWORK_DIR):
+        self.directory = directory
+        self.manifest_path = os.path.join(directory, "versions.json")
+        self.versions = []
+        if os.path.isfile(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.versions = json.load(f)
+
+    def _save_manifest(self):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.versions, f, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+    def version_at(self, timestamp):
+        """The version in effect at `timestamp`, or None if it precedes every version."""
+        timestamp = timestamp.strftime(TIMESTAMP_FORMAT)
+        valid = [version for version in self.versions if version["valid_from"] <= timestamp]
+        return valid[-1] if valid else None
+
+    def add(self, timestamp, segments, stops):
+        """
+        Store the network fetched at `timestamp` unless it equals the version in effect then.
+
+        Parameters:
+        segments, stops (dict): Raw feature collections of the API.
+
+        Returns:
+        tuple: (version record, True if it was added)
+        """
+        hashes = {"segments": content_hash(segments), "stops": content_hash(stops)}
+        current = self.version_at(timestamp)
+        if current is not None and all(current[kind] == hashes[kind] for kind in KINDS):
+            return current, False
+
+        version = {
+            "version": f"{timestamp.strftime('%Y%m%d%H%M%S')}_{hashes['segments'][:8]}{hashes['stops'][:8]}",
+            "valid_from": timestamp.strftime(TIMESTAMP_FORMAT),
+        }
+        version.update(hashes)
+        path = os.path.join(self.directory, version["version"])
+        os.makedirs(path, exist_ok=True)
+        for kind, feature_collection in (("segments", segments), ("stops", stops)):
+            NORMALIZERS[kind](feature_collection).to_parquet(os.path.join(path, f"{kind}.parquet"))
+        self.versions = sorted(
+            [v for v in self.versions if v["valid_from"] != version["valid_from"]] + [version],
+            key=lambda v: v["valid_from"],
+        )
+        self._save_manifest()
+        return version, True
+
+    def _load(self, kind, timestamp):
+        import geopandas as gpd
+
+        version = self.version_at(timestamp)
+        if version is None:
+            raise KeyError(f"No network version in {self.directory} is valid at {timestamp}")
+        return gpd.read_parquet(os.path.join(self.directory, version["version"], f"{kind}.parquet"))
+
+    def load_segments(self, timestamp):
+        """Segments valid at `timestamp`: lon/lat geometries and 'segment_length' in meters (EPSG:3812)."""
+        return self._load("segments", timestamp)
+
+    def load_stops(self, timestamp):
+        """Stops valid at `timestamp`, in the layout of preprocessed_data/Stops.geojson."""
+        return self._load("stops", timestamp)
+
+
+def update(timestamp, token=None, url=URL, directory=NETWORK_DIR):
+    """Fetch the network valid at `timestamp` and store it if it changed."""
+    store = NetworkStore(directory)
+    segments = fetch("segments", timestamp, token, url)
+    stops = fetch("stops", timestamp, token, url)
+    return store.add(timestamp, segments, stops)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fetch the STIB network valid at a timestamp into the versioned store.")
+    parser.add_argument("timestamp", help='e.g. "2024-05-23 09:00:00"')
+    parser.add_argument("--base-url", help=f"defaults to $MOBILITY_TWIN_BASE_URL or {BASE_URL}")
+    parser.add_argument("--url", help="the STIB endpoints, overrides --base-url")
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    version, added = update(
+        datetime.strptime(args.timestamp, TIMESTAMP_FORMAT),
+        token=os.environ["MOBILITY_TWIN_TOKEN"],
+        url=args.url or (args.base_url or os.environ.get("MOBILITY_TWIN_BASE_URL", BASE_URL)) + "/stib",
+    )
+    print(("new version" if added else "unchanged, version"), version["version"], "valid from", version["valid_from"])
+
+
+if __name__ == "__main__":
+    main()
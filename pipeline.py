@@ -0,0 +1,51 @@
+"""
+Entry point of every stage of the pipeline:
+
+    python -m pipeline <stage> [arguments of the stage]
+    python -m pipeline compute --help
+
+The module of a stage is only imported when that stage runs, so every command
+starts without loading the dependencies of the others.
+"""
+import importlib
+import sys
+
+# stage -> (module with a `main(argv)`, description)
+STAGES = {
+    "collect": ("stib.async_collector", "collect STIB vehicle positions at a fixed cadence"),
+    "collect-sync": ("stib.collect_stib_data", "collect STIB vehicle positions, one request at a time"),
+    "compute": ("stib.calculate_stib_speed", "compute the STIB speed per segment and 10-minute interval"),
+    "stream": ("stib.stream_speeds", "compute STIB speeds while a snapshot log is being written"),
+    "gm-collect": ("google_maps.async_collector", "collect Google Maps leg speeds, all routes of a slot in parallel"),
+    "gm-collect-sync": ("google_maps.get_gm_data", "collect Google Maps leg speeds, one request at a time"),
+    "mt-speeds": ("mobility_twin.get_agg_speed_data", "download Mobility Twin aggregated speeds"),
+    "backfill": ("mobility_twin.backfill", "backfill Mobility Twin aggregated speeds, resumable and concurrent"),
+    "network": ("mobility_twin.static_network", "store the network valid at a timestamp if it changed"),
+    "static": ("mobility_twin.get_static_data", "download the segments or stops valid at a timestamp"),
+    "load": ("load_dw", "create and load the warehouse"),
+    "query": ("warehouse", "average speed per line and hour of the day, per source, from the warehouse"),
+    "cube": ("speed_cube", "build the segment x time x source speed cube, or compare its sources"),
+}
+
+
+def usage():
+    rows = ["usage: python -m pipeline <stage> [arguments]", "", "stages:"]
+    rows += [f"  {stage:16} {description}" for stage, (_, description) in STAGES.items()]
+    return "\n".join(rows)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] in ("-h", "--help"):
+        print(usage())
+        return
+    if argv[0] not in STAGES:
+        sys.exit(f"unknown stage {argv[0]!r}\n\n{usage()}")
+    module, _ = STAGES[argv[0]]
+    # usage messages of the stage read "pipeline <stage>"
+    sys.argv[0] = f"pipeline {argv[0]}"
+    return importlib.import_module(module).main(argv[1:])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,325 @@
+"""
+Dense cube of the speeds of every source on a shared segment index and the
+10-minute time grid of the warehouse, for comparing the sources.
+
+The cube is a float32 array of shape (segments, buckets, sources) stored as
+data/cube/speeds_<generation>.npy and opened memory-mapped, so months of data
+open instantly and only the slices a computation touches are read. A missing
+speed is NaN. Its rows are listed in segments_<generation>.csv, the lines and
+directions of each segment in segment_lines_<generation>.csv, and the
+generation, the first time_id and the sources in meta.json. Growing the cube
+writes a new generation and then switches meta.json to it, so a crash leaves
+the previous one intact.
+
+    python -m speed_cube build --dates 2024-08-27 2024-08-28
+    python -m speed_cube errors --source GM --reference STIB --by line
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from facts import BUCKETS_PER_HOUR, EPOCH, TIME_FREQ, load_segment_legs, stored_facts
+
+CUBE_DIR = "data/cube"
+SOURCES = ("STIB", "MT", "GM")
+
+# bump when the layout of the files changes
+CUBE_VERSION = 2
+
+GROUPINGS = ("segment", "line", "hour")
+
+
+def segment_table(path="data/segments.geojson"):
+    """
+    The shared segment index and the lines of every segment, from the segments file.
+
+    Returns:
+    pd.DataFrame: 'start_stop_id', 'end_stop_id', one row per segment, sorted.
+    pd.DataFrame: 'start_stop_id', 'end_stop_id', 'line_id', 'direction'.
+    """
+    legs = load_segment_legs(path).rename(columns={"start": "start_stop_id", "end": "end_stop_id"})
+    segment_lines = legs[["start_stop_id", "end_stop_id", "line_id", "direction"]].drop_duplicates()
+    segments = (
+        segment_lines[["start_stop_id", "end_stop_id"]]
+        .drop_duplicates()
+        .sort_values(["start_stop_id", "end_stop_id"])
+        .reset_index(drop=True)
+    )
+    return segments, segment_lines.reset_index(drop=True)
+
+
+class SpeedCube:
+    """
+    A cube on disk, opened memory-mapped (read-only by default).
+
+    Attributes:
+    speeds (np.memmap): (segments, buckets, sources) float32, NaN where a source has no speed.
+    segments (pd.DataFrame): 'start_stop_id', 'end_stop_id' of every row.
+    segment_lines (pd.DataFrame): 'start_stop_id', 'end_stop_id', 'line_id', 'direction'.
+    first_time_id (int): time_id of the first bucket.
+    sources (tuple): Source of every index of the last axis.
+    generation (int): Suffix of the files of the current cube, see `_grow`.
+    """
+
+    def __init__(self, directory=CUBE_DIR, mode="r"):
+        self.directory = directory
+        with open(os.path.join(directory, "meta.json")) as f:
+            meta = json.load(f)
+        if meta["version"] != CUBE_VERSION:
+            raise ValueError(f"{directory} holds a cube of version {meta['version']}, expected {CUBE_VERSION}")
+        self.generation = meta["generation"]
+        self.first_time_id = meta["first_time_id"]
+        self.sources = tuple(meta["sources"])
+        self.segments = pd.read_csv(_path(directory, "segments", self.generation))
+        self.segment_lines = pd.read_csv(_path(directory, "segment_lines", self.generation))
+        self.speeds = np.load(_path(directory, "speeds", self.generation), mmap_mode=mode)
+
+    @classmethod
+    def create(cls, directory, segments, segment_lines, first_time_id, num_buckets, sources=SOURCES):
+        """Write an empty (all NaN) cube and open it for writing."""
+        os.makedirs(directory, exist_ok=True)
+        speeds = np.lib.format.open_memmap(
+            _path(directory, "speeds", 0),
+            mode="w+",
+            dtype=np.float32,
+            shape=(len(segments), num_buckets, len(sources)),
+        )
+        speeds[:] = np.nan
+        speeds.flush()
+        del speeds
+        segments[["start_stop_id", "end_stop_id"]].to_csv(_path(directory, "segments", 0), index=False)
+        segment_lines.to_csv(_path(directory, "segment_lines", 0), index=False)
+        _write_meta(directory, 0, first_time_id, sources)
+        return cls(directory, mode="r+")
+
+    @classmethod
+    def from_facts(cls, directory, facts, segments_path="data/segments.geojson", sources=SOURCES):
+        """
+        Build a cube from a fact table (`facts.build_fact_table` or `facts.stored_facts`),
+        over the time range of the facts and the segments of `segments_path`.
+        """
+        if facts.empty:
+            raise ValueError("no facts to build the cube from")
+        segments, segment_lines = segment_table(segments_path)
+        ids = facts["time_id"].to_numpy()
+        first, last = int(ids.min()), int(ids.max())
+        cube = cls.create(directory, segments, segment_lines, first, last - first + 1, sources)
+        cube.add(facts, segment_lines)
+        return cube
+
+    @property
+    def num_buckets(self):
+        return self.speeds.shape[1]
+
+    def datetimes(self):
+        """The start of every bucket."""
+        return EPOCH + (self.first_time_id + pd.RangeIndex(self.num_buckets)) * TIME_FREQ
+
+    def source(self, name):
+        """The (segments, buckets) speeds of one source."""
+        return self.speeds[:, :, self.sources.index(name)]
+
+    def mask(self, name):
+        """Where `name` has a speed."""
+        return ~np.isnan(self.source(name))
+
+    def add(self, facts, segment_lines=None):
+        """
+        Write the avg_speed of facts into the cube, growing it when they fall
+        outside its time range or on segments it does not have.
+
+        Facts of sources the cube does not hold are ignored.
+
+        Parameters:
+        segment_lines (pd.DataFrame): The lines of the segments (see `segment_table`),
+            those of the new segments are added to `segment_lines`.
+        """
+        facts = facts[facts["source"].isin(self.sources)]
+        if facts.empty:
+            return
+        keys = ["start_stop_id", "end_stop_id"]
+        new_segments = (
+            facts[keys].drop_duplicates().merge(self.segments, on=keys, how="left", indicator=True)
+        )
+        new_segments = new_segments[new_segments["_merge"] == "left_only"][keys]
+        ids = facts["time_id"].to_numpy()
+        first = min(self.first_time_id, int(ids.min()))
+        last = max(self.first_time_id + self.num_buckets - 1, int(ids.max()))
+        if len(new_segments) or first != self.first_time_id or last - first + 1 != self.num_buckets:
+            if segment_lines is not None:
+                segment_lines = segment_lines.merge(new_segments, on=keys)
+            self._grow(new_segments.sort_values(keys), segment_lines, first, last - first + 1)
+
+        rows = self.segments.reset_index().merge(facts[keys], on=keys, how="right")["index"].to_numpy()
+        columns = ids - self.first_time_id
+        sources = pd.Index(self.sources).get_indexer(facts["source"])
+        self.speeds[rows, columns, sources] = facts["avg_speed"].to_numpy(dtype=np.float32)
+        self.speeds.flush()
+
+    def _grow(self, new_segments, new_segment_lines, first_time_id, num_buckets, rows_per_copy=256):
+        # copy the cube into a new generation: new segments are appended, so existing rows keep their index
+        generation = self.generation + 1
+        speeds = np.lib.format.open_memmap(
+            _path(self.directory, "speeds", generation),
+            mode="w+",
+            dtype=np.float32,
+            shape=(len(self.segments) + len(new_segments), num_buckets, len(self.sources)),
+        )
+        speeds[:] = np.nan
+        offset = self.first_time_id - first_time_id
+        for start in range(0, len(self.segments), rows_per_copy):
+            rows = slice(start, min(start + rows_per_copy, len(self.segments)))
+            speeds[rows, offset : offset + self.num_buckets] = self.speeds[rows]
+        speeds.flush()
+        del speeds
+        segments = pd.concat([self.segments, new_segments], ignore_index=True)
+        segments.to_csv(_path(self.directory, "segments", generation), index=False)
+        segment_lines = self.segment_lines
+        if new_segment_lines is not None:
+            segment_lines = pd.concat([segment_lines, new_segment_lines[segment_lines.columns]], ignore_index=True)
+        segment_lines.to_csv(_path(self.directory, "segment_lines", generation), index=False)
+
+        # the cube is switched to the new generation at once
+        _write_meta(self.directory, generation, first_time_id, self.sources)
+        self.speeds = None
+        for name in ("speeds", "segments", "segment_lines"):
+            os.remove(_path(self.directory, name, self.generation))
+        self.generation, self.first_time_id = generation, first_time_id
+        self.segments, self.segment_lines = segments, segment_lines
+        self.speeds = np.load(_path(self.directory, "speeds", generation), mmap_mode="r+")
+
+    def errors(self, source, reference="STIB", by="segment", block=1024):
+        """
+        Error of `source` against `reference` where both have a speed.
+
+        The cube is reduced `block` buckets at a time, so memory stays bounded
+        however long the time range is.
+
+        Parameters:
+        by (str): "segment", "line" (a segment counts for every line it is part of)
+            or "hour" (of the day).
+
+        Returns:
+        pd.DataFrame: 'n', 'mae', 'bias' (mean of source - reference), 'rmse' and 'corr'
+            (Pearson), indexed by the grouping.
+        """
+        if by not in GROUPINGS:
+            raise ValueError(f"by must be one of {GROUPINGS}, not {by!r}")
+        x_index, y_index = self.sources.index(source), self.sources.index(reference)
+        hours = (self.first_time_id + np.arange(self.num_buckets)) // BUCKETS_PER_HOUR % 24
+
+        totals = None
+        for start in range(0, self.num_buckets, block):
+            x = np.asarray(self.speeds[:, start : start + block, x_index], dtype=np.float64)
+            y = np.asarray(self.speeds[:, start : start + block, y_index], dtype=np.float64)
+            if by == "hour":
+                # sums over the segments, then over the buckets of every hour
+                sums = _moments(x, y, axis=0)
+                sums = {
+                    name: np.bincount(hours[start : start + block], weights=values, minlength=24)
+                    for name, values in sums.items()
+                }
+            else:
+                sums = _moments(x, y, axis=1)
+            totals = sums if totals is None else {name: totals[name] + sums[name] for name in totals}
+
+        if by == "hour":
+            index = pd.Index(np.arange(24), name="hour")
+        elif by == "segment":
+            index = pd.MultiIndex.from_frame(self.segments)
+        else:
+            lines = self.segment_lines[["start_stop_id", "end_stop_id", "line_id"]].drop_duplicates()
+            rows = self.segments.reset_index().merge(lines, on=["start_stop_id", "end_stop_id"])
+            line_ids, groups = np.unique(rows["line_id"].to_numpy(), return_inverse=True)
+            totals = {
+                name: np.bincount(groups, weights=values[rows["index"].to_numpy()], minlength=len(line_ids))
+                for name, values in totals.items()
+            }
+            index = pd.Index(line_ids, name="line_id")
+        return pd.DataFrame(_statistics(totals), index=index)
+
+
+def _path(directory, name, generation):
+    extension = "npy" if name == "speeds" else "csv"
+    return os.path.join(directory, f"{name}_{generation}.{extension}")
+
+
+def _write_meta(directory, generation, first_time_id, sources):
+    meta = {
+        "version": CUBE_VERSION,
+        "generation": generation,
+        "first_time_id": int(first_time_id),
+        "sources": list(sources),
+    }
+    tmp_path = os.path.join(directory, "meta.json.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(meta, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, os.path.join(directory, "meta.json"))
+
+
+def _moments(x, y, axis):
+    # the sums the statistics are computed from, over the cells where both x and y are known
+    both = ~(np.isnan(x) | np.isnan(y))
+    x = np.where(both, x, 0.0)
+    y = np.where(both, y, 0.0)
+    difference = x - y
+    return {
+        "n": both.sum(axis=axis).astype(np.float64),
+        "x": x.sum(axis=axis),
+        "y": y.sum(axis=axis),
+        "xx": np.square(x).sum(axis=axis),
+        "yy": np.square(y).sum(axis=axis),
+        "xy": (x * y).sum(axis=axis),
+        "abs": np.abs(difference).sum(axis=axis),
+        "squares": np.square(difference).sum(axis=axis),
+    }
+
+
+def _statistics(sums):
+    n = sums["n"]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        covariance = n * sums["xy"] - sums["x"] * sums["y"]
+        variances = (n * sums["xx"] - sums["x"] ** 2) * (n * sums["yy"] - sums["y"] ** 2)
+        return {
+            "n": n.astype(np.int64),
+            "mae": sums["abs"] / n,
+            "bias": (sums["x"] - sums["y"]) / n,
+            "rmse": np.sqrt(sums["squares"] / n),
+            "corr": covariance / np.sqrt(variances),
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build the speed cube and compare its sources.")
+    parser.add_argument("--directory", default=CUBE_DIR)
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build", help="build the cube from the Parquet store, or add days to it")
+    build.add_argument("--dates", nargs="*", default=None, help="days (YYYY-MM-DD), all by default")
+    build.add_argument("--segments", default="data/segments.geojson")
+    errors = commands.add_parser("errors", help="error of a source against a reference")
+    errors.add_argument("--source", default="GM", choices=SOURCES)
+    errors.add_argument("--reference", default="STIB", choices=SOURCES)
+    errors.add_argument("--by", default="line", choices=GROUPINGS)
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        facts = stored_facts(args.dates, args.segments)
+        if os.path.isfile(os.path.join(args.directory, "meta.json")):
+            cube = SpeedCube(args.directory, mode="r+")
+            cube.add(facts, segment_table(args.segments)[1])
+        else:
+            cube = SpeedCube.from_facts(args.directory, facts, args.segments)
+        start, end = cube.datetimes()[[0, -1]]
+        print(f"{len(cube.segments)} segments x {cube.num_buckets} buckets ({start} to {end}) x {len(cube.sources)} sources")
+    else:
+        cube = SpeedCube(args.directory)
+        print(cube.errors(args.source, args.reference, args.by).dropna(how="all").to_string())
+
+
+if __name__ == "__main__":
+    main()
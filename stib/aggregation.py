@@ -0,0 +1,190 @@
+import heapq
+import math
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from stib.metrics import Metrics
+from stib.speed_engine import MAX_GAP_SECONDS, _interval_speeds
+
+AGGREGATE_COLUMNS = ["start", "end", "datetime", "mean", "median"]
+
+
+class SpeedAggregator:
+    """
+    Running mean and median speed per (start, end, 10-minute bucket).
+
+    Each bucket keeps its speeds, for an exact median and a correctly rounded
+    mean (`math.fsum`); aggregators of disjoint inputs (e.g. one per worker)
+    can be merged, and the result does not depend on how the rows were split.
+    The mean can differ from a pandas groupby mean in the last bit.
+    Buckets are emitted with `pop_closed` once their window has passed, so
+    memory is bounded by the buckets that are still open.
+    """
+
+    def __init__(self, freq="10min"):
+        self.freq = pd.Timedelta(freq)
+        self.buckets = {}
+        # buckets before this time were emitted, rows arriving for them are dropped
+        self.closed_until = None
+        self.late_rows = 0
+
+    def add(self, df):
+        """Fold speed rows (the output of `compute_interval_speeds`) into their buckets."""
+        if df.empty:
+            return
+        buckets = pd.to_datetime(df["timestamp"]).dt.floor(self.freq)
+        if self.closed_until is not None:
+            late = (buckets < self.closed_until).to_numpy()
+            self.late_rows += int(late.sum())
+            df, buckets = df[~late], buckets[~late]
+        keys = pd.DataFrame(
+            {
+                "start": df["pointId_df1"].astype(int).to_numpy(),
+                "end": df["end_df1"].astype(int).to_numpy(),
+                "datetime": buckets.to_numpy(),
+            }
+        )
+        speeds = df["speed"].astype(float).to_numpy()
+        for key, rows in keys.groupby(["start", "end", "datetime"], sort=False).indices.items():
+            self.buckets.setdefault(key, []).append(speeds[rows])
+
+    def merge(self, other):
+        """Fold the buckets of another aggregator into this one."""
+        for key, speeds in other.buckets.items():
+            self.buckets.setdefault(key, []).extend(speeds)
+        self.late_rows += other.late_rows
+        return self
+
+    def _to_frame(self, keys):
+        rows = []
+        for key in sorted(keys, key=lambda key: (key[2], key[0], key[1])):
+            speeds = np.concatenate(self.buckets.pop(key))
+            rows.append((*key, math.fsum(speeds) / len(speeds), np.median(speeds)))
+        df = pd.DataFrame(rows, columns=AGGREGATE_COLUMNS)
+        df["datetime"] = pd.to_datetime(df["datetime"])
+        return df
+
+    def pop_closed(self, watermark):
+        """
+        Emit and forget the buckets whose window ended at or before `watermark`.
+
+        Returns:
+        pd.DataFrame: AGGREGATE_COLUMNS, sorted by datetime, start and end.
+        """
+        watermark = pd.Timestamp(watermark)
+        closed_until = (watermark - self.freq).floor(self.freq) + self.freq
+        if self.closed_until is None or closed_until > self.closed_until:
+            self.closed_until = closed_until
+        return self._to_frame([key for key in self.buckets if key[2] < self.closed_until])
+
+    def pop_all(self):
+        """Emit and forget every bucket, closed or not."""
+        return self._to_frame(list(self.buckets))
+
+
+def _watermark(window_end, lines, max_gap):
+    # a pending pair is a gap unless its first snapshot was observed less than max_gap before the window end
+    watermark = window_end - timedelta(seconds=max_gap)
+    for instances in lines.values():
+        last = instances[-1]
+        if datetime.fromisoformat(last.get("response_timestamp", last["timestamp"])) > watermark:
+            watermark = min(watermark, datetime.strptime(last["timestamp"], "%Y-%m-%d %H:%M:%S"))
+    return watermark
+
+
+def iter_time_ordered(vehicle_positions):
+    """
+    Stream (line_id, snapshot) tuples in timestamp order.
+
+    A snapshot log is already in poll order and is passed through; a legacy
+    line_id -> list of snapshots dict is merged across lines.
+    """
+    if not isinstance(vehicle_positions, dict):
+        return iter(vehicle_positions)
+    return heapq.merge(
+        *([(line, instance) for instance in instances] for line, instances in vehicle_positions.items()),
+        key=lambda item: item[1]["timestamp"],
+    )
+
+
+def iter_time_windows(vehicle_positions, window=timedelta(minutes=10)):
+    """
+    Group a time-ordered snapshot stream into windows of `window`.
+
+    The last snapshot of every line is repeated at the start of the next
+    window, so the pair spanning the boundary is computed in the later window.
+
+    Yields:
+    tuple: (end of the window, line_id -> list of snapshots)
+    """
+    window_end = None
+    lines = {}
+    for line, instance in vehicle_positions:
+        if instance["vehicle_positions"] is None:
+            continue
+        timestamp = datetime.strptime(instance["timestamp"], "%Y-%m-%d %H:%M:%S")
+        if window_end is None:
+            window_end = timestamp - (timestamp - datetime.min) % window + window
+        while timestamp >= window_end:
+            if any(len(instances) > 1 for instances in lines.values()):
+                yield window_end, lines
+            lines = {line_id: instances[-1:] for line_id, instances in lines.items()}
+            window_end += window
+        lines.setdefault(line, []).append(instance)
+    if any(len(instances) > 1 for instances in lines.values()):
+        yield window_end, lines
+
+
+def aggregate_in_time_windows(
+    vehicle_positions,
+    network,
+    window=timedelta(minutes=10),
+    apply_filter=True,
+    gap_policy="drop",
+    max_gap=MAX_GAP_SECONDS,
+    freq="10min",
+    segment_index=None,
+    metrics=None,
+    stats=None,
+):
+    """
+    Compute speeds window by window and emit each 10-minute bucket as soon as it is closed.
+
+    After a window is processed, the only pairs still missing are those starting
+    at the last snapshot of a line. Their second snapshot is observed after the
+    end of the window, so any of them observed more than `max_gap` before it is
+    a gap; buckets ending before that point and before the other pending
+    snapshots are therefore final (with gap_policy="keep", rows of late gap
+    pairs are counted in `SpeedAggregator.late_rows` and dropped).
+
+    Parameters:
+    stats (dict): Optional, filled in as the windows are processed with "rows_removed",
+        "rows_per_instance", "perc_removed" (the rows removed due to deviations, as
+        reported by `compute_interval_speeds`) and "late_rows".
+
+    Yields:
+    pd.DataFrame: Closed buckets, AGGREGATE_COLUMNS.
+    """
+    metrics = metrics if metrics is not None else Metrics(enabled=False)
+    stats = stats if stats is not None else {}
+    stats.update(rows_removed=0, rows_per_instance=0, perc_removed=0.0, late_rows=0)
+    aggregator = SpeedAggregator(freq)
+    for window_end, lines in iter_time_windows(iter_time_ordered(vehicle_positions), window):
+        df, rows_removed, rows_per_instance = _interval_speeds(
+            lines, network, apply_filter, gap_policy, max_gap, segment_index, metrics
+        )
+        stats["rows_removed"] += rows_removed
+        stats["rows_per_instance"] += rows_per_instance
+        stats["perc_removed"] = stats["rows_removed"] / max(stats["rows_per_instance"], 1) * 100
+        with metrics.stage("aggregate", rows_in=len(df)) as stage:
+            aggregator.add(df)
+            stage["rows_out"] = len(aggregator.buckets)
+        stats["late_rows"] = aggregator.late_rows
+        closed = aggregator.pop_closed(_watermark(window_end, lines, max_gap))
+        if not closed.empty:
+            yield closed
+    closed = aggregator.pop_all()
+    if not closed.empty:
+        yield closed
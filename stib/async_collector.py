@@ -0,0 +1,257 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+from datetime import datetime, timedelta
+
+import aiohttp
+from dotenv import load_dotenv
+
+from stib.metrics import Metrics, export, profiled
+from stib.positions import decode_vehiclepositions
+from stib.scheduler import MAX_GAP_SECONDS, PROFILE_PATH, PollScheduler
+from stib.snapshot_log import SnapshotLog
+
+BASE_URL = "https://stibmivb.opendatasoft.com"
+RECORDS_PATH = "/api/explore/v2.1/catalog/datasets/vehicle-position-rt-production/records"
+URL = BASE_URL + RECORDS_PATH
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+PRECISE_TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+def chunk_lines(bus_lines, size=10):
+    # the API returns 10 records per request by default, one record per line
+    return [bus_lines[i : i + size] for i in range(0, len(bus_lines), size)]
+
+
+async def fetch_chunk(session, semaphore, url, lines, metrics=None, max_retries=2, backoff=0.5):
+    """
+    Request the vehicle positions of a chunk of lines, recording its latency in `metrics`.
+
+    429 and 5xx responses, connection errors and bodies that are not JSON (e.g. the
+    HTML error page of a proxy) are retried `max_retries` times, after `backoff` * 2^attempt
+    seconds; the retries of a chunk have to fit in its tick.
+
+    Returns:
+    tuple: (request start, response time, list of records with 'vehiclepositions' decoded
+        to POSITION_DTYPE arrays, see stib.positions)
+    """
+    params = {
+        "timezone": "Europe/Brussels",
+        "where": f"lineid in {str(tuple(lines))}",
+    }
+    for attempt in range(max_retries + 1):
+        try:
+            async with semaphore:
+                request_timestamp = datetime.now()
+                async with session.get(url, params=params) as response:
+                    # the status first: error pages are not always JSON
+                    if response.status != 200:
+                        body = await response.text()
+                        if response.status in RETRY_STATUSES:
+                            raise aiohttp.ClientResponseError(
+                                response.request_info, response.history, status=response.status
+                            )
+                        raise Exception(f"Error: {response.status} {body[:200]}")
+                    data = await response.json(content_type=None)
+                    response_timestamp = datetime.now()
+                    if metrics is not None:
+                        metrics.observe("api", (response_timestamp - request_timestamp).total_seconds())
+            break
+        except (aiohttp.ClientError, asyncio.TimeoutError, json.JSONDecodeError):
+            if attempt == max_retries:
+                raise
+            await asyncio.sleep(backoff * 2**attempt)
+    results = data["results"]
+    for entry in results:
+        entry["vehiclepositions"] = decode_vehiclepositions(entry["vehiclepositions"])
+    return request_timestamp, response_timestamp, results
+
+
+async def poll(session, semaphore, url, chunks, snapshot_log, dt_tick, metrics=None, scheduler=None, tick=None):
+    """
+    Fire the requests of every chunk concurrently and log the snapshots of one tick.
+
+    With a `scheduler`, the snapshot of every line requested is passed to its `observe`,
+    `tick` being the index of the tick; lines of failed requests stay due.
+    """
+    responses = await asyncio.gather(
+        *(fetch_chunk(session, semaphore, url, lines, metrics) for lines in chunks),
+        return_exceptions=True,
+    )
+    timestamp = dt_tick.strftime(TIMESTAMP_FORMAT)
+    errors = []
+    for lines, response in zip(chunks, responses):
+        if isinstance(response, Exception):
+            errors.append(response)
+            continue
+        request_timestamp, response_timestamp, results = response
+        if scheduler is not None:
+            # a line without a record has no vehicles
+            observed = {str(line["lineid"]): line["vehiclepositions"] for line in results}
+            for line_id in lines:
+                scheduler.observe(line_id, observed.get(line_id), tick, dt_tick.hour)
+        for line in results:
+            if metrics is not None and line["vehiclepositions"] is not None:
+                metrics.count("vehicle_positions", len(line["vehiclepositions"]))
+            snapshot_log.append(
+                line["lineid"],
+                timestamp,
+                line["vehiclepositions"],
+                request_timestamp=request_timestamp.strftime(PRECISE_TIMESTAMP_FORMAT),
+                response_timestamp=response_timestamp.strftime(PRECISE_TIMESTAMP_FORMAT),
+            )
+    snapshot_log.flush()
+    return errors
+
+
+def next_tick(now, interval):
+    # ticks are aligned on multiples of the interval since the epoch
+    return (now // interval + 1) * interval
+
+
+async def collect_data_until_async(
+    dt_until,
+    bus_lines,
+    log_path,
+    url=URL,
+    api_key=None,
+    interval=13,
+    max_concurrency=5,
+    timeout=10,
+    metrics=None,
+    metrics_path=None,
+    scheduler=None,
+):
+    """
+    Poll all lines at a fixed wall-clock cadence until `dt_until`.
+
+    Each poll starts on a tick (a multiple of `interval` seconds since the epoch)
+    regardless of how long the previous poll took; ticks missed because a poll
+    overran are skipped rather than queued. With a `scheduler`, a tick polls only
+    the lines it says are due, batched as it says.
+
+    Parameters:
+    dt_until (datetime): When to stop collecting.
+    bus_lines (list): Line ids to collect.
+    log_path (str): Snapshot log to append to.
+    url (str): The vehicle-position records endpoint, e.g. of a local replay server (benchmarks.replay_server).
+    api_key (str): STIB API key, if the endpoint requires one.
+    interval (float): Seconds between two ticks.
+    max_concurrency (int): Maximum number of requests in flight.
+    timeout (int): Timeout of a single request, in seconds.
+    metrics (Metrics): Optional; records the poll durations, the request latencies and the stats.
+    metrics_path (str): Export `metrics` there after every poll (see `metrics.export`).
+    scheduler (PollScheduler): Optional; adapts the period of every line (see stib.scheduler).
+
+    Returns:
+    dict: Number of polls, skipped ticks, requests and failed requests.
+    """
+    metrics = metrics if metrics is not None else Metrics(enabled=metrics_path is not None)
+    headers = {"Authorization": f"Apikey {api_key}"} if api_key else {}
+    chunks = chunk_lines(bus_lines)
+    snapshot_log = SnapshotLog(log_path)
+    semaphore = asyncio.Semaphore(max_concurrency)
+    connector = aiohttp.TCPConnector(limit=max_concurrency)
+    stats = {"polls": 0, "skipped_ticks": 0, "requests": 0, "failed_requests": 0}
+
+    async with aiohttp.ClientSession(
+        headers=headers, connector=connector, timeout=aiohttp.ClientTimeout(total=timeout)
+    ) as session:
+        tick = next_tick(time.time(), interval)
+        while datetime.fromtimestamp(tick) < dt_until:
+            await asyncio.sleep(max(0, tick - time.time()))
+            tick_index = round(tick / interval)
+            if scheduler is not None:
+                chunks = scheduler.batches(tick_index)
+            with metrics.stage("poll", rows_in=len(chunks)) as stage:
+                errors = await poll(
+                    session,
+                    semaphore,
+                    url,
+                    chunks,
+                    snapshot_log,
+                    datetime.fromtimestamp(tick),
+                    metrics,
+                    scheduler,
+                    tick_index,
+                )
+                stage["rows_out"] = len(chunks) - len(errors)
+            stats["polls"] += 1
+            stats["requests"] += len(chunks)
+            stats["failed_requests"] += len(errors)
+            for error in errors:
+                print(f"An error occurred: {error}")
+
+            following = next_tick(time.time(), interval)
+            # rounded, as float ticks are not exact multiples of the interval
+            stats["skipped_ticks"] += round((following - tick) / interval) - 1
+            tick = following
+            if metrics.enabled:
+                metrics.counters.update(stats)
+            if metrics_path is not None:
+                export(metrics, metrics_path)
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Collect STIB vehicle positions at a fixed cadence.")
+    parser.add_argument("--hours", type=float, default=8)
+    parser.add_argument("--interval", type=float, default=13)
+    parser.add_argument("--max-concurrency", type=int, default=5)
+    parser.add_argument("--base-url", help=f"defaults to $STIB_BASE_URL or {BASE_URL}")
+    parser.add_argument("--url", help="the full records endpoint, overrides --base-url")
+    parser.add_argument("--adaptive", action="store_true", help="poll every line at its own rate, see stib.scheduler")
+    parser.add_argument("--max-idle-period", type=int, default=16, help="ticks between two polls of a line without vehicles")
+    parser.add_argument("--max-gap", type=float, default=MAX_GAP_SECONDS, help="seconds between two polls of a line with vehicles, at most")
+    parser.add_argument("--schedule-profile", default=PROFILE_PATH, help="activity per line and hour, kept across runs")
+    parser.add_argument("--metrics", help="export metrics after every poll, to a .prom file or a JSON lines file")
+    parser.add_argument("--profile", help="write cProfile stats of the run to this file")
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    with open("data/bus_lines.txt") as f:
+        bus_lines = list(dict.fromkeys(f.read().splitlines()))
+
+    dt_now = datetime.now()
+    log_path = f"data/vehicle_positions_{dt_now.strftime('%Y-%m-%d_%H:%M:%S')}.ndjson.gz"
+    scheduler = None
+    if args.adaptive:
+        scheduler = PollScheduler(
+            bus_lines,
+            interval=args.interval,
+            max_idle_period=args.max_idle_period,
+            max_gap=args.max_gap,
+            profile=PollScheduler.load_profile(args.schedule_profile),
+        )
+    try:
+        with profiled(args.profile):
+            stats = asyncio.run(
+                collect_data_until_async(
+                    dt_now + timedelta(hours=args.hours),
+                    bus_lines,
+                    log_path,
+                    url=args.url or (args.base_url or os.environ.get("STIB_BASE_URL", BASE_URL)) + RECORDS_PATH,
+                    api_key=os.environ.get("STIB_API_KEY"),
+                    interval=args.interval,
+                    max_concurrency=args.max_concurrency,
+                    metrics_path=args.metrics,
+                    scheduler=scheduler,
+                )
+            )
+    finally:
+        # what was learned of the hours collected, even if interrupted
+        if scheduler is not None:
+            scheduler.save_profile(args.schedule_profile)
+
+    # pandas and pyarrow are only loaded once the collection is over
+    import storage
+
+    storage.log_to_parquet(log_path)
+    print(stats)
+
+
+if __name__ == "__main__":
+    main()
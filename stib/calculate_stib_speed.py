@@ -1,53 +1,48 @@
-import json
-import geopandas as gpd
+import argparse
+import os
 import pandas as pd
 from datetime import datetime, timedelta
-from shapely.geometry import LineString
 
-from tqdm.auto import tqdm, trange
+import storage
+from stib.aggregation import AGGREGATE_COLUMNS, aggregate_in_time_windows
+from stib.metrics import Metrics, export, profiled
+from stib.network_index import NetworkIndex
+from stib.positions import as_positions
+from stib.segment_index import SegmentIndex
+from stib.snapshot_log import load_vehicle_positions
+from stib.speed_engine import MAX_GAP_SECONDS, compute_interval_speeds, compute_interval_speeds_parallel
 
-def assign_direction_id(group):
-    max_stop_sequence_row = group.loc[group['stop_sequence'].idxmax()]
-    group['direction_id'] = max_stop_sequence_row['stop_id']
-    return group
+STOPS_PATH = 'preprocessed_data/Stops.geojson'
+SEGMENTS_PATH = 'data/segments.geojson'
 
-stops = gpd.read_file('preprocessed_data/Stops.geojson')
-stops = stops.groupby(['line_id', 'direction']).apply(assign_direction_id)
-stops.reset_index(drop=True, inplace=True)
 
-with open("data/bus_lines.txt") as f:
-    lines = f.read().splitlines()
+def load_network(stops_path=STOPS_PATH, segments_path=SEGMENTS_PATH, recover=True, network_at=None):
+    """
+    The network index and, with `recover`, the segment index of the stops and segments files.
 
-with open("data/vehicle_positions_2024-08-27_09:02:21.json") as f:
-    vehicle_positions = json.load(f)
+    Both are built from the GeoJSON files once, then loaded from data/cache. With the
+    segment index, vehicles reported at a stop that is not on their line and direction
+    are placed by projecting that stop onto the segments instead of being removed.
 
-for line in vehicle_positions:
-    for instance in vehicle_positions[line][:]:
-        if instance['vehicle_positions'] is None:
-            vehicle_positions[line].remove(instance)
+    Parameters:
+    network_at (datetime): Optional, build both from the version of the network store
+        (mobility_twin.static_network) valid at this time instead of the files.
 
-def reverse_coordinates(geometry):
-    if geometry.geom_type == 'LineString':
-        # Reverse the coordinates of each point in the LineString
-        reversed_coords = [(y, x) for x, y in geometry.coords]
-        return LineString(reversed_coords)
-    else:
-        # Handle other geometry types if necessary
-        return geometry
+    Returns:
+    tuple: (NetworkIndex, SegmentIndex or None)
+    """
+    if network_at is not None:
+        network = NetworkIndex.from_store(network_at)
+        segment_index = SegmentIndex.from_store(network_at) if recover else None
+        return network, segment_index
+    network = NetworkIndex.from_files(stops_path, segments_path)
+    segment_index = SegmentIndex.from_files(stops_path, segments_path) if recover else None
+    return network, segment_index
 
-segments = gpd.read_file('data/segments.geojson')
-segments['geometry'] = segments['geometry'].apply(reverse_coordinates)
-segments = segments.to_crs(epsg=3812)
-segments = segments.drop(columns=['color'])
-segments['line_id'] = segments['line_id'].astype(int)
-segments['segment_length'] = segments['geometry'].length
-segments = segments.drop(columns=['id', 'distance', 'direction'])
 
 def filter_zero_distance(instance):
-    if len(instance['vehicle_positions']) == 0:
-        return instance
-    vehicle_positions = instance['vehicle_positions']
-    instance['vehicle_positions'] = [vehicle for vehicle in vehicle_positions if vehicle['distanceFromPoint'] > 0]
+    vehicle_positions = as_positions(instance['vehicle_positions'])
+    instance['vehicle_positions'] = vehicle_positions[vehicle_positions['distanceFromPoint'] > 0]
     return instance
 
 def round_to_nearest_10_minutes(dt):
@@ -116,14 +111,15 @@ def merge_with_flexible_direction(df, stops_line):
     
     return df_final
 
-def to_df(instance, line_id):
+def to_df(instance, line_id, network):
     line_id = int(line_id)
-    df = pd.DataFrame(instance["vehicle_positions"])
+    df = pd.DataFrame(as_positions(instance["vehicle_positions"]))
     df["directionId"] = df["directionId"].astype(int)
+    df["distanceFromPoint"] = df["distanceFromPoint"].astype(float)
     df["pointId"] = df["pointId"].astype(int)
     # filter by line_id
-    stops_line = stops[stops["line_id"] == line_id]
-    segments_line = segments[segments["line_id"] == line_id]
+    stops_line = network.stops_line(line_id)
+    segments_line = network.segments_line(line_id)
     # for cases like bus 71, where the directionId in data is +/-1 the direction_id in stops
     num_rows_orig = df.shape[0]
     df = merge_with_flexible_direction(df, stops_line)
@@ -183,7 +179,7 @@ def join_dataframes(df1, df2):
     return final_result
 
 
-def get_interval_pair(i, line_id):
+def get_interval_pair(vehicle_positions, i, line_id, network, gap_policy="drop", max_gap=MAX_GAP_SECONDS):
     instance1 = vehicle_positions[str(line_id)][i]
     instance1 = filter_zero_distance(instance1)
     num_rows_instance = len(instance1["vehicle_positions"])
@@ -192,8 +188,10 @@ def get_interval_pair(i, line_id):
     instance2 = filter_zero_distance(instance2)
     
     ts1 = datetime.strptime(instance1["timestamp"], "%Y-%m-%d %H:%M:%S")
-    ts2 = datetime.strptime(instance2["timestamp"], "%Y-%m-%d %H:%M:%S")
-    interval_in_seconds = (ts2 - ts1).total_seconds()
+    # prefer the response times recorded by the collector over the poll timestamps
+    observed_at1 = datetime.fromisoformat(instance1.get("response_timestamp", instance1["timestamp"]))
+    observed_at2 = datetime.fromisoformat(instance2.get("response_timestamp", instance2["timestamp"]))
+    interval_in_seconds = (observed_at2 - observed_at1).total_seconds()
 
     if (
         len(instance1["vehicle_positions"]) == 0
@@ -201,8 +199,8 @@ def get_interval_pair(i, line_id):
     ):
         return None
 
-    df1, num_rows_removed = to_df(instance1, line_id)
-    df2, _ = to_df(instance2, line_id)
+    df1, num_rows_removed = to_df(instance1, line_id, network)
+    df2, _ = to_df(instance2, line_id, network)
     df3 = join_dataframes(df1, df2)
 
     condition = df3["pointId_df1"] == df3["pointId_df2"]
@@ -214,12 +212,17 @@ def get_interval_pair(i, line_id):
         (df3["segment_length_df1"] - df3["distanceFromPoint_df1"])
         + df3["distanceFromPoint_df2"]
     )
-    # if the time interval is greater than 40 seconds, the distance traveled is 0
-    # because we missed a data point, so the time interval is unknown
-    if interval_in_seconds >= 40:
-        df3["distance_traveled"] = 0
-    df3["speed"] = df3["distance_traveled"] / 20
+    df3["interval_in_seconds"] = interval_in_seconds
+    df3["speed"] = df3["distance_traveled"] / interval_in_seconds
     df3["timestamp"] = ts1
+    # if the time interval is greater than max_gap, we missed a data point,
+    # so the bus may have been anywhere in between
+    if interval_in_seconds >= max_gap:
+        if gap_policy == "drop":
+            df3 = df3.iloc[0:0]
+        elif gap_policy == "zero":
+            df3["distance_traveled"] = 0
+            df3["speed"] = 0
 
     df3 = df3[
         [
@@ -234,6 +237,7 @@ def get_interval_pair(i, line_id):
             "segment_length_df2",
             "distance_traveled",
             "speed",
+            "interval_in_seconds",
             "timestamp"
         ]
     ]
@@ -247,43 +251,137 @@ def get_interval_pair(i, line_id):
     }
 
 
-def get_interval_pair_all_lines_all_instances(apply_filter=True):
-    total_df = None
-    total_rows_per_instance = 0
-    total_rows_removed = 0
-    for line in tqdm(vehicle_positions):
-        vehicle_positions_line = vehicle_positions[line]
-        line_id = int(line)
-        for i in trange(len(vehicle_positions_line) - 1):
-            result = get_interval_pair(i, line_id)
-            if result is None:
-                continue
-            df3 = result["df3"]
-            total_rows_per_instance += result["num_rows_instance"]
-            total_rows_removed += result["num_rows_removed"]
-            if total_df is None:
-                total_df = df3
-            else:
-                if apply_filter:
-                    df3 = df3[(df3["speed"] > 0) & (df3["speed"] < 25)]
-                total_df = pd.concat([total_df, df3])
-    return total_df, total_rows_removed / total_rows_per_instance * 100
-
-df_all_intervals, perc_removed = get_interval_pair_all_lines_all_instances(apply_filter=True)
-print("Percentage of data removed due to deviations:", perc_removed)
-
-df_all_intervals.rename(columns={
-    "pointId_df1": "start",
-    "end_df1": "end",
-}, inplace=True)
-df_all_intervals['start'] = df_all_intervals['start'].astype(int)
-df_all_intervals['end'] = df_all_intervals['end'].astype(int)
-df_all_intervals['timestamp'] = pd.to_datetime(df_all_intervals['timestamp'])
-
-# Round 'timestamp' to the nearest 10 minutes
-df_all_intervals['datetime'] = df_all_intervals['timestamp'].dt.floor('10T')
-
-# Compute the mean and median speed per segment and interval
-grouped = df_all_intervals.groupby(['start', 'end', 'datetime'])
-df_10m_intervals = grouped['speed'].agg(['mean', 'median']).reset_index()
-df_10m_intervals.to_csv('data/speeds_stib.csv', index=False)
\ No newline at end of file
+def get_interval_pair_all_lines_all_instances(
+    vehicle_positions, network, apply_filter=True, gap_policy="drop", processes=1
+):
+    # same result as calling get_interval_pair for every pair of every line,
+    # computed over one flattened table of all snapshots (per line, with several processes)
+    if processes > 1:
+        return compute_interval_speeds_parallel(
+            vehicle_positions, network, apply_filter=apply_filter, gap_policy=gap_policy, processes=processes
+        )
+    return compute_interval_speeds(
+        vehicle_positions, network, apply_filter=apply_filter, gap_policy=gap_policy
+    )
+
+def compute(
+    vehicle_positions,
+    network,
+    output_path='data/speeds_stib.csv',
+    segment_index=None,
+    processes=None,
+    metrics=None,
+):
+    """
+    Compute the mean and median speed per segment and 10-minute interval and write them out.
+
+    The buckets go to `output_path` as CSV and to the stib_speeds Parquet dataset.
+    With several processes, every worker aggregates its own lines and the partial
+    buckets are merged; otherwise buckets are computed window by window and
+    written out as they close. Either way the rows and their order are the same.
+
+    Parameters:
+    vehicle_positions (dict): line_id -> list of snapshots, see `load_vehicle_positions`.
+    network (NetworkIndex), segment_index (SegmentIndex): See `load_network`.
+    processes (int): Number of worker processes, all cores by default.
+    metrics (Metrics): Optional, see `compute_interval_speeds`.
+    """
+    processes = processes or os.cpu_count()
+    if processes > 1:
+        aggregator, perc_removed = compute_interval_speeds_parallel(
+            vehicle_positions,
+            network,
+            processes=processes,
+            aggregate=True,
+            segment_index=segment_index,
+            metrics=metrics,
+        )
+        write_speeds([aggregator.pop_all()], output_path)
+        print("Percentage of data removed due to deviations:", perc_removed)
+    else:
+        stats = {}
+        write_speeds(
+            aggregate_in_time_windows(
+                vehicle_positions, network, segment_index=segment_index, metrics=metrics, stats=stats
+            ),
+            output_path,
+        )
+        print("Percentage of data removed due to deviations:", stats["perc_removed"])
+        if stats["late_rows"]:
+            print("Rows dropped behind the watermark:", stats["late_rows"])
+
+
+def write_speeds(chunks, output_path):
+    """
+    Write time-ordered buckets to `output_path` as CSV and to the stib_speeds dataset.
+
+    The CSV is appended chunk by chunk; the dataset is written once per day,
+    when the first bucket of the next day arrives, since every write rewrites
+    the whole partition.
+
+    Parameters:
+    chunks (iterable): DataFrames of AGGREGATE_COLUMNS, each later than the previous one.
+    output_path (str): Path of the CSV file.
+    """
+    day, buffered = None, []
+    with open(output_path, 'w') as f:
+        pd.DataFrame(columns=AGGREGATE_COLUMNS).to_csv(f, index=False)
+        for chunk in chunks:
+            # a chunk of midnight buckets only would otherwise be written as bare dates
+            chunk.to_csv(f, index=False, header=False, date_format="%Y-%m-%d %H:%M:%S")
+            for date, rows in chunk.groupby(chunk["datetime"].dt.normalize(), sort=True):
+                if date != day and buffered:
+                    storage.write_stib_speeds(pd.concat(buffered, ignore_index=True))
+                    buffered = []
+                day = date
+                buffered.append(rows)
+    if buffered:
+        storage.write_stib_speeds(pd.concat(buffered, ignore_index=True))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compute the STIB speed per segment and 10-minute interval.")
+    parser.add_argument(
+        "vehicle_positions",
+        nargs="?",
+        default="data/vehicle_positions_2024-08-27_09:02:21.json",
+        help="a legacy JSON dump, a snapshot log written by the collectors or a Parquet root",
+    )
+    parser.add_argument("--output", default="data/speeds_stib.csv")
+    parser.add_argument("--stops", default=STOPS_PATH)
+    parser.add_argument("--segments", default=SEGMENTS_PATH)
+    parser.add_argument(
+        "--network-at", help='use the stored network version valid at this time, e.g. "2024-08-27 09:00:00"'
+    )
+    parser.add_argument("--processes", type=int, help="worker processes, all cores by default")
+    parser.add_argument(
+        "--no-recover", action="store_true", help="drop vehicles at stops off their line instead of map-matching them"
+    )
+    parser.add_argument("--metrics", help="export stage timings and dropped rows to a .prom file or a JSON lines file")
+    parser.add_argument("--profile", help="write cProfile stats of the run to this file")
+    args = parser.parse_args(argv)
+    metrics = Metrics(enabled=args.metrics is not None)
+
+    with profiled(args.profile):
+        network_at = datetime.strptime(args.network_at, "%Y-%m-%d %H:%M:%S") if args.network_at else None
+        network, segment_index = load_network(args.stops, args.segments, not args.no_recover, network_at)
+        with metrics.stage("load") as stage:
+            vehicle_positions = load_vehicle_positions(args.vehicle_positions)
+
+            for line in vehicle_positions:
+                vehicle_positions[line] = [
+                    instance for instance in vehicle_positions[line] if instance['vehicle_positions'] is not None
+                ]
+            stage["rows_out"] = sum(len(instances) for instances in vehicle_positions.values())
+
+        compute(vehicle_positions, network, args.output, segment_index, args.processes, metrics)
+
+    if args.metrics:
+        export(metrics, args.metrics)
+        for name, stage in metrics.stages.items():
+            print(f"{name:10} {stage['seconds']:8.2f} s  {stage['rows_in']:>10} rows in  {stage['rows_out']:>10} rows out")
+
+
+# worker processes re-import this module when they are spawned rather than forked
+if __name__ == "__main__":
+    main()
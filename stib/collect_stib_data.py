@@ -1,57 +1,66 @@
+import argparse
 import requests
 from tqdm.auto import tqdm
 from dotenv import load_dotenv
 
 import time
 import os
-import json
-from ast import literal_eval    
-from pprint import pprint
 from datetime import datetime, timedelta
-from collections import defaultdict
-from tqdm.auto import tqdm
-
-with open("../data/bus_lines.txt") as f:
-    bus_lines = f.read().splitlines()
-
-load_dotenv()
-
-api_key = os.environ['STIB_API_KEY']
-headers = {
-    "Authorization": f"Apikey {api_key}"
-}
-url = "https://stibmivb.opendatasoft.com/api/explore/v2.1/catalog/datasets/vehicle-position-rt-production/records"
-
-session = requests.Session()
-session.headers.update(headers)
-
-with open("../data/bus_lines.txt") as f:
-    bus_lines = f.read().splitlines()
-
-params = {
-    'timezone': 'Europe/Brussels',
-}
-
-def get_data(params={}):
-    response = session.get(url, params=params)
-    data = response.json()
-    if response.status_code != 200:
-        pprint(data)
-        raise Exception(f"Error: {response.status_code}")
-    else:
-        data = response.json()['results']
-        for i, entry in enumerate(data):
-            data[i]['vehiclepositions'] = literal_eval(entry['vehiclepositions'])
-        return data
-
-def collect_data_until(dt_until):
-    segments_data = defaultdict(list)
 
+from stib.positions import decode_vehiclepositions
+from stib.snapshot_log import SnapshotLog
+
+BASE_URL = "https://stibmivb.opendatasoft.com"
+RECORDS_PATH = "/api/explore/v2.1/catalog/datasets/vehicle-position-rt-production/records"
+URL = BASE_URL + RECORDS_PATH
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+def make_session(api_key):
+    session = requests.Session()
+    session.headers.update({
+        "Authorization": f"Apikey {api_key}"
+    })
+    return session
+
+def get_data(session, params={}, url=URL, max_retries=2, backoff=0.5, timeout=10):
+    """
+    Request the vehicle positions of the lines in `params`.
+
+    Retried like `async_collector.fetch_chunk`: 429 and 5xx responses, connection errors
+    and bodies that are not JSON are retried `max_retries` times, after `backoff` * 2^attempt seconds.
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            response = session.get(url, params=params, timeout=timeout)
+            # the status first: error pages are not always JSON
+            if response.status_code in RETRY_STATUSES:
+                response.raise_for_status()
+            if response.status_code != 200:
+                raise Exception(f"Error: {response.status_code} {response.text[:200]}")
+            data = response.json()['results']
+            break
+        except (requests.RequestException, ValueError):
+            if attempt == max_retries:
+                raise
+            time.sleep(backoff * 2**attempt)
+    for i, entry in enumerate(data):
+        data[i]['vehiclepositions'] = decode_vehiclepositions(entry['vehiclepositions'])
+    return data
+
+def collect_data_until(dt_until, bus_lines, session, compression="gzip", url=URL, interval=13):
+    params = {
+        'timezone': 'Europe/Brussels',
+    }
     dt_now = datetime.now()
     dt_init = dt_now.strftime("%Y-%m-%d_%H:%M:%S")
 
+    extension = {"gzip": ".gz", "zstd": ".zst"}.get(compression, "")
+    log_path = f"data/vehicle_positions_{dt_init}.ndjson{extension}"
+    # every poll is appended to the log, nothing is kept in memory
+    snapshot_log = SnapshotLog(log_path, compression=compression)
+
     i = 0
-    total = (dt_until - dt_now).seconds // 13
+    total = int((dt_until - dt_now).total_seconds() // interval)
 
     # Initialize the progress bar
     with tqdm(
@@ -69,46 +78,58 @@ def collect_data_until(dt_until):
             for line in range(0, len(bus_lines), 10):
                 required_lines = bus_lines[line : line + 10]
                 params["where"] = f"lineid in {str(tuple(required_lines))}"
-                vehicle_positions = get_data(params)
+                try:
+                    vehicle_positions = get_data(session, params, url)
+                except Exception as error:
+                    # the lines of this request are missing from the poll, the next one retries them
+                    print(f"An error occurred: {error}")
+                    continue
                 for line in vehicle_positions:
-                    vehicle_positions_with_timestamp = {
-                        "timestamp": dt_now.strftime("%Y-%m-%d %H:%M:%S"),
-                        "vehicle_positions": line["vehiclepositions"],
-                    }
-                    if (
-                        vehicle_positions_with_timestamp
-                        not in segments_data[line["lineid"]]
-                    ):
-                        segments_data[line["lineid"]].append(
-                            vehicle_positions_with_timestamp
-                        )
+                    # identical snapshots within a poll are dropped by the log
+                    snapshot_log.append(
+                        line["lineid"],
+                        dt_now.strftime("%Y-%m-%d %H:%M:%S"),
+                        line["vehiclepositions"],
+                    )
 
             i += 1
-            with open(f"vehicle_positions_{dt_init}.json", "w") as f:
-                json.dump(segments_data, f, indent=2)
+            snapshot_log.flush()
 
             # Update progress bar
             pbar.update(1)
 
-            # 13 seconds interval
-            if dt_now + timedelta(seconds=13) <= dt_until:
-                time.sleep(13)
+            # 13 seconds interval by default
+            if dt_now + timedelta(seconds=interval) <= dt_until:
+                time.sleep(interval)
                 dt_now = datetime.now()
             else:
                 break
 
-    return segments_data
+    # columnar copy for the analyses, partitioned by date and line
+    import storage
 
-H = 8
-M = 0
-
-dt = datetime.now() + timedelta(hours=H, minutes=M)
-datetime.strftime(dt, '%Y-%m-%d %H:%M:%S')
-
-dt_now = datetime.now()
-dt_later = dt_now + timedelta(hours=H, minutes=M)
-data = collect_data_until(dt_later)
+    storage.log_to_parquet(log_path)
+    return log_path
 
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Collect STIB vehicle positions every 13 seconds.")
+    parser.add_argument("--hours", type=float, default=8)
+    parser.add_argument("--minutes", type=float, default=0)
+    parser.add_argument("--interval", type=float, default=13, help="seconds to wait between two polls")
+    parser.add_argument("--compression", default="gzip", choices=["gzip", "zstd", "none"])
+    parser.add_argument("--base-url", help=f"defaults to $STIB_BASE_URL or {BASE_URL}")
+    args = parser.parse_args(argv)
 
+    load_dotenv()
+    with open("data/bus_lines.txt") as f:
+        bus_lines = f.read().splitlines()
+    session = make_session(os.environ['STIB_API_KEY'])
 
+    dt_now = datetime.now()
+    dt_later = dt_now + timedelta(hours=args.hours, minutes=args.minutes)
+    compression = None if args.compression == "none" else args.compression
+    url = (args.base_url or os.environ.get("STIB_BASE_URL", BASE_URL)) + RECORDS_PATH
+    return collect_data_until(dt_later, bus_lines, session, compression=compression, url=url, interval=args.interval)
 
+if __name__ == "__main__":
+    main()
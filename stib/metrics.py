@@ -0,0 +1,197 @@
+"""
+Lightweight instrumentation of the STIB collector and speed computation.
+
+A `Metrics` records, per stage, the wall time and the rows going in and out;
+the latencies of the API requests; and the rows the speed computation drops,
+per line and reason (see DROP_REASONS). It is exported as JSON lines or as a
+Prometheus text file (e.g. for the node_exporter textfile collector):
+
+    metrics = Metrics()
+    with metrics.stage("load") as stage:
+        vehicle_positions = load_vehicle_positions(path)
+        stage["rows_out"] = len(vehicle_positions)
+    export(metrics, "data/metrics/stib_speed.prom")
+
+`profiled` wraps a block in cProfile, for runs started with --profile.
+"""
+import contextlib
+import cProfile
+import json
+import os
+import time
+from collections import defaultdict
+from datetime import datetime
+
+# why vehicle rows of the first snapshot of a pair do not make it to a speed
+DROP_REASONS = (
+    "zero_distance",  # distanceFromPoint of 0
+    "unmatched_stop",  # the stop is not on the line and direction
+    "no_next_match",  # the vehicle was not found again in the next snapshot
+    "gap",  # the pair missed a poll (gap_policy="drop")
+    "speed_filter",  # the speed is outside (0, 25) m/s
+)
+
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+class Metrics:
+    """
+    Stage timings, latencies, counters and dropped rows of one run.
+
+    A disabled instance records nothing, so instrumented code can always call it.
+    Instances filled by worker processes are folded together with `merge`.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.stages = {}
+        self.latencies = defaultdict(list)
+        self.counters = defaultdict(int)
+        self.drops = defaultdict(int)
+
+    @contextlib.contextmanager
+    def stage(self, name, rows_in=None):
+        """
+        Time the block as one call of stage `name`.
+
+        Yields:
+        dict: Set its "rows_out" (and "rows_in" if not given) inside the block.
+        """
+        record = {"rows_in": rows_in, "rows_out": None}
+        if not self.enabled:
+            yield record
+            return
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            self._fold_stage(name, 1, time.perf_counter() - start, record["rows_in"] or 0, record["rows_out"] or 0)
+
+    def _fold_stage(self, name, calls, seconds, rows_in, rows_out):
+        state = self.stages.setdefault(name, {"calls": 0, "seconds": 0.0, "rows_in": 0, "rows_out": 0})
+        state["calls"] += calls
+        state["seconds"] += seconds
+        state["rows_in"] += int(rows_in)
+        state["rows_out"] += int(rows_out)
+
+    def observe(self, name, seconds):
+        """Record the latency of one request to `name`."""
+        if self.enabled:
+            self.latencies[name].append(seconds)
+
+    def count(self, name, value=1):
+        if self.enabled:
+            self.counters[name] += int(value)
+
+    def drop(self, reason, rows_per_line):
+        """
+        Record dropped rows.
+
+        Parameters:
+        reason (str): One of DROP_REASONS.
+        rows_per_line (pd.Series): Rows dropped, indexed by line_id.
+        """
+        if not self.enabled:
+            return
+        for line_id, rows in rows_per_line.items():
+            if rows:
+                self.drops[(str(line_id), reason)] += int(rows)
+
+    def merge(self, other):
+        """Fold the records of another instance into this one."""
+        for name, state in other.stages.items():
+            self._fold_stage(name, state["calls"], state["seconds"], state["rows_in"], state["rows_out"])
+        for name, latencies in other.latencies.items():
+            self.latencies[name].extend(latencies)
+        for name, value in other.counters.items():
+            self.counters[name] += value
+        for key, rows in other.drops.items():
+            self.drops[key] += rows
+        return self
+
+    def summary(self):
+        """
+        Returns:
+        dict: {"stages", "latencies" (count, mean and quantiles, in seconds), "counters",
+            "drops" (line_id -> reason -> rows)}.
+        """
+        import numpy as np
+
+        latencies = {}
+        for name, values in self.latencies.items():
+            values = np.asarray(values)
+            latencies[name] = {"count": len(values), "sum": float(values.sum()), "mean": float(values.mean())}
+            latencies[name].update({f"p{round(q * 100)}": float(np.quantile(values, q)) for q in QUANTILES})
+        drops = {}
+        for (line_id, reason), rows in sorted(self.drops.items()):
+            drops.setdefault(line_id, {})[reason] = rows
+        return {"stages": self.stages, "latencies": latencies, "counters": dict(self.counters), "drops": drops}
+
+    def to_prometheus(self, prefix="stib"):
+        """The metrics in the Prometheus text exposition format."""
+        rows = []
+
+        def metric(name, kind, samples):
+            if not samples:
+                return
+            rows.append(f"# TYPE {prefix}_{name} {kind}")
+            for labels, value in samples:
+                labels = ",".join(f'{key}="{label}"' for key, label in labels.items())
+                rows.append(f"{prefix}_{name}{{{labels}}} {value}" if labels else f"{prefix}_{name} {value}")
+
+        for field in ("calls", "seconds", "rows_in", "rows_out"):
+            metric(
+                f"stage_{field}_total",
+                "counter",
+                [({"stage": name}, state[field]) for name, state in self.stages.items()],
+            )
+        for name, latency in self.summary()["latencies"].items():
+            metric(
+                f"{name}_latency_seconds",
+                "summary",
+                [({"quantile": str(q)}, latency[f"p{round(q * 100)}"]) for q in QUANTILES],
+            )
+            rows.append(f"{prefix}_{name}_latency_seconds_sum {latency['sum']}")
+            rows.append(f"{prefix}_{name}_latency_seconds_count {latency['count']}")
+        for name, value in self.counters.items():
+            metric(f"{name}_total", "counter", [({}, value)])
+        metric(
+            "dropped_rows_total",
+            "counter",
+            [({"line": line_id, "reason": reason}, rows) for (line_id, reason), rows in sorted(self.drops.items())],
+        )
+        return "\n".join(rows) + "\n"
+
+
+def export(metrics, path, **labels):
+    """
+    Write the metrics to `path`: a Prometheus text file if it ends with .prom
+    (replaced atomically), otherwise one JSON line appended with a timestamp and `labels`.
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    if path.endswith(".prom"):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(metrics.to_prometheus())
+        os.replace(tmp_path, path)
+        return
+    record = {"time": datetime.now().isoformat(), **labels, **metrics.summary()}
+    with open(path, "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+@contextlib.contextmanager
+def profiled(path=None):
+    """cProfile the block and dump the stats to `path` (for pstats or snakeviz); a no-op without a path."""
+    if path is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
@@ -0,0 +1,180 @@
+import hashlib
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+
+# vehicles report a directionId that can be off by one from the direction_id
+# of the stops (e.g. bus 71); offsets are tried in this order
+DIRECTION_OFFSETS = (0, 1, -1)
+
+# bump when the layout of the cached index changes
+INDEX_VERSION = 3
+
+
+def assign_direction_id(group):
+    max_stop_sequence_row = group.loc[group['stop_sequence'].idxmax()]
+    group['direction_id'] = max_stop_sequence_row['stop_id']
+    return group
+
+
+def to_lon_lat(gdf):
+    """
+    The network geometries of a GeoJSON file, with (lon, lat) coordinates.
+
+    Stops.geojson and Segments.geojson written by create_db_files.ipynb before it
+    stopped swapping them hold (lat, lon) pairs; in Brussels the latitude (~50.8)
+    is always larger than the longitude (~4.4), so those files are recognized
+    and swapped back.
+    """
+    import geopandas as gpd
+    import shapely
+
+    if gdf.empty:
+        return gdf
+    min_x, min_y, max_x, max_y = gdf.total_bounds
+    if min_x + max_x <= min_y + max_y:
+        return gdf
+    gdf = gdf.copy()
+    gdf["geometry"] = gpd.GeoSeries(
+        shapely.transform(gdf.geometry.to_numpy(), lambda coords: coords[:, ::-1]), index=gdf.index, crs=gdf.crs
+    )
+    return gdf
+
+
+def load_stops(path):
+    import geopandas as gpd
+
+    return prepare_stops(to_lon_lat(gpd.read_file(path)))
+
+
+def prepare_stops(stops):
+    stops = stops.groupby(['line_id', 'direction']).apply(assign_direction_id)
+    stops.reset_index(drop=True, inplace=True)
+    return stops
+
+
+def load_segments(path):
+    import geopandas as gpd
+
+    segments = to_lon_lat(gpd.read_file(path))
+    segments = segments.to_crs(epsg=3812)
+    segments = segments.drop(columns=['color'])
+    segments['line_id'] = segments['line_id'].astype(int)
+    segments['segment_length'] = segments['geometry'].length
+    segments = segments.drop(columns=['id', 'distance', 'direction'])
+    return segments
+
+
+def _line_slices(line_ids):
+    # line_ids must be sorted
+    boundaries = np.flatnonzero(np.diff(line_ids)) + 1
+    starts = np.concatenate([[0], boundaries])
+    ends = np.concatenate([boundaries, [len(line_ids)]])
+    return {int(line_ids[start]): slice(int(start), int(end)) for start, end in zip(starts, ends) if end > start}
+
+
+class NetworkIndex:
+    """
+    Stop and segment lookup tables of the bus network, built once per run.
+
+    `stops` and `segments` are sorted by line (keeping the original order
+    within a line), so the rows of one line are a contiguous slice.
+    `lookup` is keyed by (line_id, directionId, pointId) as reported by the
+    vehicles: every stop appears once per direction offset, already joined to
+    the segment that starts at it, so a vehicle is matched with a single merge.
+    """
+
+    def __init__(self, stops, segments):
+        stops = stops[["line_id", "stop_id", "direction_id", "stop_name", "stop_sequence"]]
+        segments = segments[["line_id", "start", "end", "segment_length"]]
+        self.stops = pd.DataFrame(stops).sort_values("line_id", kind="stable").reset_index(drop=True)
+        self.segments = pd.DataFrame(segments).sort_values("line_id", kind="stable").reset_index(drop=True)
+        self.stop_slices = _line_slices(self.stops["line_id"].to_numpy())
+        self.segment_slices = _line_slices(self.segments["line_id"].to_numpy())
+        self.lookup = self._build_lookup()
+
+    def _build_lookup(self):
+        stops = self.stops.assign(_stop_row=np.arange(len(self.stops)))
+        lookup = []
+        for order, offset in enumerate(DIRECTION_OFFSETS):
+            # a vehicle with directionId d matches stops with direction_id d + offset
+            lookup.append(
+                stops.assign(directionId=stops["direction_id"] - offset, _order=order).rename(
+                    columns={"stop_id": "pointId"}
+                )
+            )
+        lookup = pd.concat(lookup, ignore_index=True)
+        segments = self.segments.assign(_segment_row=np.arange(len(self.segments)))
+        # stops without a segment are kept, they count as matched stops
+        lookup = lookup.merge(
+            segments.rename(columns={"start": "pointId"}),
+            on=["line_id", "pointId"],
+            how="left",
+        )
+        return lookup[
+            [
+                "line_id",
+                "directionId",
+                "pointId",
+                "_order",
+                "_stop_row",
+                "direction_id",
+                "stop_name",
+                "stop_sequence",
+                "_segment_row",
+                "end",
+                "segment_length",
+            ]
+        ]
+
+    def stops_line(self, line_id):
+        return self.stops.iloc[self.stop_slices.get(line_id, slice(0, 0))]
+
+    def segments_line(self, line_id):
+        return self.segments.iloc[self.segment_slices.get(line_id, slice(0, 0))]
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            pickle.dump({"version": INDEX_VERSION, "stops": self.stops, "segments": self.segments}, f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            data = pickle.load(f)
+        if data.get("version") != INDEX_VERSION:
+            raise ValueError(f"{path} was written by an incompatible version of the index")
+        return cls(data["stops"], data["segments"])
+
+    @classmethod
+    def from_files(cls, stops_path, segments_path, cache_dir="data/cache"):
+        """
+        Build the index from the stops and segments GeoJSON files.
+
+        The index is cached in `cache_dir` under a hash of both files, so later
+        runs on the same files skip the GeoJSON parsing and the direction_id assignment.
+        """
+        digest = hashlib.sha1(str(INDEX_VERSION).encode())
+        for path in (stops_path, segments_path):
+            with open(path, "rb") as f:
+                digest.update(f.read())
+        cache_path = None
+        if cache_dir is not None:
+            cache_path = os.path.join(cache_dir, f"network_index_{digest.hexdigest()[:16]}.pkl")
+            if os.path.isfile(cache_path):
+                return cls.load(cache_path)
+
+        index = cls(load_stops(stops_path), load_segments(segments_path))
+        if cache_path is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            index.save(cache_path)
+        return index
+
+    @classmethod
+    def from_store(cls, timestamp, directory="data/network"):
+        """Build the index from the network version valid at `timestamp` (see mobility_twin.static_network)."""
+        from mobility_twin.static_network import NetworkStore
+
+        store = NetworkStore(directory)
+        return cls(prepare_stops(store.load_stops(timestamp)), store.load_segments(timestamp))
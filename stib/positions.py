@@ -0,0 +1,109 @@
+"""
+Compact representation of the vehicles of one snapshot.
+
+The API serves the vehicles of a line as a string, e.g.
+'[{"directionId": "8731", "distanceFromPoint": 120, "pointId": "8733"}, ...]'.
+It is decoded once, by the collector, into a structured array of
+POSITION_DTYPE (the column types of the vehicle_positions Parquet dataset);
+the snapshot log, storage and the speed computation pass that array along
+instead of lists of dicts:
+
+    positions = decode_vehiclepositions(entry["vehiclepositions"])
+    moving = positions[positions["distanceFromPoint"] > 0]
+
+Snapshots of older logs and JSON dumps (lists of dicts) are converted by `as_positions`.
+"""
+import json
+from ast import literal_eval
+
+import numpy as np
+
+POSITION_DTYPE = np.dtype(
+    [
+        ("directionId", np.int32),
+        ("distanceFromPoint", np.float32),
+        ("pointId", np.int32),
+    ]
+)
+
+FIELDS = POSITION_DTYPE.names
+
+
+def empty_positions():
+    return np.zeros(0, dtype=POSITION_DTYPE)
+
+
+def from_records(vehicles):
+    """
+    Convert a list of {"directionId", "distanceFromPoint", "pointId"} dicts.
+
+    Vehicles with a missing or non-numeric field are left out.
+    """
+    try:
+        return np.array(
+            [(int(v["directionId"]), v["distanceFromPoint"], int(v["pointId"])) for v in vehicles],
+            dtype=POSITION_DTYPE,
+        )
+    except (KeyError, TypeError, ValueError):
+        pass
+    rows = []
+    for vehicle in vehicles:
+        try:
+            rows.append((int(vehicle["directionId"]), float(vehicle["distanceFromPoint"]), int(vehicle["pointId"])))
+        except (KeyError, TypeError, ValueError):
+            continue
+    return np.array(rows, dtype=POSITION_DTYPE)
+
+
+def from_columns(columns):
+    """Convert {"directionId": [...], "distanceFromPoint": [...], "pointId": [...]}, as written by `to_columns`."""
+    positions = np.empty(len(columns["pointId"]), dtype=POSITION_DTYPE)
+    for field in FIELDS:
+        positions[field] = columns[field]
+    return positions
+
+
+def to_columns(positions):
+    """The columns of `positions` as lists, for JSON."""
+    return {field: positions[field].tolist() for field in FIELDS}
+
+
+def decode_vehiclepositions(text):
+    """
+    Decode the 'vehiclepositions' string of an API record.
+
+    JSON is tried first, being an order of magnitude faster than `ast.literal_eval`,
+    which remains the fallback for strings in Python literal syntax (single quotes).
+
+    Returns:
+    np.ndarray: Structured array of POSITION_DTYPE, or None if the record had no positions.
+    """
+    if text is None:
+        return None
+    try:
+        vehicles = json.loads(text)
+    except json.JSONDecodeError:
+        vehicles = literal_eval(text)
+    if vehicles is None:
+        return None
+    return from_records(vehicles)
+
+
+def as_positions(vehicle_positions):
+    """
+    Normalize the 'vehicle_positions' of a snapshot, whatever its origin, to POSITION_DTYPE.
+
+    Accepts a structured array, a list of dicts (legacy JSON dumps and logs),
+    columns (snapshot logs) or the raw API string. None stays None.
+    """
+    if vehicle_positions is None:
+        return None
+    if isinstance(vehicle_positions, np.ndarray):
+        if vehicle_positions.dtype == POSITION_DTYPE:
+            return vehicle_positions
+        return vehicle_positions.astype(POSITION_DTYPE)
+    if isinstance(vehicle_positions, dict):
+        return from_columns(vehicle_positions)
+    if isinstance(vehicle_positions, str):
+        return decode_vehiclepositions(vehicle_positions)
+    return from_records(vehicle_positions)
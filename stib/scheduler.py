@@ -0,0 +1,161 @@
+"""
+Adaptive polling of the STIB lines, for stib.async_collector --adaptive.
+
+Every line has its own period, a number of ticks of the collector:
+
+- a line with vehicles that move is polled every tick;
+- a line with vehicles whose positions rarely change between polls (the feed
+  was not refreshed) is polled every `active_period` ticks, the longest
+  period that keeps consecutive snapshots closer than the `max_gap` of the
+  speed computation, with `latency_margin` seconds to spare for a late tick
+  or a slow request, so no speed is lost;
+- a line without vehicles backs off, doubling its period up to
+  `max_idle_period` ticks, or only up to `active_period` at the hours of the
+  day it usually runs, so that its first buses are caught.
+
+The usual activity of a line per hour of the day comes from a JSON profile
+of the previous runs: the mean vehicle count of every hour a run collected is
+folded into an exponential average over runs when the profile is saved. The
+lines due at a tick are packed into as few requests as the API allows
+(`batch_size` lines per `where lineid in (...)`), balanced.
+
+    scheduler = PollScheduler(bus_lines, interval=13, profile=PollScheduler.load_profile(path))
+    for lines in scheduler.batches(tick):
+        ...
+        scheduler.observe(line_id, positions, tick, hour)
+"""
+import json
+import math
+import os
+
+# MAX_GAP_SECONDS of stib.speed_engine, not imported to keep pandas out of the collector
+MAX_GAP_SECONDS = 40
+
+PROFILE_PATH = "data/cache/poll_profile.json"
+
+
+class LineState:
+    __slots__ = ("period", "due", "digest", "change_rate", "vehicles")
+
+    def __init__(self):
+        self.period = 1
+        self.due = 0
+        self.digest = None
+        # exponential average of "the positions changed since the last poll", starts as changing
+        self.change_rate = 1.0
+        self.vehicles = 0
+
+
+class PollScheduler:
+    """
+    Per-line polling periods, in ticks, and the request batches of every tick.
+
+    Parameters:
+    lines (list): Line ids to collect.
+    interval (float): Seconds between two ticks.
+    max_idle_period (int): Longest period of a line without vehicles, in ticks.
+    batch_size (int): Lines per request.
+    min_change_rate (float): Below this rate of changed payloads, a line with vehicles is polled every `active_period` ticks.
+    smoothing (float): Weight of the last poll in the change rate, and of this run in the profile.
+    profile (dict): line_id -> 24 average vehicle counts (or None) per hour of the day, see `load_profile`.
+    max_gap (float): Seconds between two snapshots beyond which the speed computation drops a pair.
+    latency_margin (float): Seconds kept below `max_gap` by `active_period`, one `interval` by default.
+    """
+
+    def __init__(
+        self,
+        lines,
+        interval=13,
+        max_idle_period=16,
+        batch_size=10,
+        min_change_rate=0.5,
+        smoothing=0.2,
+        profile=None,
+        max_gap=MAX_GAP_SECONDS,
+        latency_margin=None,
+    ):
+        self.lines = {line_id: LineState() for line_id in dict.fromkeys(lines)}
+        self.batch_size = batch_size
+        self.max_idle_period = max_idle_period
+        self.min_change_rate = min_change_rate
+        self.smoothing = smoothing
+        self.profile = profile if profile is not None else {}
+        latency_margin = interval if latency_margin is None else latency_margin
+        # e.g. 2 ticks (26 s) for a 40 s max_gap at 13 s, not 3 (39 s), which one late poll would break
+        self.active_period = max(math.floor((max_gap - latency_margin) / interval), 1)
+        # line_id -> hour -> [vehicles, polls] of this run
+        self._hours = {}
+
+    def due(self, tick):
+        """Lines to poll at `tick`: their period elapsed, or their last poll failed."""
+        return [line_id for line_id, state in self.lines.items() if state.due <= tick]
+
+    def batches(self, tick):
+        """The lines due at `tick`, in as few balanced requests of at most `batch_size` lines as possible."""
+        lines = self.due(tick)
+        if not lines:
+            return []
+        num_batches = math.ceil(len(lines) / self.batch_size)
+        size = math.ceil(len(lines) / num_batches)
+        return [lines[i : i + size] for i in range(0, len(lines), size)]
+
+    def observe(self, line_id, positions, tick, hour):
+        """
+        Schedule the next poll of `line_id` from its snapshot at `tick`.
+
+        Parameters:
+        positions (np.ndarray): The POSITION_DTYPE array of the snapshot, None if the line had no record.
+        tick (int): Index of the tick (e.g. seconds since the epoch // interval).
+        hour (int): Hour of the day of the tick, 0-23.
+        """
+        state = self.lines.setdefault(line_id, LineState())
+        vehicles = 0 if positions is None else len(positions)
+        digest = None if positions is None else hash(positions.tobytes())
+        if state.digest is not None or digest is not None:
+            changed = float(digest != state.digest)
+            state.change_rate += self.smoothing * (changed - state.change_rate)
+        state.digest = digest
+        state.vehicles = vehicles
+
+        counts = self._hours.setdefault(line_id, {}).setdefault(hour, [0, 0])
+        counts[0] += vehicles
+        counts[1] += 1
+
+        if vehicles and state.change_rate >= self.min_change_rate:
+            state.period = 1
+        elif vehicles:
+            state.period = self.active_period
+        else:
+            # the line usually runs at this hour: do not miss its first buses
+            usual = self.profile.get(line_id, [None] * 24)[hour] or 0
+            limit = self.active_period if usual >= 0.5 else self.max_idle_period
+            state.period = min(state.period * 2, limit)
+        state.due = tick + state.period
+
+    def periods(self):
+        """line_id -> current period, in ticks."""
+        return {line_id: state.period for line_id, state in self.lines.items()}
+
+    @staticmethod
+    def load_profile(path=PROFILE_PATH):
+        """The activity profile saved by `save_profile`, empty if there is none yet."""
+        if not os.path.exists(path):
+            return {}
+        with open(path) as f:
+            return json.load(f)
+
+    def save_profile(self, path=PROFILE_PATH):
+        """Fold the mean vehicle count per line and hour of this run into the profile and write it to `path`."""
+        for line_id, hours in self._hours.items():
+            hourly = self.profile.setdefault(line_id, [None] * 24)
+            for hour, (vehicles, polls) in hours.items():
+                mean = vehicles / polls
+                hourly[hour] = mean if hourly[hour] is None else hourly[hour] + self.smoothing * (mean - hourly[hour])
+        self._hours = {}
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.profile, f)
+        os.replace(tmp_path, path)
@@ -0,0 +1,270 @@
+"""
+Spatial index of the segments, for map-matching positions onto the network.
+
+The STIB feed places a vehicle by its last stop (`pointId`) and the distance
+it has driven since (`distanceFromPoint`). When that stop is not one of the
+stops of the vehicle's line and direction (a detour, a stop served by another
+line, a renumbered stop), the stop lookup of `NetworkIndex` cannot place the
+vehicle and the row used to be discarded. Here the stop is located by its
+coordinates instead: projected onto the nearest segment of the line and
+direction, and the distance driven is added along the segments from there.
+
+    python -m stib.segment_index --points 2000000
+"""
+import argparse
+import hashlib
+import os
+import pickle
+import time
+
+import numpy as np
+import pandas as pd
+
+from stib.network_index import DIRECTION_OFFSETS, load_segments, load_stops
+
+# positions further than this (in meters) from every candidate segment are not matched
+MAX_DISTANCE = 50.0
+
+# a position is carried over at most this many following segments
+MAX_HOPS = 10
+
+# bump when the layout of the cached index changes
+INDEX_VERSION = 3
+
+
+class SegmentIndex:
+    """
+    STRtree over the segment geometries in EPSG:3812, so distances are in meters.
+
+    `segments` keeps 'line_id', 'start', 'end', 'segment_length' and the
+    'direction_id' of the stop every segment starts at; `next_segment` is the
+    row of the segment starting where each segment ends (-1 at a terminus);
+    `stop_points` are the stop locations, indexed by stop_id.
+    """
+
+    def __init__(self, segments, stops):
+        self.geometries = segments.geometry.to_crs(epsg=3812).to_numpy()
+        segments = pd.DataFrame(segments[["line_id", "start", "end", "segment_length"]]).reset_index(drop=True)
+        directions = pd.DataFrame(stops[["line_id", "stop_id", "direction_id"]]).drop_duplicates(
+            subset=["line_id", "stop_id"]
+        )
+        segments = segments.merge(
+            directions.rename(columns={"stop_id": "start"}), on=["line_id", "start"], how="left"
+        )
+        self.segments = segments
+        self.stop_points = (
+            stops.geometry.to_crs(epsg=3812)
+            .set_axis(stops["stop_id"].astype(int).to_numpy())
+            .pipe(lambda points: points[~points.index.duplicated()])
+        )
+        self.next_segment = self._next_segments()
+        self._build_tree()
+
+    def _build_tree(self):
+        import shapely
+
+        self.tree = shapely.STRtree(self.geometries)
+        self._line_ids = self.segments["line_id"].to_numpy()
+        self._direction_ids = self.segments["direction_id"].to_numpy(dtype=float, na_value=np.nan)
+        self._lengths = self.segments["segment_length"].to_numpy(dtype=float)
+        self._starts = self.segments["start"].to_numpy()
+
+    def _next_segments(self):
+        rows = self.segments[["line_id", "start"]].assign(_next=np.arange(len(self.segments)))
+        rows = rows.drop_duplicates(subset=["line_id", "start"])
+        following = self.segments[["line_id", "end"]].merge(
+            rows.rename(columns={"start": "end"}), on=["line_id", "end"], how="left"
+        )
+        return following["_next"].fillna(-1).to_numpy(dtype=np.int64)
+
+    def project(self, line_ids, points, direction_ids=None, max_distance=MAX_DISTANCE):
+        """
+        Project every point onto the nearest segment of its line.
+
+        All points are queried against the tree at once; candidate pairs of
+        another line (or direction) are discarded before picking the nearest.
+
+        Parameters:
+        line_ids (array-like): Line of every point.
+        points (array-like): Shapely points in EPSG:3812.
+        direction_ids (array-like): Optional directionId of every point, as reported
+            by the vehicles; only segments of that direction (see DIRECTION_OFFSETS) are candidates.
+        max_distance (float): Maximum distance from the point to its segment, in meters.
+
+        Returns:
+        np.ndarray: Row of the segment in `segments`, -1 when none is within `max_distance`.
+        np.ndarray: Distance along the segment, from its start, in meters (NaN when unmatched).
+        np.ndarray: Distance from the point to the segment, in meters (NaN when unmatched).
+        """
+        import shapely
+
+        line_ids = np.asarray(line_ids)
+        points = np.asarray(points, dtype=object)
+        point_rows, segment_rows = self.tree.query(points, predicate="dwithin", distance=max_distance)
+        keep = self._line_ids[segment_rows] == line_ids[point_rows]
+        if direction_ids is not None:
+            direction_ids = np.asarray(direction_ids, dtype=float)
+            keep &= np.isin(self._direction_ids[segment_rows] - direction_ids[point_rows], DIRECTION_OFFSETS)
+        point_rows, segment_rows = point_rows[keep], segment_rows[keep]
+
+        distances = shapely.distance(points[point_rows], self.geometries[segment_rows])
+        # nearest candidate of every point
+        order = np.lexsort((distances, point_rows))
+        point_rows, segment_rows, distances = point_rows[order], segment_rows[order], distances[order]
+        nearest = np.ones(len(point_rows), dtype=bool)
+        nearest[1:] = point_rows[1:] != point_rows[:-1]
+        point_rows, segment_rows, distances = point_rows[nearest], segment_rows[nearest], distances[nearest]
+
+        segments = np.full(len(points), -1, dtype=np.int64)
+        offsets = np.full(len(points), np.nan)
+        from_segment = np.full(len(points), np.nan)
+        segments[point_rows] = segment_rows
+        offsets[point_rows] = shapely.line_locate_point(self.geometries[segment_rows], points[point_rows])
+        from_segment[point_rows] = distances
+        return segments, offsets, from_segment
+
+    def advance(self, segments, offsets):
+        """
+        Carry distances past the end of their segment over to the following segments.
+
+        Returns:
+        np.ndarray: Row of the segment every distance ends up on (-1 stays -1).
+        np.ndarray: Distance along that segment, capped at its length at a terminus.
+        """
+        segments, offsets = segments.copy(), offsets.copy()
+        for _ in range(MAX_HOPS):
+            matched = segments >= 0
+            over = np.zeros(len(segments), dtype=bool)
+            over[matched] = (offsets[matched] > self._lengths[segments[matched]]) & (
+                self.next_segment[segments[matched]] >= 0
+            )
+            if not over.any():
+                break
+            offsets[over] -= self._lengths[segments[over]]
+            segments[over] = self.next_segment[segments[over]]
+        matched = segments >= 0
+        offsets[matched] = np.minimum(offsets[matched], self._lengths[segments[matched]])
+        return segments, offsets
+
+    def recover(self, vehicles, max_distance=MAX_DISTANCE):
+        """
+        Place vehicles whose stop is not on their line and direction.
+
+        Parameters:
+        vehicles (pd.DataFrame): Rows with 'line_id', 'directionId', 'pointId' and 'distanceFromPoint'.
+
+        Returns:
+        pd.DataFrame: The vehicles that could be placed, with 'pointId' replaced by the start
+            of the segment they are on and 'distanceFromPoint' by the distance along it.
+            Vehicles at an unknown stop, or too far from any segment of their direction, are left out.
+        """
+        points = self.stop_points.reindex(vehicles["pointId"].to_numpy()).to_numpy()
+        known = ~pd.isna(points)
+        vehicles, points = vehicles[known], points[known]
+        segments, offsets, _ = self.project(
+            vehicles["line_id"].to_numpy(),
+            points,
+            vehicles["directionId"].to_numpy(),
+            max_distance,
+        )
+        segments, offsets = self.advance(segments, offsets + vehicles["distanceFromPoint"].to_numpy())
+        matched = segments >= 0
+        return vehicles[matched].assign(
+            pointId=self._starts[segments[matched]],
+            distanceFromPoint=offsets[matched],
+        )
+
+    def __getstate__(self):
+        # the tree is rebuilt rather than pickled, it only takes a few milliseconds
+        return {
+            "geometries": self.geometries,
+            "segments": self.segments,
+            "stop_points": self.stop_points,
+            "next_segment": self.next_segment,
+        }
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._build_tree()
+
+    @classmethod
+    def from_files(cls, stops_path, segments_path, cache_dir="data/cache"):
+        """
+        Build the index from the stops and segments GeoJSON files, cached like `NetworkIndex.from_files`.
+        """
+        digest = hashlib.sha1(str(INDEX_VERSION).encode())
+        for path in (stops_path, segments_path):
+            with open(path, "rb") as f:
+                digest.update(f.read())
+        cache_path = None
+        if cache_dir is not None:
+            cache_path = os.path.join(cache_dir, f"segment_index_{digest.hexdigest()[:16]}.pkl")
+            if os.path.isfile(cache_path):
+                with open(cache_path, "rb") as f:
+                    return pickle.load(f)
+
+        index = cls(load_segments(segments_path), load_stops(stops_path))
+        if cache_path is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(cache_path, "wb") as f:
+                pickle.dump(index, f)
+        return index
+
+    @classmethod
+    def from_store(cls, timestamp, directory="data/network"):
+        """Build the index from the network version valid at `timestamp` (see mobility_twin.static_network)."""
+        from mobility_twin.static_network import NetworkStore
+        from stib.network_index import prepare_stops
+
+        store = NetworkStore(directory)
+        return cls(store.load_segments(timestamp), prepare_stops(store.load_stops(timestamp)))
+
+
+def random_positions(index, n, max_distance=MAX_DISTANCE, seed=0):
+    """
+    `n` random points within `max_distance` of a random segment each, with the line of that segment.
+    """
+    import shapely
+
+    rng = np.random.default_rng(seed)
+    rows = rng.integers(len(index.segments), size=n)
+    points = shapely.line_interpolate_point(index.geometries[rows], rng.random(n), normalized=True)
+    angles = rng.uniform(0, 2 * np.pi, n)
+    radii = rng.uniform(0, max_distance / 2, n)
+    points = shapely.points(
+        shapely.get_x(points) + radii * np.cos(angles),
+        shapely.get_y(points) + radii * np.sin(angles),
+    )
+    return index.segments["line_id"].to_numpy()[rows], points
+
+
+def benchmark(index, n, batch_size=500_000):
+    """
+    Time `project` followed by `advance` on `n` random positions.
+
+    Returns:
+    float: Points per minute.
+    """
+    line_ids, points = random_positions(index, n)
+    start = time.perf_counter()
+    for i in range(0, n, batch_size):
+        segments, offsets, _ = index.project(line_ids[i : i + batch_size], points[i : i + batch_size])
+        index.advance(segments, offsets)
+    elapsed = time.perf_counter() - start
+    return n / elapsed * 60
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the projection of positions onto the segments.")
+    parser.add_argument("--stops", default="preprocessed_data/Stops.geojson")
+    parser.add_argument("--segments", default="data/segments.geojson")
+    parser.add_argument("--points", type=int, default=1_000_000)
+    args = parser.parse_args(argv)
+
+    index = SegmentIndex.from_files(args.stops, args.segments)
+    print(f"{len(index.segments)} segments, {args.points} points")
+    print(f"{benchmark(index, args.points):,.0f} points per minute")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+import gzip
+import hashlib
+import io
+import json
+import os
+import zlib
+
+from stib.positions import as_positions, to_columns
+
+try:
+    import zstandard
+except ImportError:  # zstd framing is optional
+    zstandard = None
+
+
+def _compression_from_path(path):
+    if path.endswith(".gz"):
+        return "gzip"
+    if path.endswith(".zst"):
+        return "zstd"
+    return None
+
+
+class SnapshotLog:
+    """
+    Append-only, line-delimited log of vehicle position snapshots.
+
+    Every record is one JSON object per line:
+    {"line_id": ..., "timestamp": ..., "vehicle_positions": {"directionId": [...], ...}},
+    the vehicles stored by column (see stib.positions); logs written before
+    stored a list of {"directionId", "distanceFromPoint", "pointId"} dicts instead.
+    The records of one poll are written and flushed together, so a crashed
+    collector loses at most the poll it was writing. With gzip or zstd each
+    poll is written as its own compressed frame, which readers decode as one stream.
+
+    Identical snapshots received within the same poll (e.g. a line requested
+    twice) are dropped by hashing their payload; only the hashes of the current
+    poll are kept, so memory does not grow with the length of the run.
+    """
+
+    def __init__(self, path, compression=None):
+        self.path = path
+        self.compression = compression if compression is not None else _compression_from_path(path)
+        if self.compression == "zstd" and zstandard is None:
+            raise ImportError("zstd compression requires the 'zstandard' package")
+        self._pending = []
+        self._timestamp = None
+        self._seen = set()
+
+    def append(self, line_id, timestamp, vehicle_positions, **fields):
+        """
+        Queue a snapshot for the current poll.
+
+        `vehicle_positions` is a POSITION_DTYPE array (or anything `as_positions` accepts).
+        Extra keyword fields are stored alongside the snapshot.
+
+        Returns:
+        bool: False if an identical snapshot was already logged for this timestamp.
+        """
+        if timestamp != self._timestamp:
+            self._timestamp = timestamp
+            self._seen = set()
+        positions = as_positions(vehicle_positions)
+        digest = hashlib.blake2b(f"{line_id}\n{timestamp}\n".encode(), digest_size=16)
+        digest.update(b"null" if positions is None else positions.tobytes())
+        digest = digest.digest()
+        if digest in self._seen:
+            return False
+        self._seen.add(digest)
+        record = {
+            "line_id": str(line_id),
+            "timestamp": timestamp,
+            "vehicle_positions": None if positions is None else to_columns(positions),
+        }
+        record.update(fields)
+        self._pending.append(json.dumps(record, separators=(",", ":")))
+        return True
+
+    def flush(self):
+        """Durably append every queued snapshot to the log."""
+        if not self._pending:
+            return
+        data = ("\n".join(self._pending) + "\n").encode()
+        if self.compression == "gzip":
+            data = gzip.compress(data)
+        elif self.compression == "zstd":
+            data = zstandard.ZstdCompressor().compress(data)
+        with open(self.path, "ab") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        self._pending = []
+
+
+def _open_log(path):
+    compression = _compression_from_path(path)
+    if compression == "gzip":
+        return gzip.open(path, "rt")
+    if compression == "zstd":
+        if zstandard is None:
+            raise ImportError("reading .zst logs requires the 'zstandard' package")
+        reader = zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), read_across_frames=True)
+        return io.TextIOWrapper(reader)
+    return open(path)
+
+
+class _Decompressor:
+    """
+    Incremental decompression of a log that is still being written, for `stream_speeds.follow`.
+
+    Every flush of `SnapshotLog` is its own gzip member or zstd frame, so a
+    new decompressor is started at the end of each; plain logs pass through.
+    """
+
+    def __init__(self, path):
+        self.compression = _compression_from_path(path)
+        if self.compression == "zstd" and zstandard is None:
+            raise ImportError("reading .zst logs requires the 'zstandard' package")
+        self._decompressor = self._new()
+
+    def _new(self):
+        if self.compression == "gzip":
+            return zlib.decompressobj(zlib.MAX_WBITS | 16)
+        if self.compression == "zstd":
+            return zstandard.ZstdDecompressor().decompressobj()
+        return None
+
+    def decompress(self, data):
+        if self._decompressor is None:
+            return data
+        decompressed = b""
+        while data:
+            decompressed += self._decompressor.decompress(data)
+            data = b""
+            if self._decompressor.eof:
+                data = self._decompressor.unused_data
+                self._decompressor = self._new()
+        return decompressed
+
+
+def read_snapshots(path):
+    """
+    Stream the snapshots of a log as (line_id, {"timestamp", "vehicle_positions", ...}) tuples,
+    'vehicle_positions' as a POSITION_DTYPE array (None if the API returned none).
+
+    A truncated last record, left behind by a crashed collector, is ignored.
+    """
+    with _open_log(path) as f:
+        try:
+            for row in f:
+                try:
+                    record = json.loads(row)
+                except json.JSONDecodeError:
+                    break
+                record["vehicle_positions"] = as_positions(record["vehicle_positions"])
+                yield record.pop("line_id"), record
+        except EOFError:
+            # the last compressed frame was cut off
+            return
+
+
+def iter_vehicle_positions(path):
+    """
+    Stream (line_id, snapshot) tuples from a snapshot log, a legacy
+    vehicle_positions_*.json file (line_id -> list of snapshots) or a
+    Parquet root (e.g. data/parquet) written by `storage`, with
+    'vehicle_positions' as POSITION_DTYPE arrays.
+    """
+    if os.path.isdir(path):
+        import storage
+
+        yield from storage.iter_snapshots(root=path)
+    elif path.endswith(".json"):
+        with open(path) as f:
+            vehicle_positions = json.load(f)
+        for line_id in vehicle_positions:
+            for instance in vehicle_positions[line_id]:
+                instance["vehicle_positions"] = as_positions(instance["vehicle_positions"])
+                yield line_id, instance
+    else:
+        yield from read_snapshots(path)
+
+
+def load_vehicle_positions(path):
+    """Load a snapshot log or legacy JSON file into the line_id -> list of snapshots layout."""
+    vehicle_positions = {}
+    for line_id, instance in iter_vehicle_positions(path):
+        vehicle_positions.setdefault(line_id, []).append(instance)
+    return vehicle_positions
@@ -0,0 +1,469 @@
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+
+from stib.metrics import Metrics
+from stib.positions import POSITION_DTYPE, as_positions
+
+# columns of the per-snapshot dataframe built by `to_df` in calculate_stib_speed.py
+POSITION_COLUMNS = [
+    "directionId",
+    "distanceFromPoint",
+    "pointId",
+    "direction_id",
+    "stop_name",
+    "stop_sequence",
+    "end",
+    "segment_length",
+    "rank",
+]
+
+# pairs further apart than this missed at least one poll
+MAX_GAP_SECONDS = 40
+
+# what to do with pairs that are MAX_GAP_SECONDS or more apart:
+# "drop" them, "zero" their distance (the original behaviour) or "keep" them
+GAP_POLICIES = ("drop", "zero", "keep")
+
+OUTPUT_COLUMNS = [
+    "directionId",
+    "pointId_df1",
+    "end_df1",
+    "distanceFromPoint_df1",
+    "stop_name_df1",
+    "segment_length_df1",
+    "distanceFromPoint_df2",
+    "stop_name_df2",
+    "segment_length_df2",
+    "distance_traveled",
+    "speed",
+    "interval_in_seconds",
+    "timestamp",
+]
+
+
+def flatten_snapshots(vehicle_positions):
+    """
+    Flatten every snapshot of every line into two long tables.
+
+    Parameters:
+    vehicle_positions (dict or iterable): line_id -> list of {"timestamp", "vehicle_positions"}
+        snapshots, or a stream of (line_id, snapshot) tuples such as `snapshot_log.read_snapshots`.
+        'vehicle_positions' is a POSITION_DTYPE array (see stib.positions) or a list of dicts.
+
+    Returns:
+    pd.DataFrame: One row per snapshot with 'snapshot' (global, consecutive within a line),
+        'line_id', 'timestamp', 'observed_at', 'num_vehicles' (after dropping zero distances)
+        and 'num_zero_distance'.
+        'observed_at' is the response time recorded by the collector when available,
+        the poll timestamp otherwise.
+    pd.DataFrame: One row per vehicle with 'snapshot', 'line_id', 'directionId',
+        'distanceFromPoint' and 'pointId'.
+    """
+    if isinstance(vehicle_positions, dict):
+        vehicle_positions = [
+            (line, instance) for line, instances in vehicle_positions.items() for instance in instances
+        ]
+
+    # snapshots are buffered per line (in order of first appearance) so that
+    # the snapshots of a line get consecutive ids even when the stream interleaves lines
+    lines = {}
+    for line, instance in vehicle_positions:
+        positions = as_positions(instance["vehicle_positions"])
+        if positions is None:
+            continue
+        if line not in lines:
+            lines[line] = {
+                "timestamps": [],
+                "observed_at": [],
+                "num_vehicles": [],
+                "num_zero_distance": [],
+                "vehicles": [],
+            }
+        buffer = lines[line]
+        moving = positions[positions["distanceFromPoint"] > 0]
+        buffer["vehicles"].append(moving)
+        buffer["timestamps"].append(instance["timestamp"])
+        buffer["observed_at"].append(instance.get("response_timestamp", instance["timestamp"]))
+        buffer["num_vehicles"].append(len(moving))
+        buffer["num_zero_distance"].append(len(positions) - len(moving))
+
+    snapshot_line_ids, timestamps, observed_at, num_vehicles, num_zero_distance = [], [], [], [], []
+    vehicles = []
+    for line, buffer in lines.items():
+        snapshot_line_ids.extend([int(line)] * len(buffer["timestamps"]))
+        timestamps.extend(buffer["timestamps"])
+        observed_at.extend(buffer["observed_at"])
+        num_vehicles.extend(buffer["num_vehicles"])
+        num_zero_distance.extend(buffer["num_zero_distance"])
+        vehicles.extend(buffer["vehicles"])
+
+    snapshots = pd.DataFrame(
+        {
+            "snapshot": np.arange(len(timestamps)),
+            "line_id": np.asarray(snapshot_line_ids, dtype=np.int64),
+            "timestamp": pd.to_datetime(pd.Series(timestamps, dtype=object), format="%Y-%m-%d %H:%M:%S"),
+            "observed_at": pd.to_datetime(pd.Series(observed_at, dtype=object), format="ISO8601"),
+            "num_vehicles": np.asarray(num_vehicles, dtype=np.int64),
+            "num_zero_distance": np.asarray(num_zero_distance, dtype=np.int64),
+        }
+    )
+
+    snapshot_ids = np.repeat(snapshots["snapshot"].to_numpy(), snapshots["num_vehicles"].to_numpy())
+    vehicles = np.concatenate(vehicles) if vehicles else np.zeros(0, dtype=POSITION_DTYPE)
+    vehicles = pd.DataFrame(
+        {
+            "snapshot": snapshot_ids,
+            "line_id": snapshots["line_id"].to_numpy()[snapshot_ids],
+            "directionId": vehicles["directionId"].astype(np.int64),
+            "distanceFromPoint": vehicles["distanceFromPoint"].astype(np.float64),
+            "pointId": vehicles["pointId"].astype(np.int64),
+        }
+    )
+    return snapshots, vehicles
+
+
+def match_stops_and_segments(vehicles, network, segment_index=None):
+    """
+    Vectorized equivalent of `to_df` over all snapshots at once.
+
+    Joins every vehicle to its stop (allowing the +/-1 directionId discrepancy)
+    and to the segment starting at that stop with a single lookup in the
+    network index, then ranks vehicles sharing a stop.
+
+    Parameters:
+    vehicles (pd.DataFrame): The vehicle table from `flatten_snapshots`.
+    network (NetworkIndex): The stop/segment lookup of the network.
+    segment_index (SegmentIndex): Optional; vehicles whose stop does not match are
+        map-matched onto the segments from the stop's location instead of being removed.
+
+    Returns:
+    pd.DataFrame: 'snapshot' followed by POSITION_COLUMNS, in the row order `to_df` produces.
+    pd.Series: Number of rows removed by the stop match, indexed by snapshot.
+    """
+    vehicles = vehicles.assign(_row=np.arange(len(vehicles)))
+    df = vehicles.merge(network.lookup, on=["line_id", "directionId", "pointId"], how="inner")
+    if segment_index is not None:
+        recovered = segment_index.recover(vehicles[~vehicles["_row"].isin(df["_row"])])
+        recovered = recovered.merge(network.lookup, on=["line_id", "directionId", "pointId"], how="inner")
+        df = pd.concat([df, recovered], ignore_index=True)
+    # same order as merge_with_flexible_direction's three merges, each followed by the segment merge
+    df = df.sort_values(["snapshot", "_order", "_row", "_stop_row", "_segment_row"], kind="stable")
+
+    # identical rows within a snapshot collapse, exactly like the per-snapshot drop_duplicates
+    stop_match = ["snapshot", "directionId", "distanceFromPoint", "pointId", "direction_id", "stop_name", "stop_sequence"]
+    num_rows = vehicles.groupby("snapshot").size()
+    num_matched = df.drop_duplicates(subset=stop_match).groupby("snapshot").size()
+    num_rows_removed = num_rows.sub(num_matched, fill_value=0).astype(int)
+
+    df = df.drop_duplicates(subset=stop_match + ["_segment_row"])
+    df = df[df["_segment_row"].notna()]
+    df["end"] = df["end"].astype(network.segments["end"].dtype)
+    df["rank"] = df.groupby(["snapshot", "directionId", "pointId"])["distanceFromPoint"].rank()
+    df["rank"] = df["rank"].astype(int)
+
+    df = df[["snapshot"] + POSITION_COLUMNS].reset_index(drop=True)
+    return df, num_rows_removed
+
+
+def join_snapshot_pairs(positions, pair_starts):
+    """
+    Vectorized equivalent of `join_dataframes` for every (t, t+1) snapshot pair at once.
+
+    Every pair is identified by the snapshot id of its first snapshot; the pair id
+    is added to all join keys so vehicles are only ever matched within their own pair.
+
+    Parameters:
+    positions (pd.DataFrame): The output of `match_stops_and_segments`.
+    pair_starts (array-like): Snapshot ids t for which (t, t+1) should be joined.
+
+    Returns:
+    pd.DataFrame: The joined rows, indexed by ('pair', position within the pair).
+    """
+    df1 = positions[positions["snapshot"].isin(pair_starts)].rename(columns={"snapshot": "pair"})
+    df2 = positions[(positions["snapshot"] - 1).isin(pair_starts)].rename(columns={"snapshot": "pair"})
+    df2["pair"] -= 1
+
+    def index_by_pair(df):
+        # `join_dataframes` aligns its two merges by position within the pair
+        return df.set_index(["pair", df.groupby("pair").cumcount().rename("position")])
+
+    # Step 1: exact match, the bus is in the same stop
+    exact_match = pd.merge(
+        df1,
+        df2,
+        on=["pair", "pointId", "directionId", "stop_sequence", "rank"],
+        how="left",
+        suffixes=("_df1", "_df2"),
+    )
+    exact_match = index_by_pair(exact_match)
+    distance_from_point_condition = exact_match["distanceFromPoint_df2"] > exact_match["distanceFromPoint_df1"]
+    exact_match.loc[~distance_from_point_condition] = pd.NA
+    matched = ~exact_match["stop_name_df2"].isna()
+    exact_match.loc[matched, "pointId_df1"] = exact_match.loc[matched, "pointId"]
+    exact_match.loc[matched, "pointId_df2"] = exact_match.loc[matched, "pointId"]
+    exact_match.drop(columns=["pointId"], inplace=True)
+
+    # Step 2: the bus moved on to the next stop
+    df1_shifted = df1.copy()
+    df1_shifted["stop_sequence"] += 1
+    shifted_match = pd.merge(
+        df1_shifted,
+        df2,
+        on=["pair", "directionId", "stop_sequence", "rank"],
+        how="left",
+        suffixes=("_df1", "_df2"),
+    )
+    shifted_match = index_by_pair(shifted_match)
+
+    # Step 3: combine results, prioritizing the exact match
+    combined = exact_match.combine_first(shifted_match)
+
+    # Step 4: keep the first occurrence per pair
+    combined = combined[
+        ~combined.reset_index(level="position", drop=True)
+        .set_index(["directionId", "stop_sequence", "rank"], append=True)
+        .index.duplicated(keep="first")
+    ]
+
+    return combined.dropna()
+
+
+def compute_interval_speeds(
+    vehicle_positions,
+    network,
+    apply_filter=True,
+    gap_policy="drop",
+    max_gap=MAX_GAP_SECONDS,
+    segment_index=None,
+    metrics=None,
+):
+    """
+    Compute the per-vehicle speed between every pair of consecutive snapshots of every line.
+
+    Produces the same rows, in the same order, as calling `get_interval_pair` for
+    every pair and concatenating the results, but with a handful of whole-table
+    operations instead of one round of merges per pair.
+
+    Speeds are the distance traveled divided by the time actually elapsed between
+    the two observations (see 'observed_at' in `flatten_snapshots`).
+
+    Parameters:
+    vehicle_positions (dict or iterable): Snapshots, as accepted by `flatten_snapshots`.
+    network (NetworkIndex): The stop/segment lookup of the network.
+    segment_index (SegmentIndex): Optional, see `match_stops_and_segments`.
+    apply_filter (bool): Keep only speeds in (0, 25) m/s.
+    gap_policy (str): How to treat pairs at least `max_gap` seconds apart, one of GAP_POLICIES.
+    max_gap (float): Interval, in seconds, from which a pair is considered to have missed a poll.
+    metrics (Metrics): Optional; records the time and rows of every stage and the dropped rows per line.
+
+    Returns:
+    pd.DataFrame: One row per matched vehicle and pair, with OUTPUT_COLUMNS.
+    float: Percentage of rows removed because they did not match a stop.
+    """
+    df, total_rows_removed, total_rows_per_instance = _interval_speeds(
+        vehicle_positions, network, apply_filter, gap_policy, max_gap, segment_index, metrics
+    )
+    return df, _percent_removed(total_rows_removed, total_rows_per_instance)
+
+
+def _percent_removed(rows_removed, rows_per_instance):
+    # no pair at all, e.g. an empty recording
+    return rows_removed / rows_per_instance * 100 if rows_per_instance else 0.0
+
+
+def _interval_speeds(
+    vehicle_positions, network, apply_filter, gap_policy, max_gap, segment_index=None, metrics=None
+):
+    # compute_interval_speeds, returning the raw row counts so shards can be summed
+    if gap_policy not in GAP_POLICIES:
+        raise ValueError(f"gap_policy must be one of {GAP_POLICIES}, got {gap_policy!r}")
+    metrics = metrics if metrics is not None else Metrics(enabled=False)
+    with metrics.stage("flatten") as stage:
+        snapshots, vehicles = flatten_snapshots(vehicle_positions)
+        stage["rows_in"] = snapshots["num_vehicles"].sum() + snapshots["num_zero_distance"].sum()
+        stage["rows_out"] = len(vehicles)
+
+    # a pair is skipped when either of its snapshots has no vehicles
+    line_ids = snapshots["line_id"].to_numpy()
+    non_empty = snapshots["num_vehicles"].to_numpy() > 0
+    is_pair = np.zeros(len(snapshots), dtype=bool)
+    is_pair[:-1] = (line_ids[:-1] == line_ids[1:]) & non_empty[:-1] & non_empty[1:]
+    pair_starts = snapshots.loc[is_pair, "snapshot"].to_numpy()
+
+    with metrics.stage("match", rows_in=len(vehicles)) as stage:
+        positions, num_rows_removed = match_stops_and_segments(vehicles, network, segment_index)
+        stage["rows_out"] = len(positions)
+    total_rows_per_instance = snapshots.loc[is_pair, "num_vehicles"].sum()
+    total_rows_removed = num_rows_removed.reindex(pair_starts, fill_value=0).sum()
+
+    with metrics.stage("join") as stage:
+        df = join_snapshot_pairs(positions, pair_starts)
+        stage["rows_in"] = positions["snapshot"].isin(pair_starts).sum()
+        stage["rows_out"] = len(df)
+    if metrics.enabled:
+        metrics.drop("zero_distance", snapshots[is_pair].groupby("line_id")["num_zero_distance"].sum())
+        metrics.drop(
+            "unmatched_stop",
+            num_rows_removed.reindex(pair_starts, fill_value=0).groupby(line_ids[pair_starts]).sum(),
+        )
+        pair_positions = positions.loc[positions["snapshot"].isin(pair_starts), "snapshot"]
+        metrics.drop(
+            "no_next_match",
+            _rows_per_line(line_ids[pair_positions]).sub(
+                _rows_per_line(line_ids[df.index.get_level_values("pair")]), fill_value=0
+            ),
+        )
+
+    with metrics.stage("speeds", rows_in=len(df)) as stage:
+        pairs = df.index.get_level_values("pair")
+        ts1 = snapshots["timestamp"].to_numpy()[pairs]
+        observed_at = snapshots["observed_at"].to_numpy()
+        interval_in_seconds = (observed_at[pairs + 1] - observed_at[pairs]) / np.timedelta64(1, "s")
+        gap = interval_in_seconds >= max_gap
+
+        condition = df["pointId_df1"] == df["pointId_df2"]
+        df["distance_traveled"] = condition * (
+            df["distanceFromPoint_df2"] - df["distanceFromPoint_df1"]
+        ) + (~condition) * (
+            (df["segment_length_df1"] - df["distanceFromPoint_df1"])
+            + df["distanceFromPoint_df2"]
+        )
+        df["interval_in_seconds"] = interval_in_seconds
+        df["speed"] = df["distance_traveled"] / df["interval_in_seconds"]
+        df["timestamp"] = ts1
+
+        # a gap means we missed at least one poll, so the bus may have been anywhere in between
+        if gap_policy == "zero":
+            df.loc[gap, ["distance_traveled", "speed"]] = 0
+        elif gap_policy == "drop":
+            if metrics.enabled:
+                metrics.drop("gap", _rows_per_line(line_ids[pairs[gap]]))
+            df = df[~gap]
+
+        if apply_filter:
+            in_range = ((df["speed"] > 0) & (df["speed"] < 25)).to_numpy()
+            if metrics.enabled:
+                metrics.drop("speed_filter", _rows_per_line(line_ids[df.index.get_level_values("pair")[~in_range]]))
+            df = df[in_range]
+
+        df = df[OUTPUT_COLUMNS].reset_index(drop=True)
+        stage["rows_out"] = len(df)
+    return df, int(total_rows_removed), int(total_rows_per_instance)
+
+
+def _rows_per_line(line_ids):
+    return pd.Series(line_ids, dtype=np.int64).value_counts()
+
+
+def iter_shards(vehicle_positions, max_snapshots=None):
+    """
+    Split the snapshots into independent shards, one per line.
+
+    With `max_snapshots`, a line is further split into time windows of at most
+    that many snapshots. Consecutive windows share their boundary snapshot, so
+    every (t, t+1) pair belongs to exactly one shard.
+
+    Yields:
+    dict: line_id -> list of snapshots, for a single line.
+    """
+    # a window of one snapshot has no pair, and would never advance
+    if max_snapshots is not None and max_snapshots < 2:
+        raise ValueError(f"max_snapshots must be at least 2, got {max_snapshots}")
+    if not isinstance(vehicle_positions, dict):
+        lines = {}
+        for line, instance in vehicle_positions:
+            lines.setdefault(line, []).append(instance)
+        vehicle_positions = lines
+    for line, instances in vehicle_positions.items():
+        instances = [instance for instance in instances if instance["vehicle_positions"] is not None]
+        if max_snapshots is None or len(instances) <= max_snapshots:
+            yield {line: instances}
+            continue
+        for start in range(0, len(instances) - 1, max_snapshots - 1):
+            yield {line: instances[start : start + max_snapshots]}
+
+
+# the network and segment indexes of a worker process, set once by the pool initializer
+_worker_network = None
+_worker_segment_index = None
+
+
+def _init_worker(network, segment_index=None):
+    global _worker_network, _worker_segment_index
+    _worker_network = network
+    _worker_segment_index = segment_index
+
+
+def _compute_shard(args):
+    shard, apply_filter, gap_policy, max_gap, aggregate, instrument = args
+    metrics = Metrics(enabled=instrument)
+    df, rows_removed, rows_per_instance = _interval_speeds(
+        shard, _worker_network, apply_filter, gap_policy, max_gap, _worker_segment_index, metrics
+    )
+    if aggregate:
+        from stib.aggregation import SpeedAggregator
+
+        # ship the (much smaller) partial aggregates back instead of every row
+        aggregator = SpeedAggregator()
+        aggregator.add(df)
+        df = aggregator
+    return df, rows_removed, rows_per_instance, metrics
+
+
+def compute_interval_speeds_parallel(
+    vehicle_positions,
+    network,
+    apply_filter=True,
+    gap_policy="drop",
+    max_gap=MAX_GAP_SECONDS,
+    processes=None,
+    max_snapshots=None,
+    aggregate=False,
+    segment_index=None,
+    metrics=None,
+):
+    """
+    `compute_interval_speeds` with the lines (or line x time windows) sharded across a process pool.
+
+    The network (and segment) index is sent to each worker once, when the pool starts,
+    rather than with every task. Shard results are concatenated in line order,
+    so the result is the same as the serial computation.
+
+    Parameters:
+    processes (int): Number of worker processes, all cores by default.
+    max_snapshots (int): Split lines into windows of at most this many snapshots (see `iter_shards`).
+    aggregate (bool): Have every worker fold its rows into 10-minute buckets and merge those.
+    metrics (Metrics): Optional; the records of every worker are merged into it.
+    The other parameters are those of `compute_interval_speeds`.
+
+    Returns:
+    pd.DataFrame or SpeedAggregator: One row per matched vehicle and pair, with OUTPUT_COLUMNS,
+        or the merged buckets when `aggregate` is set.
+    float: Percentage of rows removed because they did not match a stop.
+    """
+    tasks = (
+        (shard, apply_filter, gap_policy, max_gap, aggregate, metrics is not None and metrics.enabled)
+        for shard in iter_shards(vehicle_positions, max_snapshots)
+    )
+    results, total_rows_removed, total_rows_per_instance = [], 0, 0
+    with multiprocessing.Pool(processes, initializer=_init_worker, initargs=(network, segment_index)) as pool:
+        for df, rows_removed, rows_per_instance, shard_metrics in pool.imap(_compute_shard, tasks):
+            if metrics is not None:
+                metrics.merge(shard_metrics)
+            results.append(df)
+            total_rows_removed += rows_removed
+            total_rows_per_instance += rows_per_instance
+    if aggregate:
+        from stib.aggregation import SpeedAggregator
+
+        df = SpeedAggregator()
+        for aggregator in results:
+            df.merge(aggregator)
+    elif results:
+        df = pd.concat(results, ignore_index=True)
+    else:
+        # not a single shard: the (empty) serial result, with its columns and dtypes
+        df = _interval_speeds({}, network, apply_filter, gap_policy, max_gap)[0]
+    return df, _percent_removed(total_rows_removed, total_rows_per_instance)
@@ -0,0 +1,184 @@
+import argparse
+import json
+import os
+import time
+from datetime import datetime, timedelta
+
+from stib.aggregation import SpeedAggregator
+from stib.positions import as_positions
+from stib.snapshot_log import _Decompressor, iter_vehicle_positions
+from stib.speed_engine import MAX_GAP_SECONDS, _interval_speeds
+
+
+def replay(path, speedup=None):
+    """
+    Replay a snapshot log (or legacy JSON dump) as a stream of (line_id, snapshot) tuples.
+
+    With `speedup`, snapshots are released at their recorded pace divided by
+    `speedup` (1 is real time); otherwise as fast as they can be consumed.
+    """
+    first_timestamp, started = None, time.monotonic()
+    for line_id, instance in iter_vehicle_positions(path):
+        if speedup:
+            timestamp = datetime.strptime(instance["timestamp"], "%Y-%m-%d %H:%M:%S")
+            first_timestamp = first_timestamp or timestamp
+            delay = (timestamp - first_timestamp).total_seconds() / speedup - (time.monotonic() - started)
+            if delay > 0:
+                time.sleep(delay)
+        yield line_id, instance
+
+
+def follow(path, poll_interval=1.0, idle_timeout=None):
+    """
+    Stream the snapshots of a log that is still being written, like `tail -f`.
+
+    Handles plain, gzip and zstd logs, by extension; only complete records are
+    returned. A log that does not exist yet is waited for, e.g. when started
+    before the collector. Stops after `idle_timeout` seconds without new data,
+    or never if it is None.
+    """
+    decompressor = _Decompressor(path)
+    buffer = b""
+    position = 0
+    idle_since = time.monotonic()
+    while True:
+        data = b""
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                f.seek(position)
+                data = f.read()
+        position += len(data)
+        buffer += decompressor.decompress(data)
+        *rows, buffer = buffer.split(b"\n")
+        for row in rows:
+            record = json.loads(row)
+            record["vehicle_positions"] = as_positions(record["vehicle_positions"])
+            yield record.pop("line_id"), record
+        if rows:
+            idle_since = time.monotonic()
+        elif idle_timeout is not None and time.monotonic() - idle_since > idle_timeout:
+            return
+        else:
+            time.sleep(poll_interval)
+
+
+class RollingCsvSink:
+    """
+    Append rows to one CSV file per period of their 'timestamp' column,
+    e.g. speeds_2024-08-27_0900.csv for hourly files.
+    """
+
+    def __init__(self, directory, prefix, freq="1h", timestamp_column="timestamp"):
+        self.directory = directory
+        self.prefix = prefix
+        self.freq = freq
+        self.timestamp_column = timestamp_column
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, period):
+        return os.path.join(self.directory, f"{self.prefix}_{period.strftime('%Y-%m-%d_%H%M')}.csv")
+
+    def write(self, df):
+        if df.empty:
+            return
+        periods = df[self.timestamp_column].dt.floor(self.freq)
+        for period, rows in df.groupby(periods, sort=True):
+            path = self.path(period)
+            rows.to_csv(path, mode="a", index=False, header=not os.path.isfile(path))
+
+
+class StreamingSpeedCalculator:
+    """
+    Compute segment speeds as snapshots arrive.
+
+    Only the previous snapshot of every line is kept. All snapshots of a poll
+    are paired with their predecessors in one pass of the speed engine, the
+    resulting rows are pushed to `row_sink` and folded into 10-minute buckets,
+    which are pushed to `aggregate_sink` as soon as they are closed.
+    """
+
+    def __init__(
+        self,
+        network,
+        row_sink=None,
+        aggregate_sink=None,
+        apply_filter=True,
+        gap_policy="drop",
+        max_gap=MAX_GAP_SECONDS,
+    ):
+        self.network = network
+        self.row_sink = row_sink
+        self.aggregate_sink = aggregate_sink
+        self.apply_filter = apply_filter
+        self.gap_policy = gap_policy
+        self.max_gap = max_gap
+        self.previous = {}
+        self.aggregator = SpeedAggregator()
+
+    def process_poll(self, timestamp, snapshots):
+        """
+        Pair the snapshots of one poll with the previous snapshot of their line.
+
+        Parameters:
+        timestamp (str): The poll timestamp.
+        snapshots (list): (line_id, snapshot) tuples of the poll.
+        """
+        pairs = {}
+        for line_id, instance in snapshots:
+            if instance["vehicle_positions"] is None:
+                continue
+            if line_id in self.previous:
+                pairs[line_id] = [self.previous[line_id], instance]
+            self.previous[line_id] = instance
+
+        if pairs:
+            df, _, _ = _interval_speeds(pairs, self.network, self.apply_filter, self.gap_policy, self.max_gap)
+            if self.row_sink is not None:
+                self.row_sink.write(df)
+            self.aggregator.add(df)
+
+        # pairs still to come start at the last snapshot of their line; if that is
+        # more than max_gap ago they are gaps, so earlier buckets are complete
+        watermark = datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S") - timedelta(seconds=self.max_gap)
+        self._emit(self.aggregator.pop_closed(watermark))
+
+    def run(self, source):
+        """Consume a (line_id, snapshot) stream, one poll at a time."""
+        timestamp, poll = None, []
+        for line_id, instance in source:
+            if instance["timestamp"] != timestamp and poll:
+                self.process_poll(timestamp, poll)
+                poll = []
+            timestamp = instance["timestamp"]
+            poll.append((line_id, instance))
+        if poll:
+            self.process_poll(timestamp, poll)
+        self._emit(self.aggregator.pop_all())
+
+    def _emit(self, df):
+        if self.aggregate_sink is not None and not df.empty:
+            self.aggregate_sink.write(df)
+
+
+def main(argv=None):
+    from stib.network_index import NetworkIndex
+
+    parser = argparse.ArgumentParser(description="Compute STIB segment speeds from a stream of snapshots.")
+    parser.add_argument("log", help="snapshot log written by the collector")
+    parser.add_argument("--follow", action="store_true", help="keep reading the log while it is written")
+    parser.add_argument("--speedup", type=float, default=None, help="replay at the recorded pace divided by this")
+    parser.add_argument("--out", default="data/stream")
+    args = parser.parse_args(argv)
+
+    network = NetworkIndex.from_files("preprocessed_data/Stops.geojson", "data/segments.geojson")
+    source = follow(args.log) if args.follow else replay(args.log, args.speedup)
+    calculator = StreamingSpeedCalculator(
+        network,
+        row_sink=RollingCsvSink(args.out, "speeds_rows"),
+        aggregate_sink=RollingCsvSink(args.out, "speeds_stib", freq="1D", timestamp_column="datetime"),
+    )
+    calculator.run(source)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,306 @@
+"""
+Synthetic STIB network and vehicle position snapshots, in the layout of the real files.
+
+    python -m stib.synthetic /tmp/stib-synthetic --lines 20 --vehicles 8 --hours 2
+
+writes, under the given directory:
+- preprocessed_data/Stops.geojson: stops with line_id, direction, stop_id, stop_name and stop_sequence;
+- data/segments.geojson: segments between consecutive stops, with (lon, lat) coordinates as served by the API;
+- data/bus_lines.txt;
+- data/vehicle_positions_<start>.json: line_id -> list of {"timestamp", "response_timestamp", "vehicle_positions"}.
+
+Vehicles drive along their route at a noisy speed, dwell at random, and
+start a new trip at the end of it. Like the real feed, a few lines report a
+directionId off by one, some vehicles report a stop that is not on their
+line, polls are sometimes missed and snapshots are sometimes empty. With
+--service-hours, lines only run during those hours of the day, and a
+fraction of them (--night-lines) only outside them.
+"""
+import argparse
+import json
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+
+# Brussels, in EPSG:3812
+CENTER = (649_000.0, 665_000.0)
+
+# the collector polls every 13 s, plus the time the requests take
+POLL_INTERVAL = 15.0
+
+
+def _route(rng, num_stops, spacing=(250.0, 600.0), radius=6_000.0):
+    # a smooth random walk; returns the vertices of every segment and the stop positions
+    position = np.array(CENTER) + rng.uniform(-radius, radius, 2)
+    heading = rng.uniform(0, 2 * np.pi)
+    stops, segments = [position.copy()], []
+    for _ in range(num_stops - 1):
+        length = rng.uniform(*spacing)
+        num_vertices = rng.integers(2, 6)
+        vertices = [position.copy()]
+        for _ in range(num_vertices):
+            heading += rng.normal(0, 0.25)
+            position = position + length / num_vertices * np.array([np.cos(heading), np.sin(heading)])
+            vertices.append(position.copy())
+        segments.append(np.array(vertices))
+        stops.append(position.copy())
+    return segments, np.array(stops)
+
+
+def make_network(num_lines=10, min_stops=15, max_stops=35, fuzzy_lines=0.1, seed=0):
+    """
+    A random bus network: every line has two directions along the same road,
+    the second one 5 m aside and in reverse.
+
+    Returns:
+    gpd.GeoDataFrame: Stops in EPSG:3812, with 'line_id', 'direction', 'stop_id', 'stop_name' and 'stop_sequence'.
+    gpd.GeoDataFrame: Segments in EPSG:3812, with 'line_id', 'direction', 'start' and 'end'.
+    dict: (line_id, direction) -> offset added to the directionId the vehicles of that direction report.
+    """
+    import geopandas as gpd
+    import shapely
+
+    rng = np.random.default_rng(seed)
+    line_ids = np.sort(rng.choice(np.arange(12, 100 + num_lines), size=num_lines, replace=False))
+    stop_rows, segment_rows, direction_offsets = [], [], {}
+    next_stop_id = 1000
+    for line_id in line_ids.tolist():
+        segments, stops = _route(rng, int(rng.integers(min_stops, max_stops + 1)))
+        fuzzy = rng.random() < fuzzy_lines
+        for direction in (0, 1):
+            if direction == 1:
+                segments = [vertices[::-1] + 5.0 for vertices in segments[::-1]]
+                stops = stops[::-1] + 5.0
+            stop_ids = list(range(next_stop_id, next_stop_id + len(stops)))
+            next_stop_id += len(stops) + 7
+            for sequence, (stop_id, point) in enumerate(zip(stop_ids, stops), start=1):
+                stop_rows.append(
+                    {
+                        "line_id": line_id,
+                        "direction": direction,
+                        "stop_id": stop_id,
+                        "stop_name": f"Stop {stop_id}",
+                        "stop_sequence": sequence,
+                        "geometry": shapely.Point(point),
+                    }
+                )
+            for start, end, vertices in zip(stop_ids[:-1], stop_ids[1:], segments):
+                segment_rows.append(
+                    {
+                        "line_id": line_id,
+                        "direction": direction,
+                        "start": start,
+                        "end": end,
+                        "geometry": shapely.LineString(vertices),
+                    }
+                )
+            # like bus 71, whose vehicles report a directionId off by one
+            direction_offsets[(line_id, direction)] = int(rng.choice([-1, 1])) if fuzzy else 0
+    stops = gpd.GeoDataFrame(stop_rows, crs="EPSG:3812")
+    segments = gpd.GeoDataFrame(segment_rows, crs="EPSG:3812")
+    return stops, segments, direction_offsets
+
+
+def simulate(
+    stops,
+    segments,
+    direction_offsets,
+    vehicles_per_line=8,
+    hours=1.0,
+    start=datetime(2024, 8, 27, 9, 0, 0),
+    poll_interval=POLL_INTERVAL,
+    missed_poll_rate=0.02,
+    empty_snapshot_rate=0.01,
+    foreign_stop_rate=0.01,
+    service_hours=None,
+    night_line_rate=0.0,
+    seed=0,
+):
+    """
+    Poll the vehicles of every line every `poll_interval` seconds (with jitter) for `hours`.
+
+    Parameters:
+    stops, segments (gpd.GeoDataFrame): Stops and segments of `make_network`.
+    direction_offsets (dict): Direction offsets of `make_network`.
+    missed_poll_rate (float): Probability that a poll is missed, leaving a gap of twice the interval.
+    empty_snapshot_rate (float): Probability that a line returns no vehicles in a poll.
+    foreign_stop_rate (float): Probability that a vehicle reports a stop of another line.
+    service_hours (tuple): Optional (first, last) hours of the day; outside [first, last) lines return no vehicles.
+    night_line_rate (float): Fraction of the lines that run only outside `service_hours` instead.
+
+    Returns:
+    dict: line_id -> list of snapshots, in the layout of vehicle_positions_*.json.
+    """
+    rng = np.random.default_rng(seed)
+    # distance of every stop from the start of its route, along the segments
+    lengths = segments.assign(length=segments.length).groupby(["line_id", "direction"])["length"]
+    routes = []
+    for (line_id, direction), group in stops.sort_values("stop_sequence").groupby(["line_id", "direction"]):
+        offsets = np.concatenate([[0.0], np.cumsum(lengths.get_group((line_id, direction)).to_numpy())])
+        routes.append(
+            {
+                "line_id": str(line_id),
+                "stop_ids": group["stop_id"].to_numpy(),
+                "offsets": offsets,
+                "direction_id": str(int(group["stop_id"].iloc[-1]) + direction_offsets[(line_id, direction)]),
+            }
+        )
+    line_ids = sorted({route["line_id"] for route in routes}, key=int)
+    all_stop_ids = stops["stop_id"].to_numpy()
+
+    # vehicles are spread over both directions of their line
+    vehicle_routes = np.array([i for i in range(len(routes)) for _ in range((vehicles_per_line + 1) // 2)])
+    lengths = np.array([routes[i]["offsets"][-1] for i in vehicle_routes])
+    positions = rng.uniform(0, lengths)
+    cruise_speeds = rng.uniform(4.0, 10.0, len(vehicle_routes))
+
+    vehicle_positions = {line_id: [] for line_id in line_ids}
+    night_lines = set()
+    if service_hours is not None:
+        # drawn from their own generator, not to change the snapshots of the other lines
+        night_rng = np.random.default_rng([seed, 1])
+        night_lines = {line_id for line_id in line_ids if night_rng.random() < night_line_rate}
+    timestamp = start
+    end = start + timedelta(hours=hours)
+    while timestamp < end:
+        stamp = timestamp.strftime("%Y-%m-%d %H:%M:%S")
+        snapshots = {line_id: [] for line_id in line_ids}
+        foreign = rng.random(len(positions)) < foreign_stop_rate
+        foreign_stop_ids = rng.choice(all_stop_ids, len(positions))
+        for i, route_index in enumerate(vehicle_routes.tolist()):
+            route = routes[route_index]
+            k = int(np.searchsorted(route["offsets"], positions[i], side="right")) - 1
+            point_id = foreign_stop_ids[i] if foreign[i] else route["stop_ids"][k]
+            snapshots[route["line_id"]].append(
+                {
+                    "directionId": route["direction_id"],
+                    "distanceFromPoint": int(positions[i] - route["offsets"][k]),
+                    "pointId": str(point_id),
+                }
+            )
+        for line_id in line_ids:
+            vehicles = [] if rng.random() < empty_snapshot_rate else snapshots[line_id]
+            if service_hours is not None:
+                in_service = service_hours[0] <= timestamp.hour < service_hours[1]
+                if in_service == (line_id in night_lines):
+                    vehicles = []
+            latency = timedelta(seconds=float(rng.uniform(0.1, 1.5)))
+            vehicle_positions[line_id].append(
+                {
+                    "timestamp": stamp,
+                    "response_timestamp": (timestamp + latency).isoformat(),
+                    "vehicle_positions": vehicles,
+                }
+            )
+
+        elapsed = poll_interval + rng.uniform(-2.0, 2.0)
+        if rng.random() < missed_poll_rate:
+            elapsed += poll_interval
+        # vehicles dwell at stops and in traffic some of the time
+        moving = rng.random(len(positions)) > 0.2
+        speeds = np.clip(cruise_speeds + rng.normal(0, 2.0, len(positions)), 0.0, 20.0) * moving
+        positions += speeds * elapsed
+        # a new trip starts at the first stop
+        positions = np.where(positions >= lengths, 0.0, positions)
+        timestamp += timedelta(seconds=elapsed)
+    return vehicle_positions
+
+
+def write_network(directory, stops, segments):
+    """Write the stops, segments and bus_lines.txt files under `directory`, in the layout of the real ones."""
+    os.makedirs(os.path.join(directory, "preprocessed_data"), exist_ok=True)
+    os.makedirs(os.path.join(directory, "data"), exist_ok=True)
+    stops.to_crs(epsg=4326).to_file(os.path.join(directory, "preprocessed_data", "Stops.geojson"), driver="GeoJSON")
+
+    # (lon, lat) pairs, like the stops and the API
+    segments = segments.to_crs(epsg=4326)
+    segments = segments.assign(id=np.arange(len(segments)), distance=0.0, color="#000000")
+    segments["line_id"] = segments["line_id"].astype(str)
+    segments.to_file(os.path.join(directory, "data", "segments.geojson"), driver="GeoJSON")
+
+    with open(os.path.join(directory, "data", "bus_lines.txt"), "w") as f:
+        f.write("\n".join(str(line_id) for line_id in sorted(stops["line_id"].unique())))
+
+
+def write_vehicle_positions(path, vehicle_positions):
+    """Write the snapshots as a legacy JSON dump (.json) or as a snapshot log (.ndjson, .ndjson.gz)."""
+    if path.endswith(".json"):
+        with open(path, "w") as f:
+            json.dump(vehicle_positions, f)
+        return
+
+    from stib.snapshot_log import SnapshotLog
+
+    log = SnapshotLog(path)
+    polls = zip(*vehicle_positions.values())
+    for snapshots in polls:
+        for line_id, instance in zip(vehicle_positions, snapshots):
+            fields = {key: value for key, value in instance.items() if key not in ("timestamp", "vehicle_positions")}
+            log.append(line_id, instance["timestamp"], instance["vehicle_positions"], **fields)
+        log.flush()
+
+
+def generate(
+    directory,
+    lines=10,
+    vehicles=8,
+    hours=1.0,
+    start=datetime(2024, 8, 27, 9, 0, 0),
+    seed=0,
+    service_hours=None,
+    night_line_rate=0.0,
+):
+    """
+    Write a synthetic network and `hours` of snapshots under `directory`.
+
+    `service_hours` and `night_line_rate` are those of `simulate`.
+
+    Returns:
+    str: Path of the vehicle positions file.
+    """
+    stops, segments, direction_offsets = make_network(lines, seed=seed)
+    write_network(directory, stops, segments)
+    vehicle_positions = simulate(
+        stops,
+        segments,
+        direction_offsets,
+        vehicles,
+        hours,
+        start,
+        service_hours=service_hours,
+        night_line_rate=night_line_rate,
+        seed=seed,
+    )
+    path = os.path.join(directory, "data", f"vehicle_positions_{start.strftime('%Y-%m-%d_%H:%M:%S')}.json")
+    write_vehicle_positions(path, vehicle_positions)
+    return path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a synthetic STIB network and vehicle position snapshots.")
+    parser.add_argument("directory")
+    parser.add_argument("--lines", type=int, default=10)
+    parser.add_argument("--vehicles", type=int, default=8, help="vehicles per line")
+    parser.add_argument("--hours", type=float, default=1.0)
+    parser.add_argument("--start", default="2024-08-27 09:00:00")
+    parser.add_argument("--service-hours", nargs=2, type=int, metavar=("FIRST", "LAST"), help="e.g. 6 24")
+    parser.add_argument("--night-lines", type=float, default=0.0, help="fraction of lines running outside service hours")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    path = generate(
+        args.directory,
+        args.lines,
+        args.vehicles,
+        args.hours,
+        datetime.strptime(args.start, "%Y-%m-%d %H:%M:%S"),
+        seed=args.seed,
+        service_hours=args.service_hours,
+        night_line_rate=args.night_lines,
+    )
+    print("wrote", path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,341 @@
+"""
+Columnar storage of the raw and computed data, as Parquet datasets partitioned
+by date (and line where it applies) under data/parquet/<dataset>/.
+
+Files are hive-partitioned (date=2024-08-27/line_id=71/part-0.parquet) so
+readers only open the partitions they ask for, and only the requested columns.
+Writing rows again (e.g. re-running a collection or a computation) replaces
+them instead of adding duplicates.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+ROOT = "data/parquet"
+
+VEHICLE_POSITIONS_SCHEMA = pa.schema(
+    [
+        ("timestamp", pa.timestamp("s")),
+        ("observed_at", pa.timestamp("us")),
+        ("directionId", pa.int32()),
+        ("pointId", pa.int32()),
+        ("distanceFromPoint", pa.float64()),
+    ]
+)
+
+GM_SPEEDS_SCHEMA = pa.schema(
+    [
+        ("departure_time", pa.timestamp("s", tz="Europe/Brussels")),
+        ("direction", pa.int8()),
+        ("leg", pa.int16()),
+        ("distance_meters", pa.float64()),
+        ("duration_seconds", pa.float64()),
+        ("speed", pa.float64()),
+    ]
+)
+
+MT_SPEEDS_SCHEMA = pa.schema(
+    [
+        ("timestamp", pa.timestamp("s")),
+        ("pointId", pa.int32()),
+        ("speed", pa.float64()),
+    ]
+)
+
+STIB_SPEEDS_SCHEMA = pa.schema(
+    [
+        ("start", pa.int32()),
+        ("end", pa.int32()),
+        ("datetime", pa.timestamp("s")),
+        ("mean", pa.float64()),
+        ("median", pa.float64()),
+    ]
+)
+
+DATE_PARTITIONING = pa.schema([("date", pa.string())])
+DATE_LINE_PARTITIONING = pa.schema([("date", pa.string()), ("line_id", pa.int16())])
+
+
+def _with_partitions(partitioning, schema):
+    return pa.schema(list(partitioning) + list(schema))
+
+
+def dataset_path(name, root=ROOT):
+    return os.path.join(root, name)
+
+
+def write_partitioned(table, name, partitioning, key, root=ROOT):
+    """
+    Merge a table into a dataset, rewriting every partition it touches as one file.
+
+    Stored rows with the same `key` as a row of `table` are replaced by it, so
+    writing the same rows twice leaves a single copy.
+
+    Parameters:
+    table (pa.Table): The rows, including the partition columns.
+    name (str): The dataset, e.g. "vehicle_positions".
+    partitioning (pa.Schema): The partition columns, in directory order.
+    key (list): The columns identifying a record, e.g. a snapshot for the vehicle rows.
+    """
+    path = dataset_path(name, root)
+    hive = ds.partitioning(partitioning, flavor="hive")
+    if os.path.isdir(path):
+        partitions = table.select(partitioning.names).group_by(partitioning.names).aggregate([])
+        in_partitions = None
+        for values in partitions.to_pylist():
+            condition = None
+            for column, value in values.items():
+                condition = ds.field(column) == value if condition is None else condition & (ds.field(column) == value)
+            in_partitions = condition if in_partitions is None else in_partitions | condition
+        stored = ds.dataset(path, format="parquet", partitioning=hive).to_table(filter=in_partitions)
+        if stored.num_rows:
+            stored = stored.to_pandas()
+            replaced = pd.MultiIndex.from_frame(stored[key]).isin(
+                pd.MultiIndex.from_frame(table.select(key).to_pandas())
+            )
+            stored = pa.Table.from_pandas(stored[~replaced], schema=table.schema, preserve_index=False)
+            table = pa.concat_tables([stored, table])
+    ds.write_dataset(
+        table,
+        path,
+        format="parquet",
+        partitioning=hive,
+        basename_template="part-{i}.parquet",
+        existing_data_behavior="delete_matching",
+        file_options=ds.ParquetFileFormat().make_write_options(compression="zstd"),
+    )
+
+
+def read_partitioned(name, partitioning, columns=None, filters=None, root=ROOT):
+    """
+    Read a dataset with column and partition/predicate pushdown, memory-mapping its files.
+
+    Parameters:
+    filters: A pyarrow expression or a list of (column, op, value) tuples.
+
+    Returns:
+    pd.DataFrame: The matching rows.
+    """
+    path = dataset_path(name, root)
+    if not os.path.isdir(path):
+        return pd.DataFrame(columns=columns)
+    table = pq.read_table(
+        path,
+        columns=columns,
+        filters=filters,
+        memory_map=True,
+        partitioning=ds.partitioning(partitioning, flavor="hive"),
+    )
+    return table.to_pandas()
+
+
+def _filters(dates=None, lines=None):
+    filters = []
+    if dates is not None:
+        filters.append(("date", "in", [str(date) for date in dates]))
+    if lines is not None:
+        filters.append(("line_id", "in", [int(line) for line in lines]))
+    return filters or None
+
+
+# STIB vehicle positions
+
+
+def write_vehicle_positions(snapshots, root=ROOT):
+    """
+    Store (line_id, snapshot) tuples, one row per vehicle.
+
+    The 'vehicle_positions' of the snapshots are POSITION_DTYPE arrays (see
+    stib.positions), whose columns are copied as is. A snapshot without
+    vehicles is kept as a single row with null vehicle columns, since it still
+    breaks the pairing of its neighbours.
+    """
+    from stib.positions import POSITION_DTYPE, as_positions
+
+    line_ids, timestamps, observed_at, positions = [], [], [], []
+    for line_id, instance in snapshots:
+        vehicles = as_positions(instance["vehicle_positions"])
+        if vehicles is None:
+            continue
+        line_ids.append(int(line_id))
+        timestamps.append(instance["timestamp"])
+        observed_at.append(instance.get("response_timestamp"))
+        positions.append(vehicles)
+    if not positions:
+        return
+
+    counts = np.array([len(vehicles) for vehicles in positions])
+    empty = np.repeat(counts == 0, np.maximum(counts, 1))
+    placeholder = np.zeros(1, dtype=POSITION_DTYPE)
+    positions = np.concatenate([vehicles if len(vehicles) else placeholder for vehicles in positions])
+    timestamps = pd.to_datetime(pd.Series(timestamps, dtype=object), format="%Y-%m-%d %H:%M:%S")
+    observed_at = pd.to_datetime(pd.Series(observed_at, dtype=object), format="ISO8601")
+
+    def repeat(values):
+        return np.repeat(np.asarray(values), np.maximum(counts, 1))
+
+    columns = {
+        "date": repeat(timestamps.dt.strftime("%Y-%m-%d")),
+        "line_id": repeat(line_ids),
+        "timestamp": repeat(timestamps),
+        "observed_at": repeat(observed_at),
+    }
+    columns = {name: pa.array(values, from_pandas=True) for name, values in columns.items()}
+    for name in ("directionId", "pointId", "distanceFromPoint"):
+        columns[name] = pa.array(positions[name], mask=empty)
+    schema = _with_partitions(DATE_LINE_PARTITIONING, VEHICLE_POSITIONS_SCHEMA)
+    table = pa.table(columns).select(schema.names).cast(schema)
+    write_partitioned(table, "vehicle_positions", DATE_LINE_PARTITIONING, ["line_id", "timestamp"], root)
+
+
+def log_to_parquet(log_path, root=ROOT):
+    """Copy a snapshot log (or legacy JSON dump) into the vehicle_positions dataset."""
+    from stib.snapshot_log import iter_vehicle_positions
+
+    write_vehicle_positions(iter_vehicle_positions(log_path), root)
+
+
+def read_vehicle_positions(dates=None, lines=None, columns=None, root=ROOT):
+    """
+    Read vehicle rows, ordered by line and timestamp.
+
+    Parameters:
+    dates (list): Dates ("YYYY-MM-DD") to read, all by default.
+    lines (list): Line ids to read, all by default.
+    columns (list): Columns to read, all by default.
+    """
+    if columns is not None:
+        columns = list(dict.fromkeys(["line_id", "timestamp"] + list(columns)))
+    df = read_partitioned("vehicle_positions", DATE_LINE_PARTITIONING, columns, _filters(dates, lines), root)
+    return df.sort_values(["line_id", "timestamp"], kind="stable").reset_index(drop=True)
+
+
+def iter_snapshots(dates=None, lines=None, root=ROOT):
+    """
+    Stream stored vehicle positions as (line_id, snapshot) tuples, in the
+    layout of the snapshot log (POSITION_DTYPE arrays), e.g. for `speed_engine.flatten_snapshots`.
+    """
+    from stib.positions import POSITION_DTYPE
+
+    df = read_vehicle_positions(dates, lines, root=root)
+    if df.empty:
+        return
+    present = df["pointId"].notna().to_numpy()
+    positions = np.zeros(len(df), dtype=POSITION_DTYPE)
+    for name in POSITION_DTYPE.names:
+        positions[name][present] = df[name].to_numpy()[present]
+
+    line_ids = df["line_id"].to_numpy()
+    timestamps = df["timestamp"].to_numpy()
+    starts = np.flatnonzero(
+        np.concatenate([[True], (line_ids[1:] != line_ids[:-1]) | (timestamps[1:] != timestamps[:-1])])
+    )
+    ends = np.append(starts[1:], len(df))
+    observed_at = df["observed_at"].to_numpy()
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        instance = {
+            "timestamp": pd.Timestamp(timestamps[start]).strftime("%Y-%m-%d %H:%M:%S"),
+            "vehicle_positions": positions[start:end][present[start:end]],
+        }
+        if not pd.isna(observed_at[start]):
+            instance["response_timestamp"] = pd.Timestamp(observed_at[start]).isoformat(sep=" ")
+        yield str(line_ids[start]), instance
+
+
+# Google Maps leg speeds
+
+
+def write_gm_speeds(segment_speeds, root=ROOT):
+    """
+    Store the output of `collect_google_maps_data`, one row per route leg.
+
+    Parameters:
+    segment_speeds (dict): (line_id, direction, ...) -> {"time", "speed_data"}.
+    """
+    rows = []
+    for (line_id, direction, *_), entry in segment_speeds.items():
+        departure_time = pd.Timestamp(entry["time"]).tz_convert("Europe/Brussels")
+        for leg, estimates in enumerate(entry["speed_data"]):
+            rows.append(
+                {
+                    "date": departure_time.strftime("%Y-%m-%d"),
+                    "line_id": int(line_id),
+                    "departure_time": departure_time,
+                    "direction": int(direction),
+                    "leg": leg,
+                    "distance_meters": estimates.get("distanceMeters", 0),
+                    "duration_seconds": float(estimates["duration"][:-1]),
+                    "speed": estimates["speed"],
+                }
+            )
+    if not rows:
+        return
+    schema = _with_partitions(DATE_LINE_PARTITIONING, GM_SPEEDS_SCHEMA)
+    write_partitioned(
+        pa.Table.from_pylist(rows, schema=schema),
+        "gm_speeds",
+        DATE_LINE_PARTITIONING,
+        ["line_id", "departure_time", "direction"],
+        root,
+    )
+
+
+def read_gm_speeds(dates=None, lines=None, columns=None, root=ROOT):
+    return read_partitioned("gm_speeds", DATE_LINE_PARTITIONING, columns, _filters(dates, lines), root)
+
+
+# Mobility Twin aggregated speeds
+
+
+def write_mt_speeds(timestamp, entries, root=ROOT):
+    """
+    Store one aggregated-speed response of the Mobility Twin API.
+
+    Parameters:
+    timestamp (datetime): The timestamp the response was requested for.
+    entries (list): The response entries, with 'lineId', 'pointId' and 'speed'.
+    """
+    write_mt_responses([(timestamp, entries)], root)
+
+
+def write_mt_responses(responses, root=ROOT):
+    """Store several aggregated-speed responses at once, as (timestamp, entries) tuples, see `write_mt_speeds`."""
+    rows = [
+        {
+            "date": timestamp.strftime("%Y-%m-%d"),
+            "line_id": int(entry["lineId"]),
+            "timestamp": timestamp,
+            "pointId": int(entry["pointId"]),
+            "speed": entry["speed"],
+        }
+        for timestamp, entries in responses
+        for entry in entries
+    ]
+    if not rows:
+        return
+    schema = _with_partitions(DATE_LINE_PARTITIONING, MT_SPEEDS_SCHEMA)
+    write_partitioned(
+        pa.Table.from_pylist(rows, schema=schema), "mt_speeds", DATE_LINE_PARTITIONING, ["line_id", "timestamp"], root
+    )
+
+
+def read_mt_speeds(dates=None, lines=None, columns=None, root=ROOT):
+    return read_partitioned("mt_speeds", DATE_LINE_PARTITIONING, columns, _filters(dates, lines), root)
+
+
+# STIB 10-minute segment speeds (the content of speeds_stib.csv)
+
+
+def write_stib_speeds(df, root=ROOT):
+    df = df.assign(date=pd.to_datetime(df["datetime"]).dt.strftime("%Y-%m-%d"))
+    schema = _with_partitions(DATE_PARTITIONING, STIB_SPEEDS_SCHEMA)
+    table = pa.Table.from_pandas(df[schema.names], schema=schema, preserve_index=False)
+    write_partitioned(table, "stib_speeds", DATE_PARTITIONING, ["start", "end", "datetime"], root)
+
+
+def read_stib_speeds(dates=None, columns=None, root=ROOT):
+    return read_partitioned("stib_speeds", DATE_PARTITIONING, columns, _filters(dates), root)
@@ -0,0 +1,66 @@
+import os
+from datetime import datetime, timedelta
+
+import pandas as pd
+import pytest
+
+from stib import calculate_stib_speed as pipeline
+from stib import synthetic
+from stib.network_index import NetworkIndex
+
+START = datetime(2024, 8, 27, 23, 30, 0)
+
+
+@pytest.fixture(scope="module")
+def network(tmp_path_factory):
+    directory = str(tmp_path_factory.mktemp("synthetic"))
+    synthetic.generate(directory, lines=3, vehicles=1, hours=0.01, start=START, seed=4)
+    return NetworkIndex.from_files(
+        os.path.join(directory, "preprocessed_data", "Stops.geojson"),
+        os.path.join(directory, "data", "segments.geojson"),
+        cache_dir=None,
+    )
+
+
+def recording():
+    # the first line is not answered from 23:38 to 23:50, and its last poll before is answered
+    # just before the first one after, with the vehicles barely moved: the pair is no gap,
+    # and its rows land in a bucket two windows back
+    stops, segments, direction_offsets = synthetic.make_network(3, seed=4)
+    vehicle_positions = synthetic.simulate(
+        stops, segments, direction_offsets, 6, 1.0, START, missed_poll_rate=0.0, empty_snapshot_rate=0.0, seed=4
+    )
+    line = next(iter(vehicle_positions))
+    instances = vehicle_positions[line]
+    before = [instance for instance in instances if instance["timestamp"] < "2024-08-27 23:38:00"]
+    after = [instance for instance in instances if instance["timestamp"] >= "2024-08-27 23:50:00"]
+    after[0]["vehicle_positions"] = [
+        dict(vehicle, distanceFromPoint=vehicle["distanceFromPoint"] + 10)
+        for vehicle in before[-1]["vehicle_positions"]
+    ]
+    response = pd.Timestamp(after[0]["response_timestamp"]) - timedelta(seconds=15)
+    before[-1]["response_timestamp"] = response.isoformat()
+    vehicle_positions[line] = before + after
+    return vehicle_positions
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_compute_writes_the_same_rows_on_any_number_of_processes(network, tmp_path, monkeypatch, processes):
+    writes = []
+    monkeypatch.setattr(pipeline.storage, "write_stib_speeds", writes.append)
+
+    expected_path, output_path = str(tmp_path / "expected.csv"), str(tmp_path / "speeds.csv")
+    pipeline.compute(recording(), network, expected_path, processes=3 - processes)
+    writes.clear()
+    pipeline.compute(recording(), network, output_path, processes=processes)
+
+    expected, output = pd.read_csv(expected_path), pd.read_csv(output_path)
+    assert len(output) > 0
+    pd.testing.assert_frame_equal(output, expected)
+    # one write per day, in the order of the CSV
+    days = [df["datetime"].dt.date.unique().tolist() for df in writes]
+    assert days == [[START.date()], [START.date() + timedelta(days=1)]]
+    pd.testing.assert_frame_equal(
+        pd.concat(writes, ignore_index=True).assign(datetime=lambda df: df["datetime"].astype(str)),
+        output.astype({"datetime": str}),
+    )
@@ -0,0 +1,49 @@
+from datetime import datetime
+
+import pytest
+
+from google_maps.checkpoint import RouteCheckpoint, dated_checkpoint_path, departure_times
+
+START = datetime(2024, 8, 27, 9, 0)
+LEGS = [{"distanceMeters": 300, "duration": "60s", "speed": 5.0}]
+
+
+def test_resume_keeps_the_schedule_and_the_routes(tmp_path):
+    path = str(tmp_path / "gm.ndjson")
+    checkpoint = RouteCheckpoint(path)
+    times = checkpoint.open_schedule(START, H=1, interval=30)
+    assert times == departure_times(START, 1, 30)
+    checkpoint.append("71", "0", times[1], LEGS)
+
+    resumed = RouteCheckpoint(path)
+    assert resumed.open_schedule(START.replace(minute=20), H=8, interval=10) == times
+    assert (71, 0, times[1]) in resumed
+    assert (71, 0, times[2]) not in resumed
+    assert resumed.segment_speeds() == {(71, 0, times[1]): {"time": times[1], "speed_data": LEGS}}
+
+
+def test_truncated_record_is_dropped(tmp_path):
+    path = tmp_path / "gm.ndjson"
+    checkpoint = RouteCheckpoint(str(path))
+    times = checkpoint.open_schedule(START, H=1, interval=30)
+    checkpoint.append(71, 0, times[1], LEGS)
+    with open(path, "a") as f:
+        f.write('{"line_id": 71, "direction": 1, "ti')
+
+    resumed = RouteCheckpoint(str(path))
+    assert list(resumed.routes) == [(71, 0, times[1])]
+    resumed.append(71, 1, times[1], LEGS)
+    assert len(RouteCheckpoint(str(path)).routes) == 2
+
+
+def test_passed_schedule_fails(tmp_path):
+    path = str(tmp_path / "gm.ndjson")
+    RouteCheckpoint(path).open_schedule(START, H=1, interval=30)
+    with pytest.raises(ValueError, match="has passed"):
+        RouteCheckpoint(path).open_schedule(START.replace(hour=11), H=1, interval=30)
+
+
+def test_runs_on_another_day_get_their_own_checkpoint():
+    today = dated_checkpoint_path("data/gm_segment_speeds.pkl", START)
+    assert today == "data/gm_segment_speeds_2024-08-27.ndjson"
+    assert dated_checkpoint_path("data/gm_segment_speeds.pkl", START.replace(day=28)) != today
@@ -0,0 +1,70 @@
+import asyncio
+import time
+
+import aiohttp
+import numpy as np
+import pytest
+
+from benchmarks.replay_server import ReplayServer, serving
+from google_maps.async_collector import ROUTES_PATH, RetryableError, TokenBucket, compute_route
+from google_maps.route_templates import RequestTemplate, route_locations, route_payloads
+
+# three stops in Brussels: two legs
+LOCATIONS = route_locations(np.array([4.3517, 4.3601, 4.3702]), np.array([50.8466, 50.8503, 50.8427]))
+TEMPLATE = RequestTemplate(route_payloads(LOCATIONS, "__departure_time__")[0])
+DEPARTURE_TIME = "2024-08-28T08:00:00Z"
+
+
+async def compute(url, requests=1, rate=100, capacity=None, **retry):
+    bucket = TokenBucket(rate, capacity)
+    semaphore = asyncio.Semaphore(10)
+    async with aiohttp.ClientSession() as session:
+        return await asyncio.gather(
+            *(
+                compute_route(session, semaphore, bucket, url + ROUTES_PATH, TEMPLATE, DEPARTURE_TIME, **retry)
+                for _ in range(requests)
+            )
+        )
+
+
+def test_compute_route_retries_injected_errors():
+    # with this seed, the first response is an injected 503 and the second one is not
+    server = ReplayServer(error_rate=0.5, seed=9)
+    with serving(server) as url:
+        (legs,) = asyncio.run(compute(url, backoff=0))
+
+    assert server.stats["routes"]["requests"] == 2
+    assert server.stats["routes"]["errors"] == 1
+    assert len(legs) == TEMPLATE.legs
+
+
+def test_compute_route_waits_for_retry_after():
+    server = ReplayServer(error_rate=0.5, retry_after=1, seed=9)
+    with serving(server) as url:
+        started = time.monotonic()
+        asyncio.run(compute(url, backoff=0))
+        elapsed = time.monotonic() - started
+
+    assert server.stats["routes"]["requests"] == 2
+    assert elapsed >= 1
+
+
+def test_compute_route_gives_up_after_max_retries():
+    server = ReplayServer(error_rate=1.0)
+    with serving(server) as url:
+        with pytest.raises(RetryableError):
+            asyncio.run(compute(url, max_retries=2, backoff=0))
+
+    assert server.stats["routes"]["requests"] == 3
+
+
+def test_token_bucket_limits_the_request_rate():
+    # a burst of `capacity` requests, then one every 1 / rate seconds
+    server = ReplayServer()
+    with serving(server) as url:
+        started = time.monotonic()
+        asyncio.run(compute(url, requests=12, rate=20, capacity=2))
+        elapsed = time.monotonic() - started
+
+    assert server.stats["routes"]["requests"] == 12
+    assert 0.45 <= elapsed < 1.5
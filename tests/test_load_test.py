@@ -0,0 +1,26 @@
+import numpy as np
+
+from benchmarks.load_test import first_attempts, poll_starts
+
+A, B = ("1", "2"), ("3",)
+
+
+def test_retries_are_not_polls():
+    requests = [
+        (0.0, A, 200),
+        (0.1, B, 503),
+        (0.6, B, 200),  # retry
+        (13.0, A, 503),
+        (13.5, A, 503),  # retry
+        (14.5, A, 503),  # last retry
+        (13.1, B, 200),
+        (26.0, A, 200),  # next poll, after the retries were exhausted
+        (26.1, B, 200),
+    ]
+    np.testing.assert_array_equal(first_attempts(requests), [0.0, 0.1, 13.0, 13.1, 26.0, 26.1])
+    np.testing.assert_array_equal(poll_starts(first_attempts(requests), 2), [0.0, 13.0, 26.0])
+
+
+def test_polls_of_varying_size_are_found_by_tick():
+    request_times = [13.2, 13.3, 26.1, 52.4, 52.5, 52.6]
+    np.testing.assert_array_equal(poll_starts(request_times, interval=13.0), [13.2, 26.1, 52.4])
@@ -0,0 +1,35 @@
+from datetime import datetime, timedelta
+
+import storage
+from benchmarks.replay_server import MobilityTwinReplay, ReplayServer, serving
+from mobility_twin import get_agg_speed_data as download
+
+START = datetime(2024, 8, 27, 23, 0, 0)
+
+
+def test_download_writes_once_per_day(tmp_path, monkeypatch):
+    root = str(tmp_path / "recorded")
+    storage.write_mt_responses(
+        [
+            (START + timedelta(minutes=10 * i), [{"lineId": "71", "pointId": "1000", "speed": 5.0 + i}])
+            for i in range(6)
+        ],
+        root,
+    )
+    writes = []
+    monkeypatch.setattr(download.storage, "write_mt_responses", writes.append)
+    server = ReplayServer(mobility_twin=MobilityTwinReplay(root), error_rate=0.3, seed=1)
+
+    end = START + timedelta(hours=2)
+    with serving(server) as url:
+        data = download.get_agg_speed_data(START, end, ["71"], "replay", url)
+
+    assert server.stats["mobility_twin"]["errors"] > 0
+    assert len(data) == 13
+    assert [[timestamp.date() for timestamp, _ in day] for day in writes] == [
+        [START.date()] * 6,
+        [end.date()] * 7,
+    ]
+    assert [entries for _, entries in writes[0]] == [
+        [{"lineId": "71", "pointId": "1000", "speed": 5.0 + i}] for i in range(6)
+    ]
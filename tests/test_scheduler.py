@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+
+from stib.positions import as_positions
+from stib.scheduler import PollScheduler
+
+
+def positions(distance):
+    return as_positions([{"directionId": "1", "pointId": "5", "distanceFromPoint": distance}])
+
+
+@pytest.mark.parametrize(
+    "interval, max_gap, expected",
+    [(13, 40, 2), (10, 40, 3), (5, 40, 7), (30, 40, 1), (13 / 240, 40 / 240, 2)],
+)
+def test_active_period_keeps_one_interval_under_max_gap(interval, max_gap, expected):
+    scheduler = PollScheduler(["71"], interval=interval, max_gap=max_gap)
+    assert scheduler.active_period == expected
+    # a poll one interval late still pairs with the previous one
+    assert expected == 1 or (expected + 1) * interval <= max_gap * (1 + 1e-9)
+
+
+def test_latency_margin():
+    assert PollScheduler(["71"], interval=5, latency_margin=0).active_period == 8
+    assert PollScheduler(["71"], interval=5, latency_margin=12).active_period == 5
+
+
+def test_periods_follow_the_vehicles():
+    scheduler = PollScheduler(["71"], interval=13, max_idle_period=8, smoothing=0.5)
+    # moving vehicles: every tick
+    for tick, distance in enumerate([10.0, 20.0, 30.0]):
+        scheduler.observe("71", positions(distance), tick, hour=9)
+    assert scheduler.periods()["71"] == 1
+
+    # the same payload again and again: every active_period ticks
+    for tick in range(3, 6):
+        scheduler.observe("71", positions(30.0), tick, hour=9)
+    assert scheduler.periods()["71"] == scheduler.active_period
+
+    # no vehicles: the period doubles up to max_idle_period
+    periods = []
+    for tick in range(6, 12):
+        scheduler.observe("71", None if tick % 2 else positions(0.0)[:0], tick, hour=3)
+        periods.append(scheduler.periods()["71"])
+    assert periods == [4, 8, 8, 8, 8, 8]
+    assert scheduler.due(11) == []
+    assert scheduler.due(11 + 8) == ["71"]
+
+
+def test_idle_line_is_capped_at_its_usual_hours():
+    profile = {"71": [None] * 6 + [3.0] * 18}
+    scheduler = PollScheduler(["71"], interval=13, max_idle_period=16, profile=profile)
+    for tick in range(6):
+        scheduler.observe("71", None, tick, hour=7)
+    assert scheduler.periods()["71"] == scheduler.active_period
+
+
+def test_batches_are_balanced():
+    scheduler = PollScheduler([str(line_id) for line_id in range(23)], batch_size=10)
+    batches = scheduler.batches(0)
+    assert [len(batch) for batch in batches] == [8, 8, 7]
+    assert sorted(sum(batches, [])) == sorted(scheduler.lines)
+
+
+def test_profile_is_averaged_over_runs(tmp_path):
+    path = str(tmp_path / "profile.json")
+    scheduler = PollScheduler(["71"], smoothing=0.5)
+    scheduler.observe("71", positions(1.0), 0, hour=9)
+    scheduler.observe("71", None, 1, hour=9)
+    scheduler.save_profile(path)
+    assert PollScheduler.load_profile(path)["71"][9] == 0.5
+
+    scheduler = PollScheduler(["71"], smoothing=0.5, profile=PollScheduler.load_profile(path))
+    scheduler.observe("71", positions(1.0), 0, hour=9)
+    scheduler.save_profile(path)
+    assert PollScheduler.load_profile(path)["71"][9] == 0.75
+    assert np.all([hour is None for i, hour in enumerate(PollScheduler.load_profile(path)["71"]) if i != 9])
@@ -0,0 +1,49 @@
+import os
+
+import geopandas as gpd
+import pandas as pd
+import pytest
+import shapely
+
+from stib import synthetic
+from stib.segment_index import SegmentIndex
+
+
+@pytest.fixture(scope="module")
+def network(tmp_path_factory):
+    directory = str(tmp_path_factory.mktemp("synthetic"))
+    synthetic.generate(directory, lines=3, vehicles=1, hours=0.01, seed=5)
+    return (
+        os.path.join(directory, "preprocessed_data", "Stops.geojson"),
+        os.path.join(directory, "data", "segments.geojson"),
+    )
+
+
+def stop_vehicles(index):
+    # one vehicle at the start of every segment, on its line and direction
+    return pd.DataFrame(
+        {
+            "line_id": index.segments["line_id"],
+            "directionId": index.segments["direction_id"],
+            "pointId": index.segments["start"],
+            "distanceFromPoint": 0.0,
+        }
+    )
+
+
+def test_recover_with_swapped_stops(network, tmp_path):
+    stops_path, segments_path = network
+    # the layout written by create_db_files.ipynb: POINT (lat lon)
+    stops = gpd.read_file(stops_path)
+    stops["geometry"] = shapely.transform(stops.geometry.to_numpy(), lambda coords: coords[:, ::-1])
+    swapped_path = str(tmp_path / "Stops.geojson")
+    stops.to_file(swapped_path, driver="GeoJSON")
+    assert stops.geometry.x.min() > stops.geometry.y.max()
+
+    index = SegmentIndex.from_files(stops_path, segments_path, cache_dir=None)
+    swapped = SegmentIndex.from_files(swapped_path, segments_path, cache_dir=None)
+    vehicles = stop_vehicles(index)
+
+    expected = index.recover(vehicles)
+    assert len(expected) == len(vehicles)
+    pd.testing.assert_frame_equal(swapped.recover(vehicles), expected)
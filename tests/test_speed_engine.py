@@ -0,0 +1,75 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from stib import calculate_stib_speed as pipeline
+from stib import synthetic
+from stib.network_index import NetworkIndex
+from stib.snapshot_log import load_vehicle_positions
+from stib.speed_engine import OUTPUT_COLUMNS, compute_interval_speeds, compute_interval_speeds_parallel
+
+
+@pytest.fixture(scope="module")
+def recording(tmp_path_factory):
+    directory = str(tmp_path_factory.mktemp("synthetic"))
+    path = synthetic.generate(directory, lines=3, vehicles=4, hours=0.2, seed=3)
+    network = NetworkIndex.from_files(
+        os.path.join(directory, "preprocessed_data", "Stops.geojson"),
+        os.path.join(directory, "data", "segments.geojson"),
+        cache_dir=None,
+    )
+    return path, network
+
+
+def pairwise_speeds(vehicle_positions, network, apply_filter=True):
+    # the loop of the original script: one get_interval_pair per pair, the first pair unfiltered
+    total_df, rows, removed = None, 0, 0
+    for line in vehicle_positions:
+        for i in range(len(vehicle_positions[line]) - 1):
+            result = pipeline.get_interval_pair(vehicle_positions, i, int(line), network)
+            if result is None:
+                continue
+            df3 = result["df3"]
+            rows += result["num_rows_instance"]
+            removed += result["num_rows_removed"]
+            if total_df is None:
+                total_df = df3
+            else:
+                if apply_filter:
+                    df3 = df3[(df3["speed"] > 0) & (df3["speed"] < 25)]
+                total_df = pd.concat([total_df, df3])
+    return total_df, removed / rows * 100
+
+
+@pytest.mark.parametrize("apply_filter", [True, False])
+def test_engine_matches_pairwise_computation(recording, apply_filter):
+    path, network = recording
+    expected, expected_removed = pairwise_speeds(load_vehicle_positions(path), network, apply_filter)
+    df, removed = compute_interval_speeds(load_vehicle_positions(path), network, apply_filter=apply_filter)
+
+    assert len(df) == len(expected) > 0
+    assert removed == pytest.approx(expected_removed)
+    for column in ("pointId_df1", "end_df1", "directionId"):
+        np.testing.assert_array_equal(df[column].astype(int).to_numpy(), expected[column].astype(int).to_numpy())
+    for column in ("distance_traveled", "speed", "interval_in_seconds"):
+        np.testing.assert_allclose(df[column].to_numpy(dtype=float), expected[column].to_numpy(dtype=float))
+    np.testing.assert_array_equal(
+        pd.to_datetime(df["timestamp"]).to_numpy(), pd.to_datetime(expected["timestamp"]).to_numpy()
+    )
+
+
+def test_empty_input(recording):
+    _, network = recording
+    df, removed = compute_interval_speeds({}, network)
+    assert df.empty and list(df.columns) == OUTPUT_COLUMNS
+    assert removed == 0
+
+    parallel, removed = compute_interval_speeds_parallel({}, network, processes=1)
+    pd.testing.assert_frame_equal(parallel, df)
+    assert removed == 0
+
+    aggregator, removed = compute_interval_speeds_parallel({}, network, processes=1, aggregate=True)
+    assert aggregator.pop_all().empty
+    assert removed == 0
@@ -0,0 +1,68 @@
+import asyncio
+
+import aiohttp
+import pytest
+import requests
+
+from benchmarks.replay_server import ReplayServer, StibReplay, serving
+from stib import synthetic
+from stib.async_collector import fetch_chunk
+from stib.collect_stib_data import RECORDS_PATH, get_data, make_session
+
+
+@pytest.fixture(scope="module")
+def replay(tmp_path_factory):
+    directory = str(tmp_path_factory.mktemp("synthetic"))
+    return StibReplay(synthetic.generate(directory, lines=3, vehicles=2, hours=0.05, seed=1))
+
+
+def where(lines):
+    return {"where": f"lineid in {tuple(lines)}"}
+
+
+def test_get_data_retries_injected_errors(replay):
+    # with this seed, the first response is an injected 503 and the second one is not
+    server = ReplayServer(stib=replay, error_rate=0.5, seed=9)
+    lines = sorted(replay.lines)
+    with serving(server) as url:
+        data = get_data(make_session("replay"), where(lines), url + RECORDS_PATH, backoff=0)
+
+    assert server.stats["stib"]["requests"] == 2
+    assert server.stats["stib"]["errors"] == 1
+    assert sorted(entry["lineid"] for entry in data) == lines
+
+
+def test_get_data_gives_up_after_max_retries(replay):
+    server = ReplayServer(stib=replay, error_rate=1.0)
+    with serving(server) as url:
+        with pytest.raises(requests.HTTPError):
+            get_data(make_session("replay"), where(sorted(replay.lines)), url + RECORDS_PATH, backoff=0)
+
+    assert server.stats["stib"]["requests"] == 3
+
+
+async def fetch(url, lines):
+    async with aiohttp.ClientSession() as session:
+        return await fetch_chunk(session, asyncio.Semaphore(1), url + RECORDS_PATH, lines, backoff=0)
+
+
+def test_fetch_chunk_retries_injected_errors(replay):
+    server = ReplayServer(stib=replay, error_rate=0.5, seed=9)
+    lines = sorted(replay.lines)
+    with serving(server) as url:
+        request_timestamp, response_timestamp, results = asyncio.run(fetch(url, lines))
+
+    assert server.stats["stib"]["requests"] == 2
+    assert server.stats["stib"]["errors"] == 1
+    assert request_timestamp <= response_timestamp
+    assert sorted(entry["lineid"] for entry in results) == lines
+
+
+def test_fetch_chunk_gives_up_after_max_retries(replay):
+    server = ReplayServer(stib=replay, error_rate=1.0)
+    with serving(server) as url:
+        with pytest.raises(aiohttp.ClientResponseError) as error:
+            asyncio.run(fetch(url, sorted(replay.lines)))
+
+    assert error.value.status == 503
+    assert server.stats["stib"]["requests"] == 3
@@ -0,0 +1,77 @@
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+import storage
+from stib.positions import as_positions
+
+
+def snapshot(timestamp, vehicles):
+    return {
+        "timestamp": timestamp,
+        "response_timestamp": timestamp.replace(" ", "T") + ".250000",
+        "vehicle_positions": as_positions(vehicles),
+    }
+
+
+SNAPSHOTS = [
+    ("71", snapshot("2024-08-27 09:00:00", [{"directionId": "1", "pointId": "5", "distanceFromPoint": 12.5}])),
+    ("71", snapshot("2024-08-27 09:00:13", [])),
+    (
+        "71",
+        snapshot(
+            "2024-08-27 09:00:26",
+            [
+                {"directionId": "1", "pointId": "5", "distanceFromPoint": 40.0},
+                {"directionId": "2", "pointId": "9", "distanceFromPoint": 0.1},
+            ],
+        ),
+    ),
+    ("12", snapshot("2024-08-28 23:59:50", [{"directionId": "3", "pointId": "7", "distanceFromPoint": 1.0}])),
+]
+
+
+def stored(root, **filters):
+    return [(line_id, instance) for line_id, instance in storage.iter_snapshots(root=root, **filters)]
+
+
+def key(item):
+    return int(item[0]), item[1]["timestamp"]
+
+
+def assert_same_snapshots(actual, expected):
+    actual, expected = sorted(actual, key=key), sorted(expected, key=key)
+    assert [key(item) for item in actual] == [key(item) for item in expected]
+    for (_, a), (_, b) in zip(actual, expected):
+        np.testing.assert_array_equal(a["vehicle_positions"], b["vehicle_positions"])
+        assert a["response_timestamp"] == b["response_timestamp"].replace("T", " ")
+
+
+def test_vehicle_positions_round_trip(tmp_path):
+    storage.write_vehicle_positions(SNAPSHOTS, root=str(tmp_path))
+    assert_same_snapshots(stored(str(tmp_path)), SNAPSHOTS)
+    assert_same_snapshots(stored(str(tmp_path), dates=["2024-08-27"], lines=[71]), SNAPSHOTS[:3])
+
+
+def test_rewriting_replaces_rows(tmp_path):
+    root = str(tmp_path)
+    storage.write_vehicle_positions(SNAPSHOTS[:2], root=root)
+    storage.write_vehicle_positions(SNAPSHOTS[1:], root=root)
+    storage.write_vehicle_positions(SNAPSHOTS, root=root)
+    assert_same_snapshots(stored(root), SNAPSHOTS)
+    partition = tmp_path / "vehicle_positions" / "date=2024-08-27" / "line_id=71"
+    assert sorted(path.name for path in partition.iterdir()) == ["part-0.parquet"]
+
+
+def test_mt_speeds_keep_float64(tmp_path):
+    root = str(tmp_path)
+    timestamp = datetime(2024, 8, 27, 9, 10)
+    entries = [{"lineId": "71", "pointId": "5", "speed": 8.123456789}]
+    storage.write_mt_speeds(timestamp, entries, root=root)
+    storage.write_mt_responses([(timestamp, entries), (timestamp.replace(minute=20), entries)], root=root)
+    df = storage.read_mt_speeds(root=root)
+    assert len(df) == 2
+    assert df["speed"].dtype == np.float64
+    assert (df["speed"] == 8.123456789).all()
+    assert sorted(df["timestamp"]) == [pd.Timestamp(timestamp), pd.Timestamp(timestamp.replace(minute=20))]
@@ -0,0 +1,220 @@
+"""
+Queries of the speeds warehouse for the dashboards, answered from the hourly
+rollups that load_dw.py maintains and cached in memory.
+
+    with psycopg2.connect(dsn) as conn:
+        dw = Warehouse(conn)
+        # average speed per line and hour of the day over the last month, STIB vs Google
+        dw.hourly_profile(start=datetime.now() - timedelta(days=30), sources=["STIB", "GM"])
+
+Results are cached by query and parameters for `ttl` seconds, at most
+`cache_size` of them, least recently used first out. The cache does not see
+loads done by other processes, hence the TTL; call `clear_cache` after a load
+done through the same process.
+
+    python -m warehouse --lines 71 95 --days 30
+"""
+import argparse
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+from facts import EPOCH
+
+HOUR = pd.Timedelta(hours=1)
+
+
+def hour_id(value):
+    """The hour bucket of the rollups (hours since 1970-01-01) a datetime falls into."""
+    return int((pd.Timestamp(value) - EPOCH) // HOUR)
+
+
+class TTLCache:
+    """An LRU mapping whose entries also expire `ttl` seconds after they were stored."""
+
+    def __init__(self, maxsize=256, ttl=300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None or time.monotonic() - entry[0] > self.ttl:
+            self._entries.pop(key, None)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, value):
+        self._entries[key] = (time.monotonic(), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class Warehouse:
+    """
+    Read-only queries of the rollups. Every method returns a DataFrame with
+    'avg_speed' (mean of the 10-minute average speeds) and 'samples' (their number).
+
+    Parameters:
+    conn (connection): An open psycopg2 connection to the warehouse.
+    cache_size (int): Results kept in the cache.
+    ttl (float): Seconds a cached result stays valid.
+    """
+
+    def __init__(self, conn, cache_size=256, ttl=300.0):
+        self.conn = conn
+        self.cache = TTLCache(cache_size, ttl)
+
+    def clear_cache(self):
+        self.cache.clear()
+
+    def query(self, sql, params=None):
+        """Run `sql` with `params`, or return its cached result."""
+        params = params or {}
+        key = (sql, tuple(sorted((name, _hashable(value)) for name, value in params.items())))
+        df = self.cache.get(key)
+        if df is None:
+            with self.conn.cursor() as cur:
+                cur.execute(sql, params)
+                df = pd.DataFrame(cur.fetchall(), columns=[column[0] for column in cur.description])
+            # the connection is only read, do not leave a transaction open
+            self.conn.rollback()
+            self.cache.put(key, df)
+        return df.copy()
+
+    def _filters(self, start=None, end=None, sources=None, **columns):
+        # WHERE clause on the hour range [start, end), the sources and any column -> values
+        conditions, params = [], {}
+        if start is not None:
+            conditions.append("hour_id >= %(first)s")
+            params["first"] = hour_id(start)
+        if end is not None:
+            conditions.append("hour_id < %(last)s")
+            params["last"] = hour_id(end)
+        if sources is not None:
+            conditions.append("source = ANY(%(sources)s)")
+            params["sources"] = list(sources)
+        for column, values in columns.items():
+            if values is not None:
+                conditions.append(f"{column} = ANY(%({column})s)")
+                params[column] = [int(value) for value in values]
+        where = ("WHERE " + " AND ".join(conditions)) if conditions else ""
+        return where, params
+
+    def line_speeds(self, lines=None, start=None, end=None, sources=None, by_direction=False):
+        """
+        Hourly speeds per line (and direction with `by_direction`), from `start` to `end` (excluded).
+
+        Returns:
+        pd.DataFrame: 'line_id', ['direction',] 'datetime' (start of the hour), 'source', 'avg_speed', 'samples'.
+        """
+        table, keys = "speeds_line_hourly", "line_id"
+        if by_direction:
+            table, keys = "speeds_line_direction_hourly", "line_id, direction"
+        where, params = self._filters(start, end, sources, line_id=lines)
+        df = self.query(
+            f"SELECT {keys}, hour_id, source, speed_sum / samples AS avg_speed, samples "
+            f"FROM {table} {where} ORDER BY {keys}, hour_id, source",
+            params,
+        )
+        return _with_datetime(df)
+
+    def segment_speeds(self, segments=None, start=None, end=None, sources=None):
+        """
+        Hourly speeds per segment.
+
+        Parameters:
+        segments (list): (start_stop_id, end_stop_id) pairs, all by default.
+
+        Returns:
+        pd.DataFrame: 'start_stop_id', 'end_stop_id', 'datetime', 'source', 'avg_speed', 'samples'.
+        """
+        where, params = self._filters(start, end, sources)
+        if segments is not None:
+            where = (where + " AND " if where else "WHERE ") + (
+                "(start_stop_id, end_stop_id) IN (SELECT * FROM unnest(%(starts)s, %(ends)s))"
+            )
+            params["starts"] = [int(start_stop_id) for start_stop_id, _ in segments]
+            params["ends"] = [int(end_stop_id) for _, end_stop_id in segments]
+        df = self.query(
+            "SELECT start_stop_id, end_stop_id, hour_id, source, speed_sum / samples AS avg_speed, samples "
+            f"FROM speeds_segment_hourly {where} ORDER BY start_stop_id, end_stop_id, hour_id, source",
+            params,
+        )
+        return _with_datetime(df)
+
+    def hourly_profile(self, lines=None, start=None, end=None, sources=None):
+        """
+        Average speed per line, hour of the day and source over [start, end).
+
+        Returns:
+        pd.DataFrame: 'line_id', 'hour' (0-23), 'source', 'avg_speed', 'samples'.
+        """
+        where, params = self._filters(start, end, sources, line_id=lines)
+        return self.query(
+            "SELECT line_id, mod(hour_id, 24) AS hour, source, sum(speed_sum) / sum(samples) AS avg_speed, "
+            f"sum(samples) AS samples FROM speeds_line_hourly {where} "
+            "GROUP BY 1, 2, 3 ORDER BY 1, 2, 3",
+            params,
+        )
+
+    def compare_sources(self, lines=None, start=None, end=None, sources=("STIB", "GM")):
+        """
+        `hourly_profile` with one 'avg_speed' column per source, e.g. STIB vs Google.
+
+        Returns:
+        pd.DataFrame: Indexed by ('line_id', 'hour'), one column per source.
+        """
+        profile = self.hourly_profile(lines, start, end, sources)
+        return profile.pivot(index=["line_id", "hour"], columns="source", values="avg_speed")
+
+
+def _hashable(value):
+    if isinstance(value, (list, tuple)):
+        return tuple(value)
+    return value
+
+
+def _with_datetime(df):
+    df.insert(df.columns.get_loc("hour_id"), "datetime", EPOCH + df.pop("hour_id").astype("int64") * HOUR)
+    return df
+
+
+def main(argv=None):
+    import psycopg2
+    from dotenv import load_dotenv
+
+    parser = argparse.ArgumentParser(description="Average speed per line and hour of the day, per source.")
+    parser.add_argument("--dsn", default=None, help="defaults to $DW_DSN")
+    parser.add_argument("--lines", nargs="*", type=int, default=None, help="all lines by default")
+    parser.add_argument("--days", type=float, default=30, help="over the last days")
+    parser.add_argument("--sources", nargs="*", default=["STIB", "GM"])
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    conn = psycopg2.connect(args.dsn or os.environ["DW_DSN"])
+    try:
+        dw = Warehouse(conn)
+        start = datetime.now() - timedelta(days=args.days)
+        print(dw.compare_sources(args.lines, start=start, sources=args.sources).to_string())
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()